@@ -12,6 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
 
+from .lifespan import LifespanMiddleware
 from .opentelemetry import setup_telemetry
 
 # Initialize OpenTelemetry before the application is loaded
@@ -21,5 +22,8 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings.local")
 
 application = get_asgi_application()
 
+# Answer the lifespan protocol so apps can start and stop their background resources
+application = LifespanMiddleware(application)
+
 # Wrap the application with the OpenTelemetry middleware
 application = OpenTelemetryMiddleware(application)
@@ -1,15 +1,30 @@
 import tomllib
 from pathlib import Path
+from typing import Literal, Optional
 
 import msgspec
 
 
+class DatabasePool(msgspec.Struct):
+    """psycopg's connection pool, one per process, shared by the threads running the ORM calls"""
+
+    enabled: bool = True
+    min_size: int = 2  # connections kept open
+    max_size: int = 10
+    timeout: float = 10.0  # seconds a query waits for a free connection before failing
+    max_waiting: int = 0  # queries allowed to wait for a connection, 0: no limit
+    max_lifetime: float = 1800.0  # seconds before a connection is replaced
+    max_idle: float = 300.0  # seconds an idle connection above min_size is kept
+    health_checks: bool = True  # check a connection before handing it out
+
+
 class Database(msgspec.Struct):
     name: str
     user: str
     password: str
     host: str
     port: int
+    pool: DatabasePool = msgspec.field(default_factory=DatabasePool)
 
 
 class SMTP2Go(msgspec.Struct):
@@ -18,6 +33,7 @@ class SMTP2Go(msgspec.Struct):
     domain_id: str  # not necessary to query users
     smtp_host: str
     smtp_port: int
+    api_url: str = "https://api.smtp2go.com/v3"
 
 
 class Mailersend(msgspec.Struct):
@@ -26,15 +42,101 @@ class Mailersend(msgspec.Struct):
     domain_id: str
     smtp_host: str
     smtp_port: int
+    api_url: str = "https://api.mailersend.com/v1"
 
 class Usage(msgspec.Struct):
     hobby_monthly_limit: int
 
+
+class Webhook(msgspec.Struct):
+    mode: Literal["direct", "queued"] = "direct"  # queued: acknowledge first, bulk insert in the background
+    batch_size: int = 500  # flush when this many events are waiting
+    flush_interval: float = 0.5  # or when the oldest waiting event is this old (seconds)
+    max_queue_size: int = 10_000  # back-pressure: enqueueing waits once the queue is full
+    enqueue_timeout: float = 2.0  # give up waiting and ask the provider to retry (seconds)
+    flush_retries: int = 3  # a batch that fails to be stored is retried, then dropped
+    retry_backoff: float = 0.5  # wait before the first retry, doubled for each next one (seconds)
+
+
+class ProviderHTTP(msgspec.Struct):
+    """The HTTP client shared by the calls to each provider's API"""
+
+    max_connections: int = 50
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0  # seconds an idle connection is kept open
+    http2: bool = False  # needs the `h2` package (httpx[http2])
+    connect_timeout: float = 3.0
+    timeout: float = 10.0  # read, write and pool timeouts
+    retries: int = 2  # retries of transport errors and 429/502/503/504 answers
+    backoff: float = 0.2  # seconds, doubles with every retry, with jitter
+
+
+class SMTPPool(msgspec.Struct):
+    size: int = 4  # idle sessions kept per SMTP account
+    max_idle: float = 30.0  # seconds, providers drop idle clients
+    max_age: float = 300.0  # seconds before a session is replaced
+    timeout: float = 10.0
+    use_tls: bool = True
+
+
+class OutboundQueue(msgspec.Struct):
+    batch_size: int = 20  # emails a worker claims at once
+    poll_interval: float = 1.0  # seconds an idle worker waits before looking again
+    max_attempts: int = 5  # then the email is dead-lettered
+    retry_backoff: float = 30.0  # seconds before the first retry, doubles with every attempt
+    lock_timeout: float = 300.0  # seconds before an email a worker claimed and never finished is claimed again
+
+
+class SMTPCredentials(msgspec.Struct):
+    ttl: float = 300.0  # seconds the credentials a provider returned are reused
+
+
+class ActiveProviders(msgspec.Struct):
+    ttl: float = 60.0  # seconds, bounds how long another process shows an app's previous provider
+    max_entries: int = 100_000  # apps kept in each process, least recently used first out
+    send_ttl: float = 1.0  # seconds the send path trusts an entry, only without the redis loader cache
+
+
+class LoaderCache(msgspec.Struct):
+    backend: Literal["off", "memory", "redis"] = "memory"  # memory: per process, redis: shared by every process
+    ttl: float = 60.0  # seconds, bounds how stale another process' copy can be
+    max_entries: int = 10_000  # per loader, memory backend only
+    url: str = "redis://localhost:6379/1"  # redis backend only, any Redis-compatible server
+
+
+class Pagination(msgspec.Struct):
+    default_page_size: int = 20  # when a connection gets neither `first` nor `last`
+    max_page_size: int = 100  # larger `first` or `last` are refused
+
+
+class QueryCost(msgspec.Struct):
+    max_cost: int = 10_000  # connections multiply the cost of their nodes by the page size
+    max_depth: int = 12  # fields nested in one another, edges and node included
+
+
+class PersistedQueries(msgspec.Struct):
+    # automatic: clients register a query by sending its text once, allowlist: only `persist_queries` registers
+    mode: Literal["off", "automatic", "allowlist"] = "automatic"
+    cache_size: int = 1000  # parsed and validated documents kept per process, 0 disables the cache
+    max_cached_length: int = 20_000  # characters, longer documents are parsed and validated on every request
+
+
 class Config(msgspec.Struct):
     database: Database
     smtp2go: SMTP2Go
     mailersend: Mailersend
     usage: Usage
+    replica: Optional[Database] = None  # read replica of `database`, GraphQL queries read from it
+    webhook: Webhook = msgspec.field(default_factory=Webhook)
+    loader_cache: LoaderCache = msgspec.field(default_factory=LoaderCache)
+    provider_http: ProviderHTTP = msgspec.field(default_factory=ProviderHTTP)
+    smtp_credentials: SMTPCredentials = msgspec.field(default_factory=SMTPCredentials)
+    active_providers: ActiveProviders = msgspec.field(default_factory=ActiveProviders)
+    smtp_pool: SMTPPool = msgspec.field(default_factory=SMTPPool)
+    outbound: OutboundQueue = msgspec.field(default_factory=OutboundQueue)
+    pagination: Pagination = msgspec.field(default_factory=Pagination)
+    query_cost: QueryCost = msgspec.field(default_factory=QueryCost)
+    persisted_queries: PersistedQueries = msgspec.field(default_factory=PersistedQueries)
 
 
 CONFIG_PATH = Path(__file__).parent.parent.parent / "config.toml"
@@ -0,0 +1,76 @@
+"""The psycopg connection pools Django opens when `[database.pool]` is enabled
+
+Each process has one pool per database alias. Its state is exported as OpenTelemetry metrics with a `pool`
+attribute: the connections in use and idle, the queries waiting for one, and the cumulative number of
+requests and time spent waiting. The wait time divided by the queued requests is the mean acquire latency.
+"""
+
+from django.db import connections
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+
+meter = metrics.get_meter(__name__)
+
+
+def pool_stats() -> dict[str, dict[str, int]]:
+    """psycopg's stats of the pool of every database alias that has one"""
+    stats = {}
+    for alias in connections:
+        # the pool is shared by the threads, only created and never opened here
+        pool = getattr(connections[alias], "pool", None)
+        if pool is not None:
+            stats[alias] = pool.get_stats()
+    return stats
+
+
+def _observe(*keys: str):
+    def callback(options: CallbackOptions):
+        return [
+            Observation(sum(stats.get(key, 0) for key in keys), {"pool": alias})
+            for alias, stats in pool_stats().items()
+        ]
+
+    return callback
+
+
+def _in_use(options: CallbackOptions):
+    return [
+        Observation(stats.get("pool_size", 0) - stats.get("pool_available", 0), {"pool": alias})
+        for alias, stats in pool_stats().items()
+    ]
+
+
+def register_pool_metrics():
+    meter.create_observable_gauge("db.pool.connections.in_use", [_in_use], description="Connections lent out")
+    meter.create_observable_gauge(
+        "db.pool.connections.idle", [_observe("pool_available")], description="Connections ready in the pool"
+    )
+    meter.create_observable_gauge(
+        "db.pool.connections.max", [_observe("pool_max")], description="Maximum size of the pool"
+    )
+    meter.create_observable_gauge(
+        "db.pool.requests.waiting", [_observe("requests_waiting")], description="Queries waiting for a connection"
+    )
+    meter.create_observable_counter(
+        "db.pool.requests", [_observe("requests_num")], description="Connections requested from the pool"
+    )
+    meter.create_observable_counter(
+        "db.pool.requests.queued", [_observe("requests_queued")], description="Requests that had to wait"
+    )
+    meter.create_observable_counter(
+        "db.pool.requests.wait_time",
+        [_observe("requests_wait_ms")],
+        unit="ms",
+        description="Time the queued requests waited for a connection",
+    )
+    meter.create_observable_counter(
+        "db.pool.requests.errors", [_observe("requests_errors")], description="Requests that timed out or failed"
+    )
+
+
+def close_before_fork():
+    """Close the connections and the pools, a forked child must open its own instead of sharing the sockets"""
+    connections.close_all()
+    for connection in connections.all(initialized_only=True):
+        if getattr(connection, "pool", None) is not None:
+            connection.close_pool()
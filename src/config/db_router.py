@@ -0,0 +1,83 @@
+"""Send the reads of GraphQL queries to the read replica configured in `[replica]`
+
+Reads go to the primary unless the code runs inside `read_from_replica()`, the GraphQL view enters it for query
+operations, mutations, webhooks, the admin, commands and workers never see the replica. The first write inside
+that block pins the rest of it to the primary, a resolver that writes reads its own writes back. The pin is shared
+by the tasks and threads the block spawns, sibling resolvers stop using the replica too.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.base.creation import TEST_DATABASE_PREFIX
+
+REPLICA_DB_ALIAS = "replica"
+
+
+class _Reads:
+    __slots__ = ("pinned",)
+
+    def __init__(self):
+        self.pinned = False
+
+
+_reads: ContextVar[Optional[_Reads]] = ContextVar("replica_reads", default=None)
+
+
+@contextmanager
+def read_from_replica():
+    token = _reads.set(_Reads())
+    try:
+        yield
+    finally:
+        _reads.reset(token)
+
+
+def pin_to_primary():
+    """Read from the primary for the rest of the `read_from_replica()` block"""
+    reads = _reads.get()
+    if reads is not None:
+        reads.pinned = True
+
+
+def reading_from_replica() -> bool:
+    reads = _reads.get()
+    return reads is not None and not reads.pinned
+
+
+class ReplicaRouter:
+    def __init__(self):
+        self.replica = REPLICA_DB_ALIAS if REPLICA_DB_ALIAS in settings.DATABASES else None
+
+    def db_for_read(self, model, **hints):
+        # never None: Django would fall back to the database the instance in the hints was read from
+        if self.replica is not None and reading_from_replica() and not self.is_test_mirror(self.replica):
+            return self.replica
+        return DEFAULT_DB_ALIAS
+
+    @staticmethod
+    def is_test_mirror(alias: str) -> bool:
+        """The test runner pointed the replica at the test database, its own connection would not see the
+        transaction of the test: read through the primary's
+        """
+        replica = connections[alias].settings_dict
+        mirror = replica["TEST"].get("MIRROR")
+        return (
+            mirror is not None
+            and replica["NAME"] == connections[mirror].settings_dict["NAME"]
+            and replica["NAME"].startswith(TEST_DATABASE_PREFIX)
+        )
+
+    def db_for_write(self, model, **hints):
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,56 @@
+"""ASGI lifespan support.
+
+Django's ASGI handler only understands ``http`` scopes, so uvicorn's ``lifespan`` events never reach
+the apps. This wrapper answers them and runs the hooks the apps registered, which gives long-lived
+resources (queues, pools, clients) a place to start once per process and to be closed cleanly.
+"""
+
+from logging import getLogger
+from typing import Awaitable, Callable
+
+logger = getLogger(__name__)
+
+Hook = Callable[[], Awaitable[None]]
+
+startup_hooks: list[Hook] = []
+shutdown_hooks: list[Hook] = []
+
+
+def on_startup(hook: Hook) -> Hook:
+    startup_hooks.append(hook)
+    return hook
+
+
+def on_shutdown(hook: Hook) -> Hook:
+    shutdown_hooks.append(hook)
+    return hook
+
+
+class LifespanMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "lifespan":
+            return await self.app(scope, receive, send)
+
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    for hook in startup_hooks:
+                        await hook()
+                except Exception as e:
+                    logger.exception("Startup hook failed")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # shut down in reverse order so resources started last are closed first
+                for hook in reversed(shutdown_hooks):
+                    try:
+                        await hook()
+                    except Exception:
+                        logger.exception("Shutdown hook failed")
+                await send({"type": "lifespan.shutdown.complete"})
+                return
@@ -1,4 +1,5 @@
-from opentelemetry import trace
+from opentelemetry import metrics, trace
+from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
     OTLPSpanExporter as OTLPGRPCSpanExporter,
 )
@@ -9,11 +10,15 @@ from opentelemetry.instrumentation.grpc import GrpcAioInstrumentorServer, GrpcAi
 from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
 
 
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 
 from opentelemetry.instrumentation.psycopg import PsycopgInstrumentor
+
+from .database import register_pool_metrics
 # from .otel_psycopg import PsycopgInstrumentor
 # see https://github.com/open-telemetry/opentelemetry-python-contrib/issues/2486
 # copied from:
@@ -29,6 +34,13 @@ def setup_telemetry():
 
     trace.set_tracer_provider(provider)
 
+    # the loader cache counters and the database pool gauges
+    metric_reader = PeriodicExportingMetricReader(
+        OTLPMetricExporter(endpoint="http://otel-collector:4317"), export_interval_millis=15_000
+    )
+    metrics.set_meter_provider(MeterProvider(resource=resource, metric_readers=[metric_reader]))
+    register_pool_metrics()
+
     # Instrument libraries
     DjangoInstrumentor().instrument()
     PsycopgInstrumentor().instrument()
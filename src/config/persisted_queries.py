@@ -0,0 +1,168 @@
+"""Persisted queries and the cache of parsed and validated GraphQL documents
+
+Clients may send a document by its SHA-256 instead of its text, with the `persistedQuery` extension of Apollo's
+automatic persisted queries: `{"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "..."}}}`.
+`[persisted_queries] mode`:
+
+- `automatic`: an unknown hash answers `PersistedQueryNotFound`, the client sends the text along with the hash
+  once and it is stored for every process.
+- `allowlist`: only the documents registered with `./manage.py persist_queries` run, sent by hash or as text.
+- `off`: hashes are refused, documents are sent as text.
+
+Every document, persisted or not, is parsed and validated once per process: the LRU keeps the `DocumentNode`
+by hash. A hit skips both, only the query cost depends on the variables and is checked on every request.
+Only the documents that pass the cost check are cached (and stored in `automatic` mode), and not those longer
+than `max_cached_length`: an abusive client cannot fill the cache and evict the documents of the others.
+In `allowlist` mode a hit still checks the hash is registered, a query removed from the allowlist stops running
+in every process at once.
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from typing import Any, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from graphql import DocumentNode, GraphQLError, GraphQLSchema, parse, specified_rules, validate
+from graphql_server.exceptions import GraphQLValidationError
+from opentelemetry import metrics
+
+from .query_cost import QueryCost, check_query_cost
+
+meter = metrics.get_meter(__name__)
+hits_counter = meter.create_counter("graphql.documents.hits", description="Documents served parsed and validated")
+misses_counter = meter.create_counter("graphql.documents.misses", description="Documents parsed and validated")
+
+
+def query_hash(query: str) -> str:
+    return sha256(query.encode()).hexdigest()
+
+
+def _error(message: str, code: str) -> GraphQLValidationError:
+    return GraphQLValidationError([GraphQLError(message, extensions={"code": code})])
+
+
+class DocumentCache:
+    """LRU of the valid documents by hash, shared by the requests of the process"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._documents: OrderedDict[str, DocumentNode] = OrderedDict()
+
+    def get(self, hash_: str) -> Optional[DocumentNode]:
+        document = self._documents.get(hash_)
+        if document is not None:
+            self._documents.move_to_end(hash_)
+        return document
+
+    def set(self, hash_: str, document: DocumentNode):
+        if self.max_entries <= 0:
+            return
+        self._documents[hash_] = document
+        self._documents.move_to_end(hash_)
+        while len(self._documents) > self.max_entries:
+            self._documents.popitem(last=False)
+
+    def evict(self, hash_: str):
+        self._documents.pop(hash_, None)
+
+    def clear(self):
+        self._documents.clear()
+
+    def __len__(self):
+        return len(self._documents)
+
+
+documents = DocumentCache(settings.PERSISTED_QUERIES.cache_size)
+
+
+async def _stored_query(hash_: str) -> Optional[str]:
+    from core.models import PersistedQuery
+
+    # from the primary: a hash another process just stored may not have reached the replica
+    stored = PersistedQuery.objects.using(DEFAULT_DB_ALIAS).filter(hash=hash_)
+    return await stored.values_list("query", flat=True).afirst()
+
+
+async def _is_registered(hash_: str) -> bool:
+    from core.models import PersistedQuery
+
+    return await PersistedQuery.objects.using(DEFAULT_DB_ALIAS).filter(hash=hash_).aexists()
+
+
+async def _store_query(hash_: str, query: str):
+    from core.models import PersistedQuery
+
+    await PersistedQuery.objects.abulk_create([PersistedQuery(hash=hash_, query=query)], ignore_conflicts=True)
+
+
+def parse_and_validate(schema: GraphQLSchema, query: str) -> DocumentNode:
+    try:
+        document = parse(query)
+    except GraphQLError as e:
+        raise GraphQLValidationError([e]) from e
+    errors = validate(schema, document, specified_rules)
+    if errors:
+        raise GraphQLValidationError(errors)
+    return document
+
+
+async def get_document(
+    schema: GraphQLSchema,
+    query: Optional[str],
+    extensions: Optional[dict],
+    variables: Optional[dict[str, Any]] = None,
+    operation_name: Optional[str] = None,
+) -> tuple[DocumentNode, QueryCost]:
+    """The parsed and validated document of a request, from its text or its persisted query hash, and the cost of
+    the operation it runs. Raises `GraphQLValidationError`, graphql-server answers it like any invalid document
+    """
+    mode = settings.PERSISTED_QUERIES.mode
+    persisted = (extensions or {}).get("persistedQuery")
+    if persisted is not None:
+        if mode == "off":
+            raise _error("PersistedQueryNotSupported", "PERSISTED_QUERY_NOT_SUPPORTED")
+        hash_ = persisted.get("sha256Hash") if isinstance(persisted, dict) else None
+        if not isinstance(hash_, str):
+            raise _error("The persistedQuery extension needs a sha256Hash", "BAD_USER_INPUT")
+        if query is not None and query_hash(query) != hash_:
+            raise _error("The sha256Hash does not match the query", "BAD_USER_INPUT")
+    elif query:
+        hash_ = query_hash(query)
+    else:
+        raise _error("No GraphQL query found in the request", "BAD_USER_INPUT")
+
+    document = documents.get(hash_)
+    if document is not None:
+        if mode == "allowlist" and not await _is_registered(hash_):
+            documents.evict(hash_)
+            raise _error("PersistedQueryNotAllowed", "PERSISTED_QUERY_NOT_ALLOWED")
+        hits_counter.add(1)
+        return document, _checked_cost(schema, document, variables, operation_name)
+    misses_counter.add(1)
+
+    from_store = query is None or mode == "allowlist"
+    if from_store:
+        query = await _stored_query(hash_)
+        if query is None:
+            if mode == "allowlist":
+                raise _error("PersistedQueryNotAllowed", "PERSISTED_QUERY_NOT_ALLOWED")
+            raise _error("PersistedQueryNotFound", "PERSISTED_QUERY_NOT_FOUND")
+    document = parse_and_validate(schema, query)
+    query_cost = _checked_cost(schema, document, variables, operation_name)
+
+    # only what clients ask to persist is stored, not every ad hoc query
+    if persisted is not None and not from_store:
+        await _store_query(hash_, query)
+    if len(query) <= settings.PERSISTED_QUERIES.max_cached_length:
+        documents.set(hash_, document)
+    return document, query_cost
+
+
+def _checked_cost(
+    schema: GraphQLSchema, document: DocumentNode, variables: Optional[dict[str, Any]], operation_name: Optional[str]
+) -> QueryCost:
+    query_cost, errors = check_query_cost(schema, document, variables, operation_name)
+    if errors:
+        raise GraphQLValidationError(errors)
+    return query_cost
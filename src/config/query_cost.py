@@ -0,0 +1,183 @@
+"""Reject GraphQL operations that would cost too much before running them
+
+Every field costs 1 if it returns an object and 0 if it returns a scalar, the aggregates cost what
+`FIELD_COSTS` says. A connection multiplies the cost of its nodes by its page size (`first`/`last`, or
+`[pagination] default_page_size`), so `users { apps { owner { apps { ... } } } }` costs what it fans out to.
+The edges, nodes and page info of a connection are free, introspection is not counted.
+
+The analysis runs after the validation of the document: an operation above `[query_cost] max_cost` or nested
+deeper than `max_depth` is refused with a validation error, nothing is executed. The walk stops at the first
+limit it passes, the error reports what was measured until then.
+"""
+
+from typing import Any, Optional
+
+from django.conf import settings
+from graphql import (
+    DocumentNode,
+    FieldNode,
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    GraphQLObjectType,
+    GraphQLSchema,
+    InlineFragmentNode,
+    SelectionSetNode,
+    get_named_type,
+    get_operation_ast,
+    is_interface_type,
+    is_object_type,
+    value_from_ast_untyped,
+)
+
+FIELD_COSTS = {
+    # (type, field): cost of resolving the field once
+    ("AppEmails", "usage"): 10,
+    ("AppEmails", "totalEmailsCount"): 5,
+    ("UserEmails", "usage"): 10,
+    ("UserEmails", "sentEmailsCount"): 5,
+}
+
+
+class QueryCost:
+    """The cost and depth of the operation of one request"""
+
+    def __init__(self):
+        self.cost = 0
+        self.depth = 0
+
+    def as_extension(self) -> dict:
+        return {"requested": self.cost, "maximum": settings.QUERY_COST.max_cost, "depth": self.depth}
+
+
+def is_connection(type_) -> bool:
+    return isinstance(type_, GraphQLObjectType) and "edges" in type_.fields and "pageInfo" in type_.fields
+
+
+def is_edge(type_) -> bool:
+    return isinstance(type_, GraphQLObjectType) and "node" in type_.fields and "cursor" in type_.fields
+
+
+class _OverLimit(Exception):
+    def __init__(self, code: str, cost: int, depth: int):
+        super().__init__(code)
+        self.code = code
+        self.cost = cost
+        self.depth = depth
+
+
+class _Analyzer:
+    """Walks the operation once: every fragment is measured once per type, and the walk stops as soon as the
+    part measured so far is over a limit, the cost of an abusive document is bounded by the limits
+    """
+
+    def __init__(self, schema: GraphQLSchema, document: DocumentNode, variables: Optional[dict[str, Any]]):
+        self.schema = schema
+        self.fragments = {
+            definition.name.value: definition
+            for definition in document.definitions
+            if isinstance(definition, FragmentDefinitionNode)
+        }
+        self.variables = variables or {}
+        self.limits = settings.QUERY_COST
+        self.measured: dict[tuple[str, str], tuple[int, int]] = {}
+
+    def check(self, cost: int, depth: int):
+        """`cost` and `depth` are lower bounds of the operation's"""
+        if depth > self.limits.max_depth:
+            raise _OverLimit("QUERY_TOO_DEEP", cost, depth)
+        if cost > self.limits.max_cost:
+            raise _OverLimit("QUERY_TOO_EXPENSIVE", cost, depth)
+
+    def selection_set(
+        self, selection_set: SelectionSetNode, parent_type, multiplier: int, path_depth: int, fragments: frozenset
+    ) -> tuple[int, int]:
+        """The cost and depth of the selections, `multiplier` is the product of the page sizes of the connections
+        above them and `path_depth` the number of fields above them
+        """
+        cost = depth = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                field_cost, field_depth = self.field(selection, parent_type, multiplier, path_depth, fragments)
+            elif isinstance(selection, InlineFragmentNode):
+                type_ = parent_type
+                if selection.type_condition is not None:
+                    type_ = self.schema.get_type(selection.type_condition.name.value)
+                field_cost, field_depth = self.selection_set(
+                    selection.selection_set, type_, multiplier, path_depth, fragments
+                )
+            elif isinstance(selection, FragmentSpreadNode):
+                name = selection.name.value
+                fragment = self.fragments.get(name)
+                # validation refused unknown fragments and cycles, the guard only keeps the walk finite
+                if fragment is None or name in fragments:
+                    continue
+                type_ = self.schema.get_type(fragment.type_condition.name.value)
+                key = (name, type_.name)
+                if key not in self.measured:
+                    self.measured[key] = self.selection_set(
+                        fragment.selection_set, type_, multiplier, path_depth, fragments | {name}
+                    )
+                field_cost, field_depth = self.measured[key]
+            else:
+                continue
+            cost += field_cost
+            depth = max(depth, field_depth)
+            self.check(cost * multiplier, path_depth + depth)
+        return cost, depth
+
+    def field(self, node: FieldNode, parent_type, multiplier: int, path_depth: int, fragments: frozenset):
+        name = node.name.value
+        if name.startswith("__") or not (is_object_type(parent_type) or is_interface_type(parent_type)):
+            return 0, 0
+        definition = parent_type.fields.get(name)
+        if definition is None:
+            return 0, 0
+        free = is_connection(parent_type) or is_edge(parent_type)
+        if node.selection_set is None:
+            return (0 if free else FIELD_COSTS.get((parent_type.name, name), 0)), 1
+
+        field_type = get_named_type(definition.type)
+        page_size = self.page_size(node) if is_connection(field_type) else 1
+        children_cost, children_depth = self.selection_set(
+            node.selection_set, field_type, multiplier * page_size, path_depth + 1, fragments
+        )
+        cost = 0 if free else FIELD_COSTS.get((parent_type.name, name), 1)
+        return cost + children_cost * page_size, children_depth + 1
+
+    def page_size(self, node: FieldNode) -> int:
+        for argument in node.arguments:
+            if argument.name.value in ("first", "last"):
+                size = value_from_ast_untyped(argument.value, self.variables)
+                if isinstance(size, int):
+                    return max(size, 0)
+        return settings.PAGINATION.default_page_size
+
+
+def check_query_cost(
+    schema: GraphQLSchema, document: DocumentNode, variables: Optional[dict[str, Any]], operation_name: Optional[str]
+) -> tuple[QueryCost, list[GraphQLError]]:
+    """Measure the operation a request runs, with the error if it is over the limits. The document must be valid.
+    Walks the selected operation only, without a full validation pass: the document may come from the cache.
+    Over a limit, the cost and depth are those measured when the walk stopped
+    """
+    query_cost = QueryCost()
+    operation = get_operation_ast(document, operation_name)
+    root_type = schema.get_root_type(operation.operation) if operation is not None else None
+    if root_type is None:
+        return query_cost, []
+    try:
+        query_cost.cost, query_cost.depth = _Analyzer(schema, document, variables).selection_set(
+            operation.selection_set, root_type, 1, 0, frozenset()
+        )
+        return query_cost, []
+    except _OverLimit as over:
+        query_cost.cost, query_cost.depth = over.cost, over.depth
+        code = over.code
+
+    limits = settings.QUERY_COST
+    if code == "QUERY_TOO_DEEP":
+        message = f"The operation is nested at least {query_cost.depth} fields deep, the limit is {limits.max_depth}"
+    else:
+        message = f"The operation costs at least {query_cost.cost}, the limit is {limits.max_cost}"
+    return query_cost, [GraphQLError(message, operation, extensions={"code": code, "cost": query_cost.as_extension()})]
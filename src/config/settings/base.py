@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 
-from ..config import config
+from ..config import Database, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
@@ -85,18 +85,42 @@ WSGI_APPLICATION = "config.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    "default": {
+def database_settings(alias: str, database: Database) -> dict:
+    return {
         # "ENGINE": "django.db.backends.sqlite3",
         # "NAME": BASE_DIR / "db.sqlite3",
         "ENGINE": "django.db.backends.postgresql",
-        "NAME": config.database.name,
-        "USER": config.database.user,
-        "PASSWORD": config.database.password,
-        "HOST": config.database.host,
-        "PORT": config.database.port,
+        "NAME": database.name,
+        "USER": database.user,
+        "PASSWORD": database.password,
+        "HOST": database.host,
+        "PORT": database.port,
+        "CONN_HEALTH_CHECKS": database.pool.health_checks,
+        "OPTIONS": {
+            # the pool replaces persistent connections, CONN_MAX_AGE must stay 0
+            "pool": {
+                "name": alias,
+                "min_size": database.pool.min_size,
+                "max_size": database.pool.max_size,
+                "timeout": database.pool.timeout,
+                "max_waiting": database.pool.max_waiting,
+                "max_lifetime": database.pool.max_lifetime,
+                "max_idle": database.pool.max_idle,
+            }
+        }
+        if database.pool.enabled
+        else {},
     }
-}
+
+
+DATABASES = {"default": database_settings("default", config.database)}
+if config.replica is not None:
+    DATABASES["replica"] = database_settings("replica", config.replica)
+    # the test runner points the replica at the test database instead of creating one
+    DATABASES["replica"]["TEST"] = {"MIRROR": "default"}
+
+# GraphQL queries read from the replica, everything else uses the primary
+DATABASE_ROUTERS = ["config.db_router.ReplicaRouter"]
 
 
 # Password validation
@@ -200,4 +224,24 @@ STMP_PROVIDERS = {
     "mailersend": config.mailersend,
 }
 
+PROVIDER_HTTP = config.provider_http
+SMTP_CREDENTIALS = config.smtp_credentials
+ACTIVE_PROVIDERS = config.active_providers
+SMTP_POOL = config.smtp_pool
+OUTBOUND_EMAIL = config.outbound
+
 HOBBY_MONTHLY_EMAIL_LIMIT = config.usage.hobby_monthly_limit
+
+WEBHOOK_INGESTION = config.webhook
+
+PAGINATION = config.pagination
+QUERY_COST = config.query_cost
+PERSISTED_QUERIES = config.persisted_queries
+
+LOADER_CACHE = config.loader_cache
+if LOADER_CACHE.backend == "redis":
+    # needs the `redis` package
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "loaders": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": LOADER_CACHE.url},
+    }
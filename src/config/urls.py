@@ -3,18 +3,19 @@ from django.http import HttpResponse
 from django.urls import include, path
 from django.views.decorators.csrf import csrf_exempt
 import graphene
-from graphql_server.django.views import AsyncGraphQLView
 
 from core.schemas import schema as core_schema
 from mailer.schemas import schema as mailer_schema
-from mailer.views import email_webhook, switch_provider
+from mailer.views import email_webhook, email_webhook_batch, switch_provider
+
+from .views import GraphQLView
 
 
 async def am_i_alive(request):
     return HttpResponse(status=200)
 
 
-class Query(core_schema.Query, graphene.ObjectType): ...
+class Query(core_schema.Query, mailer_schema.Query, graphene.ObjectType): ...
 
 
 class Mutation(core_schema.Mutation, mailer_schema.Mutation, graphene.ObjectType): ...
@@ -31,5 +32,10 @@ urlpatterns = [
     path("health", am_i_alive),
     path("switch_provider/<str:app_id>/<str:provider_name>", switch_provider),
     path("webhook/email/<str:provider_name>/<str:token>", csrf_exempt(email_webhook), name="email_webhook"),
-    path("graphql/", AsyncGraphQLView.as_view(schema=schema.graphql_schema, graphiql=True)),
+    path(
+        "webhook/email/<str:provider_name>/<str:token>/batch",
+        csrf_exempt(email_webhook_batch),
+        name="email_webhook_batch",
+    ),
+    path("graphql/", GraphQLView.as_view(schema=schema.graphql_schema, graphiql=True)),
 ]
@@ -0,0 +1,73 @@
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+
+from graphql import OperationType
+from graphql.utilities import get_operation_ast
+from graphql_server.django.context import GraphQLDjangoContext
+from graphql_server.django.views import AsyncGraphQLView
+from graphql_server.runtime import execute
+
+from core.dataloaders import AppLoader, UserAppIdsLoader, UserAppsPageLoader, UserLoader
+from mailer.dataloaders import ActiveProviderLoader, AppEmailLoader, AppEmailTotalLoader, AppProvidersLoader
+
+from .db_router import read_from_replica
+from .persisted_queries import get_document
+
+
+@dataclass
+class Loaders:
+    """The DataLoaders of one request, shared by all the resolvers so sibling fields are batched
+    and every key is loaded once per request. Never share them across requests: they cache forever
+    """
+
+    user: UserLoader = field(default_factory=UserLoader)
+    app: AppLoader = field(default_factory=AppLoader)
+    user_app_ids: UserAppIdsLoader = field(default_factory=UserAppIdsLoader)
+    user_apps_page: UserAppsPageLoader = field(default_factory=UserAppsPageLoader)
+    app_providers: AppProvidersLoader = field(default_factory=AppProvidersLoader)
+    active_provider: ActiveProviderLoader = field(default_factory=ActiveProviderLoader)
+    app_email: AppEmailLoader = field(default_factory=AppEmailLoader)
+    app_email_total: AppEmailTotalLoader = field(default_factory=AppEmailTotalLoader)
+
+
+@dataclass
+class GraphQLContext(GraphQLDjangoContext):
+    loaders: Loaders = field(default_factory=Loaders)
+
+
+class GraphQLView(AsyncGraphQLView):
+    async def get_context(self, request, response) -> GraphQLContext:
+        # created inside the request's event loop, DataLoaders bind to the loop they are created in
+        return GraphQLContext(request=request, response=response)
+
+    async def execute_operation(self, request_adapter, request_data, context, root_value, allowed_operation_types):
+        if request_data.protocol == "multipart-subscription":
+            return await super().execute_operation(
+                request_adapter, request_data, context, root_value, allowed_operation_types
+            )
+        # parsed and validated once per process, only the cost depends on the variables
+        document, query_cost = await get_document(
+            self.schema,
+            request_data.query,
+            request_data.extensions,
+            request_data.variables,
+            request_data.operation_name,
+        )
+
+        # the operation type decides where the whole request reads from: mutations read their writes back
+        operation = get_operation_ast(document, request_data.operation_name)
+        is_query = operation is not None and operation.operation == OperationType.QUERY
+        with read_from_replica() if is_query else nullcontext():
+            result = await execute(
+                schema=self.schema,
+                query=document,
+                root_value=root_value,
+                variable_values=request_data.variables,
+                context_value=context,
+                operation_name=request_data.operation_name,
+                allowed_operation_types=allowed_operation_types,
+                operation_extensions=request_data.extensions,
+                validate_document=False,
+            )
+        result.extensions = {**(result.extensions or {}), "cost": query_cost.as_extension()}
+        return result
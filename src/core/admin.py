@@ -1,6 +1,12 @@
 from django.contrib import admin
 
-from .models import User
+from .models import PersistedQuery, User
 
 
 admin.site.register(User)
+
+
+@admin.register(PersistedQuery)
+class PersistedQueryAdmin(admin.ModelAdmin):
+    list_display = ("hash", "created_at")
+    search_fields = ("hash", "query")
@@ -16,6 +16,8 @@ class CoreConfig(AppConfig):
     name = "core"
 
     def ready(self):
+        from . import signals  # noqa: F401
+
         try:
             loop = asyncio.get_running_loop()
             logger.info("Registering PlanEnum in the running event loop.")
@@ -24,3 +26,6 @@ class CoreConfig(AppConfig):
             # If no running loop, we are in a synchronous context
             logger.info("Registering PlanEnum in a synchronous context.")
             register_db_enum(connection, "plan", PlanEnum)
+            # a pool opened this early keeps the settings of this moment, the test runner renames the database later
+            connection.close()
+            connection.close_pool()
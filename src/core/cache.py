@@ -0,0 +1,184 @@
+"""Second level cache behind the DataLoaders
+
+The request-scoped loaders only deduplicate within one request, users and apps change rarely so the loaders
+also keep them in a cache shared by every request. Backends:
+
+- `memory`: an LRU with a TTL in the process, nothing to run but every process has its own copy,
+  an invalidation only reaches the process that made the change, the others serve the old value until the TTL.
+- `redis`: Django's cache framework on `config.loader_cache.url`, shared (and invalidated) by every process.
+- `off`: every load goes to the database.
+
+Entries are invalidated by the mutations that change them and by the model signals, after the transaction commits.
+"""
+
+from collections import OrderedDict
+from logging import getLogger
+import threading
+import time
+from typing import Any, Awaitable, Callable, Hashable, Iterable
+
+from django.conf import settings
+from django.core.cache import caches
+from opentelemetry import metrics
+
+logger = getLogger(__name__)
+
+meter = metrics.get_meter(__name__)
+hits_counter = meter.create_counter("loader_cache.hits", description="DataLoader keys served by the shared cache")
+misses_counter = meter.create_counter("loader_cache.misses", description="DataLoader keys loaded from the database")
+
+CACHE_ALIAS = "loaders"
+
+
+class MemoryBackend:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        # signals may invalidate from the threads of sync_to_async
+        self._lock = threading.Lock()
+
+    async def get_many(self, keys: Iterable[Hashable]) -> dict:
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                expires_at, value = entry
+                if expires_at <= now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = value
+        return found
+
+    async def set_many(self, values: dict):
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in values.items():
+                self._entries[key] = (expires_at, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys: Iterable[Hashable]):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    async def adelete_many(self, keys: Iterable[Hashable]):
+        self.delete_many(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoCacheBackend:
+    """Any Django cache, keys are prefixed with the loader's namespace"""
+
+    def __init__(self, namespace: str, ttl: float, alias: str = CACHE_ALIAS):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _key(self, key: Hashable) -> str:
+        return f"{self.namespace}:{key}"
+
+    async def get_many(self, keys: Iterable[Hashable]) -> dict:
+        by_cache_key = {self._key(key): key for key in keys}
+        found = await self.cache.aget_many(by_cache_key)
+        return {by_cache_key[cache_key]: value for cache_key, value in found.items()}
+
+    async def set_many(self, values: dict):
+        await self.cache.aset_many({self._key(key): value for key, value in values.items()}, timeout=self.ttl)
+
+    def delete_many(self, keys: Iterable[Hashable]):
+        self.cache.delete_many([self._key(key) for key in keys])
+
+    async def adelete_many(self, keys: Iterable[Hashable]):
+        await self.cache.adelete_many([self._key(key) for key in keys])
+
+    def clear(self):
+        # the cache may be shared with other namespaces and processes, entries expire with the TTL instead
+        pass
+
+
+class LoaderCache:
+    def __init__(self, namespace: str, backend: MemoryBackend | DjangoCacheBackend | None):
+        self.namespace = namespace
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls, namespace: str) -> "LoaderCache":
+        conf = settings.LOADER_CACHE
+        if conf.backend == "memory":
+            backend = MemoryBackend(conf.ttl, conf.max_entries)
+        elif conf.backend == "redis":
+            backend = DjangoCacheBackend(namespace, conf.ttl)
+        else:
+            backend = None
+        return cls(namespace, backend)
+
+    async def load_many(self, keys: list[Hashable], load: Callable[[list[Hashable]], Awaitable[dict]]) -> list:
+        """Values of `keys` in order, the keys missing from the cache are fetched with `load` and cached.
+        Keys `load` does not return are not cached, they load as None
+        """
+        if self.backend is None:
+            found = await load(keys)
+            return [found.get(key) for key in keys]
+
+        found = await self.backend.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        self._count(hits=len(keys) - len(missing), misses=len(missing))
+        if missing:
+            loaded = await load(missing)
+            if loaded:
+                await self.backend.set_many(loaded)
+            found.update(loaded)
+        return [found.get(key) for key in keys]
+
+    def _count(self, hits: int, misses: int):
+        attributes = {"cache": self.namespace}
+        if hits:
+            self.hits += hits
+            hits_counter.add(hits, attributes)
+        if misses:
+            self.misses += misses
+            misses_counter.add(misses, attributes)
+
+    def invalidate(self, *keys: Hashable):
+        if self.backend is not None and keys:
+            self.backend.delete_many(keys)
+
+    async def ainvalidate(self, *keys: Hashable):
+        if self.backend is not None and keys:
+            await self.backend.adelete_many(keys)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "size": len(self.backend) if isinstance(self.backend, MemoryBackend) else None,
+        }
+
+
+user_cache = LoaderCache.from_settings("user")
+app_cache = LoaderCache.from_settings("app")
@@ -1,6 +1,13 @@
+from collections import defaultdict
+
 from aiodataloader import DataLoader
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
 
 from . import models
+from .cache import app_cache, user_cache
+from .pagination import PageRequest
 
 
 EXCLUDE_USER_FIELDS = [
@@ -14,13 +21,72 @@ EXCLUDE_USER_FIELDS = [
 ]
 
 
+async def load_users(keys):
+    # cached past the request: from the primary even inside a GraphQL query, a lagging replica would refill
+    # the cache with the rows an invalidation just dropped
+    return {
+        user.id: user
+        async for user in models.User.objects.using(DEFAULT_DB_ALIAS).defer(*EXCLUDE_USER_FIELDS).filter(id__in=keys)
+    }
+
+
+async def load_apps(keys):
+    # cached, from the primary like the users
+    return {app.id: app async for app in models.DeployedApp.objects.using(DEFAULT_DB_ALIAS).filter(id__in=keys)}
+
+
 class UserLoader(DataLoader):
     async def batch_load_fn(self, keys):
-        users = {user.id: user async for user in models.User.objects.defer(*EXCLUDE_USER_FIELDS).filter(id__in=keys)}
-        return [users.get(user_id) for user_id in keys]
+        return await user_cache.load_many(keys, load_users)
 
 
 class AppLoader(DataLoader):
     async def batch_load_fn(self, keys):
-        apps = {app.id: app async for app in models.DeployedApp.objects.filter(id__in=keys)}
-        return [apps.get(app_id) for app_id in keys]
+        return await app_cache.load_many(keys, load_apps)
+
+
+class UserAppIdsLoader(DataLoader):
+    async def batch_load_fn(self, keys):
+        app_ids = {user_id: [] for user_id in keys}
+        async for app_id, owner_id in (
+            models.DeployedApp.objects.filter(owner_id__in=keys).order_by("pk").values_list("pk", "owner_id")
+        ):
+            app_ids[owner_id].append(app_id)
+        return [app_ids[user_id] for user_id in keys]
+
+
+class UserAppsPageLoader(DataLoader):
+    """Keys are `(owner_id, page)`, values the rows of `pagination.keyset_page` over the owner's apps.
+    The pages of the same size and direction come from one query, numbering each owner's apps from the cursor
+    """
+
+    async def batch_load_fn(self, keys):
+        # an owner is in a group once, the numbering restarts per owner and not per cursor
+        groups: dict[tuple[int, bool], list[dict[str, PageRequest]]] = defaultdict(list)
+        for owner_id, page in keys:
+            owners = next((g for g in groups[page.size, page.backwards] if owner_id not in g), None)
+            if owners is None:
+                owners = {}
+                groups[page.size, page.backwards].append(owners)
+            owners[owner_id] = page
+
+        pages = {key: [] for key in keys}
+        for (size, backwards), owner_groups in groups.items():
+            order = F("pk").desc() if backwards else F("pk").asc()
+            for owners in owner_groups:
+                beyond_cursor = Q()
+                for owner_id, page in owners.items():
+                    if page.cursor is None:
+                        beyond_cursor |= Q(owner_id=owner_id)
+                    elif backwards:
+                        beyond_cursor |= Q(owner_id=owner_id, pk__lt=page.cursor)
+                    else:
+                        beyond_cursor |= Q(owner_id=owner_id, pk__gt=page.cursor)
+                async for app in (
+                    models.DeployedApp.objects.filter(beyond_cursor)
+                    .annotate(row=Window(RowNumber(), partition_by=F("owner_id"), order_by=order))
+                    .filter(row__lte=size + 1)
+                    .order_by("owner_id", order)
+                ):
+                    pages[app.owner_id, owners[app.owner_id]].append(app)
+        return [pages[key] for key in keys]
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from config.persisted_queries import documents, get_document, parse_and_validate
+from config.query_cost import check_query_cost
+from config.urls import schema
+
+from .bench_graphql import QUERY
+
+QUERIES = {
+    "small": "{ users(first: 10) { edges { node { id username plan } } } }",
+    "dashboard": QUERY,
+}
+
+
+def check_cost(document):
+    return check_query_cost(schema.graphql_schema, document, None, None)
+
+
+def parse_validate_and_check_cost(query: str):
+    return check_cost(parse_and_validate(schema.graphql_schema, query))
+
+
+def per_call(repeat: int, function, *args) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function(*args)
+    return (time.perf_counter() - started) / repeat
+
+
+async def per_call_async(repeat: int, function, *args) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        await function(*args)
+    return (time.perf_counter() - started) / repeat
+
+
+class Command(BaseCommand):
+    help = "Compare parsing and validating a GraphQL document on every request with the document cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", "-r", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        asyncio.run(self.compare(options["repeat"]))
+
+    async def compare(self, repeat: int):
+        graphql_schema = schema.graphql_schema
+        for name, query in QUERIES.items():
+            miss = per_call(repeat, parse_validate_and_check_cost, query)
+
+            documents.clear()
+            await get_document(graphql_schema, query, None)
+            # the cost depends on the variables, a hit checks it on every request
+            hit = await per_call_async(repeat, get_document, graphql_schema, query, None)
+
+            print(
+                f"{name:<10} {len(query):>5} chars  parse+validate+cost {miss * 1e6:>8.1f}µs  "
+                f"cache hit+cost {hit * 1e6:>7.1f}µs  {miss / hit:>5.1f}x faster"
+            )
+        documents.clear()
@@ -0,0 +1,137 @@
+import asyncio
+import secrets
+import socket
+import threading
+import time
+
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.db import connection
+import httpx
+import psycopg
+import uvicorn
+
+from config.database import close_before_fork, pool_stats
+from config.lifespan import LifespanMiddleware
+from mailer.management.commands.bench_webhook import percentile
+
+QUERY = """
+{
+  users(first: 30) {
+    edges {
+      node {
+        id
+        apps(first: 10) { edges { node { id owner { id } emails { totalEmailsCount usage(groupBy: MONTH) { timestamp } } } } }
+        emails { sentEmailsCount }
+      }
+    }
+  }
+}
+"""
+
+
+def start_server() -> str:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    app = LifespanMiddleware(get_asgi_application())
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+class ConnectionMonitor(threading.Thread):
+    """Samples, from its own connection, the server's connections to the database and the sessions opened so far"""
+
+    def __init__(self, interval: float = 0.25):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples: list[int] = []
+        self.stopped = threading.Event()
+        params = connection.get_connection_params()
+        self.conn = psycopg.connect(**params, autocommit=True)
+        self.sessions_at_start = self.sessions()
+
+    def sessions(self) -> int:
+        # every connection opened to the database, PostgreSQL 14+
+        query = "SELECT sessions FROM pg_stat_database WHERE datname = current_database()"
+        return self.conn.execute(query).fetchone()[0]
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            count = self.conn.execute(
+                "SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()"
+            ).fetchone()[0]
+            self.samples.append(count)
+
+    def stop(self) -> tuple[int, int, int]:
+        self.stopped.set()
+        self.join()
+        opened = self.sessions() - self.sessions_at_start
+        self.conn.close()
+        return min(self.samples, default=0), max(self.samples, default=0), opened
+
+
+class Command(BaseCommand):
+    help = "Load test the GraphQL endpoint and watch the database connections of the server"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", help="A running server, one is started in this process by default")
+        parser.add_argument("--requests", "-n", type=int, default=2000)
+        parser.add_argument("--concurrency", "-c", type=int, default=50)
+        parser.add_argument("--query", default=QUERY)
+        parser.add_argument("--no-pool", action="store_true", help="Run the local server without the pool")
+
+    def handle(self, *args, **options):
+        if options["no_pool"]:
+            close_before_fork()
+            connection.settings_dict["OPTIONS"].pop("pool", None)
+        url = options["url"] or start_server()
+        print(f"GraphQL: {url}/graphql/, {options['requests']} requests, concurrency {options['concurrency']}")
+
+        monitor = ConnectionMonitor()
+        monitor.start()
+        latencies, elapsed, errors = asyncio.run(
+            self.run(url, options["query"], options["requests"], options["concurrency"])
+        )
+        fewest, most, opened = monitor.stop()
+
+        print(
+            f"{len(latencies) / elapsed:>7.0f} requests/s  p50={percentile(latencies, 50) * 1000:.1f}ms  "
+            f"p99={percentile(latencies, 99) * 1000:.1f}ms  errors={errors}"
+        )
+        print(f"Database connections: {fewest} to {most} open, {opened} opened during the run")
+        if not options["url"]:
+            for alias, stats in pool_stats().items():
+                print(
+                    f"Pool {alias}: size {stats.get('pool_size', 0)}/{stats.get('pool_max', 0)}, "
+                    f"{stats.get('requests_queued', 0)} of {stats.get('requests_num', 0)} requests waited "
+                    f"{stats.get('requests_wait_ms', 0)}ms in total, {stats.get('requests_errors', 0)} errors"
+                )
+
+    async def run(self, url: str, query: str, total: int, concurrency: int) -> tuple[list[float], float, int]:
+        latencies: list[float] = []
+        errors = 0
+        pending = iter(range(total))
+        limits = httpx.Limits(max_connections=concurrency)
+
+        # any token passes Django's CSRF check as long as the cookie and the header match
+        token = secrets.token_hex(16)
+        async with httpx.AsyncClient(
+            base_url=url, limits=limits, timeout=60, cookies={"csrftoken": token}, headers={"X-CSRFToken": token}
+        ) as client:
+
+            async def worker():
+                nonlocal errors
+                for _ in pending:
+                    started = time.perf_counter()
+                    response = await client.post("/graphql/", json={"query": query})
+                    latencies.append(time.perf_counter() - started)
+                    if response.status_code != 200 or "errors" in response.json():
+                        errors += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return latencies, time.perf_counter() - started, errors
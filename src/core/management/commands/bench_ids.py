@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import DeployedApp, User, allocate_ids, generate_id
+
+
+def exists_per_id() -> str:
+    """How the app ids were generated before, one query per id"""
+    while True:
+        app_id = generate_id()
+        if not DeployedApp.objects.filter(id=app_id).exists():
+            return app_id
+
+
+def bulk_with_exists(owner: User, count: int, batch_size: int):
+    DeployedApp.objects.bulk_create(
+        [DeployedApp(id=exists_per_id(), owner=owner, name=f"bench {i}") for i in range(count)], batch_size=batch_size
+    )
+
+
+def bulk_with_allocator(owner: User, count: int, batch_size: int):
+    DeployedApp.objects.bulk_create(
+        allocate_ids([DeployedApp(owner=owner, name=f"bench {i}") for i in range(count)]), batch_size=batch_size
+    )
+
+
+class Command(BaseCommand):
+    help = "Compare inserting apps with an exists() query per id and with the bulk id allocator, nothing is kept"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--apps", "-n", type=int, default=100_000)
+        parser.add_argument("--batch-size", type=int, default=5_000)
+
+    def handle(self, *args, **options):
+        for label, insert in [("exists() per id", bulk_with_exists), ("bulk allocator", bulk_with_allocator)]:
+            with transaction.atomic():
+                owner = User.objects.create(username=f"bench {time.monotonic()}", full_name="Bench")
+                started = time.perf_counter()
+                insert(owner, options["apps"], options["batch_size"])
+                elapsed = time.perf_counter() - started
+                transaction.set_rollback(True)
+            print(f"{label:<16} {options['apps']} apps in {elapsed:.2f}s  {options['apps'] / elapsed:>9.0f} apps/s")
@@ -0,0 +1,31 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from graphql_server.exceptions import GraphQLValidationError
+
+from config.persisted_queries import parse_and_validate, query_hash
+from config.urls import schema
+from core.models import PersistedQuery
+
+
+class Command(BaseCommand):
+    help = "Register GraphQL documents as persisted queries, the only ones that run in the allowlist mode"
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="+", type=Path, help="Files with one GraphQL document each")
+
+    def handle(self, *args, **options):
+        queries = {}
+        for path in options["files"]:
+            query = path.read_text()
+            try:
+                parse_and_validate(schema.graphql_schema, query)
+            except GraphQLValidationError as e:
+                raise CommandError(f"{path}: {'; '.join(error.message for error in e.errors)}")
+            queries[query_hash(query)] = (path, query)
+
+        PersistedQuery.objects.bulk_create(
+            [PersistedQuery(hash=hash_, query=query) for hash_, (_, query) in queries.items()], ignore_conflicts=True
+        )
+        for hash_, (path, _) in queries.items():
+            self.stdout.write(f"{hash_}  {path}")
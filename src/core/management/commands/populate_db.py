@@ -1,9 +1,17 @@
-from random import choice
+from datetime import datetime, timezone
+import random
+import time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connection, transaction
 
 from core.fields import PlanEnum
-from core.models import DeployedApp, User
+from core.models import RANDOM_ID_LENGTH, DeployedApp, User, alpha_numeric
+from mailer.management.commands.generate_email_events import Distribution, copy_events, zipf_weights
+from mailer.management.commands.rebuild_usage_counters import rebuild_usage_counters
+from mailer.management.commands.rollup_email_usage import rollup_email_usage
+from mailer.models import EmailProvider, SMTPProvider
+from mailer.smtp_providers import SMTPServiceProvider
 
 names = [
     "John",
@@ -53,39 +61,129 @@ app_names = [
 ]
 
 
-def gen_users():
-    print("\n Users: ")
-    for name in names:
-        print(name, end=" | ")
-        yield User(username=name.lower(), plan=choice(PlanEnum.values), full_name=f"{name} {choice(last_names)}")
+class Tenants:
+    """Users, their apps and the apps' EmailProvider rows as COPY text, the same for the same seed"""
 
-def gen_apps():
-    print("\n Apps: ")
-    for name in app_names:
-        print(name, end=" | ")
-        yield DeployedApp(name=name)
+    def __init__(self, rng: random.Random, users: int, apps_per_user: float, pro_share: float, provider_ids: list[int]):
+        self.rng = rng
+        self.provider_ids = provider_ids
+        self.users, self.apps, self.email_providers = [], [], []
+        self.senders: list[str] = []
+        joined = datetime.now(timezone.utc).isoformat()
+        for i in range(users):
+            user_id = self.new_id()
+            first_name = rng.choice(names)
+            username = f"{first_name.lower()}.{i}"
+            plan = PlanEnum.PRO.value if rng.random() < pro_share else PlanEnum.HOBBY.value
+            self.users.append(
+                f"{user_id}\t!\tf\t{username}\t{username}@example.com\tf\tt\t{joined}\t{plan}"
+                f"\t{first_name} {rng.choice(last_names)}\n"
+            )
+            # exponential around the mean: most users have one or two apps, a few have dozens
+            for _ in range(max(1, round(rng.expovariate(1 / apps_per_user)))):
+                self.add_app(user_id)
 
+    def new_id(self) -> str:
+        return "".join(self.rng.choices(alpha_numeric, k=RANDOM_ID_LENGTH))
 
-def populate_db():
-    User.objects.bulk_create(
-        gen_users()
-        , ignore_conflicts=True
-    )
-    users = User.objects.all()
-    DeployedApp.objects.bulk_create(
-        [DeployedApp(owner=choice(users), name=app_name) for app_name in app_names]
-        , ignore_conflicts=True
-    )
+    def add_app(self, owner_id: str):
+        app_id = self.new_id()
+        self.apps.append(f"{app_id}\t{owner_id}\t{self.rng.choice(app_names)}\tt\n")
+        sender = f"app.{app_id.lower()}.{len(self.senders)}@nicedomain.com"
+        self.senders.append(sender)
+        # one row per provider with the same sender, one of them active
+        active = self.rng.choice(self.provider_ids)
+        for provider_id in self.provider_ids:
+            flag = "t" if provider_id == active else "f"
+            self.email_providers.append(f"{app_id}\t{provider_id}\t{app_id}-{provider_id}\t{flag}\t{sender}\n")
+
+
+def copy_rows(model, columns: str, rows: list[str]):
+    with connection.cursor() as cursor:
+        with cursor.copy(f"COPY {model._meta.db_table} ({columns}) FROM STDIN") as copy:
+            copy.write("".join(rows))
+
+
+def smtp_provider_ids() -> list[int]:
+    for name in SMTPServiceProvider.providers:
+        SMTPProvider.objects.get_or_create(name=name, defaults={"verified_domain": "nicedomain.com"})
+    return sorted(SMTPProvider.objects.values_list("id", flat=True))
+
+
+def populate_db(
+    users: int = 25,
+    apps_per_user: float = 1.0,
+    pro_share: float = 0.2,
+    events: int = 0,
+    event_skew: float = 1.1,
+    seed: int | None = None,
+) -> Tenants:
+    """Load `users` users with about `apps_per_user` apps each, a provider row per app and provider, and `events`
+    email events whose volume per app follows a Zipf law of exponent `event_skew`
+    """
+    rng = random.Random(seed)
+    with transaction.atomic():
+        provider_ids = smtp_provider_ids()
+        tenants = Tenants(rng, users, apps_per_user, pro_share, provider_ids)
+        copy_rows(
+            User,
+            "id, password, is_superuser, username, email, is_staff, is_active, date_joined, plan, full_name",
+            tenants.users,
+        )
+        copy_rows(DeployedApp, "id, owner_id, name, active", tenants.apps)
+        copy_rows(EmailProvider, "app_id, provider_id, external_id, active, from_address", tenants.email_providers)
+
+        if events:
+            # the busiest senders are spread over the users, not the first ones created
+            ranks = list(range(len(tenants.senders)))
+            rng.shuffle(ranks)
+            weights = zipf_weights(len(ranks), event_skew)
+            dist = Distribution(
+                senders=tenants.senders,
+                sender_weights=[weights[rank] for rank in ranks],
+                provider_ids=provider_ids,
+                hard_bounce_rate=0.02,
+                soft_bounce_rate=0.03,
+                days=90,
+            )
+            copy_events(events // 2, dist, seed=rng.randrange(2**32), batch_size=50_000)
+    if events:
+        rebuild_usage_counters()
+        rollup_email_usage()
+    return tenants
 
 
 class Command(BaseCommand):
+    help = "Load users, apps, their providers and optionally email events, skewed like production, with COPY"
+
     def add_arguments(self, parser):
-        parser.add_argument("--rollback", "-r", action="store_true")
+        parser.add_argument("--rollback", "-r", action="store_true", help="Delete every user and app instead")
+        parser.add_argument("--users", "-u", type=int, default=25)
+        parser.add_argument("--apps-per-user", type=float, default=1.0, help="Mean, exponentially distributed")
+        parser.add_argument("--pro-share", type=float, default=0.2, help="Share of the users on the pro plan")
+        parser.add_argument("--events", "-e", type=int, default=0, help="Email events, two per email")
+        parser.add_argument("--event-skew", type=float, default=1.1, help="Zipf exponent of the apps' volume")
+        parser.add_argument("--seed", type=int, help="The same seed loads the same data")
 
     def handle(self, *args, **options):
         if options["rollback"]:
             DeployedApp.objects.all().delete()
             User.objects.all().delete()
-        else:
-            populate_db()
-            print("\nDone")
+            return
+
+        started = time.perf_counter()
+        try:
+            tenants = populate_db(
+                users=options["users"],
+                apps_per_user=options["apps_per_user"],
+                pro_share=options["pro_share"],
+                events=options["events"],
+                event_skew=options["event_skew"],
+                seed=options["seed"],
+            )
+        except IntegrityError as e:
+            raise CommandError(f"{e}\nThe rows of a previous run with this seed are still there? Use --rollback first")
+        print(
+            f"Loaded {len(tenants.users)} users, {len(tenants.apps)} apps, {len(tenants.email_providers)} providers"
+            f" and {options['events']} events in {time.perf_counter() - started:.1f}s"
+        )
@@ -1,6 +1,6 @@
 import string
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.db.models import Q # noqa
 from nanoid import generate
 from .fields import PlanEnum, PlanField
@@ -8,20 +8,73 @@ from .fields import PlanEnum, PlanField
 alpha_numeric = string.ascii_letters + string.digits
 RANDOM_ID_LENGTH = 12
 
+def generate_id() -> str:
+    return generate(alphabet=alpha_numeric, size=RANDOM_ID_LENGTH)
+
+
+# 62**12 ids, a collision is so unlikely that it is left to the primary key: no query per new id,
+# RandomIDMixin.save retries the rare insert that hits one and allocate_ids checks a bulk in one query
 def generate_user_id() -> str:
-    while True:
-        user_id = generate(alphabet=alpha_numeric, size=RANDOM_ID_LENGTH)
-        if not User.objects.filter(id=user_id).exists():
-            return user_id
+    return generate_id()
 
 
 def generate_app_id() -> str:
-    while True:
-        app_id = generate(alphabet=alpha_numeric, size=RANDOM_ID_LENGTH)
-        if not DeployedApp.objects.filter(id=app_id).exists():
-            return app_id
+    return generate_id()
+
+
+def allocate_ids(objs: list, chunk_size: int = 10_000) -> list:
+    """Make sure the unsaved `objs`, all of one model, have ids no row and no other obj has before a `bulk_create`.
+    One query per `chunk_size` objects, and one more round for the few ids that had to be replaced
+    """
+    if not objs:
+        return objs
+    model = type(objs[0])
+    used = set()
+    pending = objs
+    while pending:
+        clashing = []
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start : start + chunk_size]
+            taken = set(model.objects.filter(pk__in=[obj.pk for obj in chunk]).values_list("pk", flat=True))
+            for obj in chunk:
+                if obj.pk in taken or obj.pk in used:
+                    obj.pk = generate_id()
+                    clashing.append(obj)
+                else:
+                    used.add(obj.pk)
+        pending = clashing
+    return objs
+
+
+class RandomIDMixin:
+    """Retry the insert with a new id when the random one is taken"""
+
+    ID_ATTEMPTS = 3
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # loaded rows and ids given by the caller are never replaced
+        self._random_id = not args and "id" not in kwargs and "pk" not in kwargs
 
-class User(AbstractUser):
+    def save(self, *args, **kwargs):
+        if not (self._state.adding and self._random_id):
+            return super().save(*args, **kwargs)
+        for attempt in range(self.ID_ATTEMPTS):
+            try:
+                # a savepoint, a failed insert must not break the caller's transaction
+                with transaction.atomic(using=kwargs.get("using")):
+                    return super().save(*args, **kwargs)
+            except IntegrityError as e:
+                if attempt == self.ID_ATTEMPTS - 1 or not self._is_pk_violation(e):
+                    raise
+                self.pk = generate_id()
+
+    def _is_pk_violation(self, error: IntegrityError) -> bool:
+        diag = getattr(error.__cause__, "diag", None)
+        return getattr(diag, "constraint_name", None) == f"{self._meta.db_table}_pkey"
+
+
+class User(RandomIDMixin, AbstractUser):
     
     id = models.CharField(primary_key=True, default=generate_user_id, max_length=RANDOM_ID_LENGTH)
     plan = PlanField(default=PlanEnum.HOBBY.value)
@@ -40,7 +93,7 @@ class User(AbstractUser):
         return self.username
 
 
-class DeployedApp(models.Model):
+class DeployedApp(RandomIDMixin, models.Model):
 
     id = models.CharField(primary_key=True, default=generate_app_id, max_length=RANDOM_ID_LENGTH)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="apps")
@@ -49,3 +102,14 @@ class DeployedApp(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class PersistedQuery(models.Model):
+    """A GraphQL document clients send by its SHA-256 instead of its text, see `config.persisted_queries`"""
+
+    hash = models.CharField(primary_key=True, max_length=64)
+    query = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.hash
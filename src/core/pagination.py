@@ -0,0 +1,87 @@
+"""Keyset pagination of the relay connections on the primary key
+
+A cursor is the primary key of the row, encoded. A page is `pk > after ORDER BY pk LIMIT first + 1` (or
+`pk < before ORDER BY pk DESC LIMIT last + 1`): no OFFSET to skip, the index takes the query straight to the
+page, and the extra row only tells if there is another page. A request holds at most one page per connection.
+"""
+
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from graphene import relay
+from graphql import GraphQLError
+
+CURSOR_PREFIX = "pk:"
+
+
+def encode_cursor(pk: str) -> str:
+    return urlsafe_b64encode(f"{CURSOR_PREFIX}{pk}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        decoded = urlsafe_b64decode(cursor.encode()).decode()
+    except (binascii.Error, UnicodeError):
+        raise GraphQLError("Invalid cursor")
+    if not decoded.startswith(CURSOR_PREFIX):
+        raise GraphQLError("Invalid cursor")
+    return decoded.removeprefix(CURSOR_PREFIX)
+
+
+class PageRequest(NamedTuple):
+    """Where the page starts and how many rows it holds, `backwards` pages end before `cursor`"""
+
+    cursor: Optional[str]
+    size: int
+    backwards: bool
+
+
+def page_request(connection: str, first=None, after=None, last=None, before=None, **kwargs) -> PageRequest:
+    """Validate the relay arguments of `connection`, the page size is capped by `[pagination] max_page_size`"""
+    if first is not None and last is not None:
+        raise GraphQLError(f"Pass `first` or `last` to the `{connection}` connection, not both")
+    backwards = last is not None or (first is None and before is not None)
+    size = last if backwards else first
+    if size is None:
+        size = settings.PAGINATION.default_page_size
+    if size < 0:
+        raise GraphQLError(f"`{'last' if backwards else 'first'}` on the `{connection}` connection must be positive")
+    if size > settings.PAGINATION.max_page_size:
+        raise GraphQLError(
+            f"Requesting {size} records on the `{connection}` connection exceeds the "
+            f"`{'last' if backwards else 'first'}` limit of {settings.PAGINATION.max_page_size} records."
+        )
+    cursor = before if backwards else after
+    return PageRequest(decode_cursor(cursor) if cursor else None, size, backwards)
+
+
+def keyset_page(queryset, page: PageRequest):
+    """The queryset of at most `page.size + 1` rows, in the direction of the page"""
+    if page.backwards:
+        if page.cursor is not None:
+            queryset = queryset.filter(pk__lt=page.cursor)
+        return queryset.order_by("-pk")[: page.size + 1]
+    if page.cursor is not None:
+        queryset = queryset.filter(pk__gt=page.cursor)
+    return queryset.order_by("pk")[: page.size + 1]
+
+
+def to_connection(connection_type, rows: list, page: PageRequest):
+    """Build the connection from the rows of `keyset_page`, the extra row only says there is more"""
+    has_more = len(rows) > page.size
+    rows = rows[: page.size]
+    if page.backwards:
+        rows.reverse()
+    edges = [connection_type.Edge(node=row, cursor=encode_cursor(row.pk)) for row in rows]
+    return connection_type(
+        edges=edges,
+        page_info=relay.PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            # the other direction is not queried, a cursor means rows were left behind it
+            has_previous_page=has_more if page.backwards else page.cursor is not None,
+            has_next_page=page.cursor is not None if page.backwards else has_more,
+        ),
+    )
@@ -5,12 +5,15 @@ from graphene import relay
 from graphene_django import DjangoObjectType
 
 from mailer.schemas import AppEmails, UserEmails
+from mailer.active_provider import active_providers
 from mailer.models import EmailProvider
 
 from . import models
+from .cache import user_cache
 from .custom_node import CustomNode
-from .dataloaders import AppLoader, EXCLUDE_USER_FIELDS, UserLoader
+from .dataloaders import EXCLUDE_USER_FIELDS
 from .fields import PlanEnum
+from .pagination import keyset_page, page_request, to_connection
 
 logger = getLogger(__name__)
 
@@ -27,7 +30,7 @@ class App(DjangoObjectType):
         return CustomNode.to_global_id("DeployedApp", self.pk)
 
     async def resolve_owner(self, info):
-        return await UserLoader().load(self.owner_id)
+        return await info.context.loaders.user.load(self.owner_id)
 
     async def resolve_emails(self, info):
         return self
@@ -55,23 +58,36 @@ class User(DjangoObjectType):
         interfaces = (CustomNode,)
         convert_choices_to_enum = True
 
-    async def resolve_apps(root, info):
-        return await AppLoader().load_many([app async for app in root.apps.values_list("id", flat=True)])
+    async def resolve_apps(root, info, **kwargs):
+        page = page_request("apps", **kwargs)
+        loaders = info.context.loaders
+        apps = await loaders.user_apps_page.load((root.pk, page))
+        for app in apps:
+            loaders.app.prime(app.pk, app)
+        return to_connection(AppConnection, apps, page)
 
     async def resolve_emails(self, info):
         return self
 
 
+class UserConnection(relay.Connection):
+    class Meta:
+        node = User
+
+
 class Query(graphene.ObjectType):
     node = CustomNode.Field()
     user = CustomNode.Field(User)
     app = CustomNode.Field(App)
 
-    ## for ease of debugging we could use a list of available users
-    users = graphene.List(User)
+    users = relay.ConnectionField(UserConnection)
 
-    async def resolve_users(root, info):
-        return [user async for user in models.User.objects.all()]
+    async def resolve_users(root, info, **kwargs):
+        page = page_request("users", **kwargs)
+        users = [user async for user in keyset_page(models.User.objects.defer(*EXCLUDE_USER_FIELDS), page)]
+        for user in users:
+            info.context.loaders.user.prime(user.pk, user)
+        return to_connection(UserConnection, users, page)
 
 
 class UserPlanInput(graphene.InputObjectType):
@@ -86,9 +102,10 @@ class UpdateUserPlan(graphene.Mutation):
     count = graphene.Int()
 
     async def mutate(root, info, plan_input):
-        changed_count = await models.User.objects.filter(id=CustomNode.from_global_id(plan_input.id)[1]).aupdate(
-            plan=plan_input.plan.value
-        )
+        uid = CustomNode.from_global_id(plan_input.id)[1]
+        changed_count = await models.User.objects.filter(id=uid).aupdate(plan=plan_input.plan.value)
+        # update() sends no signals
+        await user_cache.ainvalidate(uid)
         return UpdateUserPlan(count=changed_count)
 
 
@@ -101,9 +118,12 @@ class upgradeAccount(graphene.Mutation):
     async def mutate(root, info, id):
         uid = CustomNode.from_global_id(id)[1]
         count = await models.User.objects.filter(id=uid).aupdate(plan=PlanEnum.PRO.value)
+        await user_cache.ainvalidate(uid)
         if count > 0:
             # TODO: try to do this without importing mailer models
             await EmailProvider.objects.filter(app__owner_id=uid).aupdate(maxed_quota_for=None)
+            app_ids = models.DeployedApp.objects.filter(owner_id=uid).values_list("pk", flat=True)
+            active_providers.invalidate(*[app_id async for app_id in app_ids])
         return upgradeAccount(ok=count > 0)
 
 
@@ -114,7 +134,9 @@ class downgradeAccount(graphene.Mutation):
     ok = graphene.Boolean()
 
     async def mutate(root, info, id):
-        count = await models.User.objects.filter(id=CustomNode.from_global_id(id)[1]).aupdate(plan=PlanEnum.HOBBY.value)
+        uid = CustomNode.from_global_id(id)[1]
+        count = await models.User.objects.filter(id=uid).aupdate(plan=PlanEnum.HOBBY.value)
+        await user_cache.ainvalidate(uid)
         return downgradeAccount(ok=count > 0)
 
 
@@ -0,0 +1,17 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import models
+from .cache import app_cache, user_cache
+
+
+@receiver([post_save, post_delete], sender=models.User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # after the commit, or a concurrent request could cache the old row again
+    transaction.on_commit(lambda: user_cache.invalidate(instance.pk))
+
+
+@receiver([post_save, post_delete], sender=models.DeployedApp)
+def invalidate_cached_app(sender, instance, **kwargs):
+    transaction.on_commit(lambda: app_cache.invalidate(instance.pk))
@@ -1,3 +1,506 @@
-from django.test import TestCase
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone as dj_tz
+import msgspec
+
+from config import persisted_queries
+from config.database import pool_stats
+from config.db_router import REPLICA_DB_ALIAS, ReplicaRouter, read_from_replica
+from mailer.active_provider import active_providers
+from mailer.models import EmailEvent, EmailEventChoices, EmailProvider, SMTPProvider
+
+from .cache import MemoryBackend, app_cache, user_cache
+from .custom_node import CustomNode
+from .dataloaders import AppLoader, UserLoader, load_apps, load_users
+from .management.commands.populate_db import populate_db
+from .models import DeployedApp, PersistedQuery, User, allocate_ids
+from .pagination import encode_cursor
+
+NESTED_QUERY = """
+{
+  users {
+    edges {
+      node {
+        id
+        apps {
+          edges {
+            node {
+              id
+              owner { id username }
+              emails {
+                totalEmailsCount
+                usage(groupBy: MONTH) { timestamp emails { total } }
+              }
+            }
+          }
+        }
+        emails { sentEmailsCount }
+      }
+    }
+  }
+}
+"""
+
+
+class RequestScopedLoadersTests(TestCase):
+    """Every resolver goes through the loaders of the request, the query count does not grow with the data"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.provider = SMTPProvider.objects.create(name="smtp2go", verified_domain="nicedomain.com")
+
+    def setUp(self):
+        user_cache.clear()
+        app_cache.clear()
+        active_providers.clear()
+
+    def add_users(self, count: int, apps_per_user: int = 3):
+        for _ in range(count):
+            user = User.objects.create(username=f"user {User.objects.count()}", full_name="Someone")
+            for i in range(apps_per_user):
+                app = DeployedApp.objects.create(owner=user, name=f"app {i}")
+                sender = f"app.{app.pk}@nicedomain.com"
+                EmailProvider.objects.create(app=app, provider=self.provider, active=True, from_address=sender)
+                EmailEvent.objects.create(
+                    provider=self.provider,
+                    event=EmailEventChoices.SENT,
+                    event_time=dj_tz.now(),
+                    send_time=dj_tz.now(),
+                    message_id=f"message {app.pk}",
+                    from_address=sender,
+                    recipients=["someone@example.com"],
+                )
+
+    def run_query(self) -> tuple[dict, int]:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/graphql/", {"query": NESTED_QUERY}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertNotIn("errors", result)
+        return result["data"], len(queries)
+
+    def test_query_count_does_not_grow(self):
+        self.add_users(2)
+        data, few = self.run_query()
+        users = [edge["node"] for edge in data["users"]["edges"]]
+        self.assertEqual([user["emails"]["sentEmailsCount"] for user in users], [3, 3])
+
+        self.add_users(5)
+        data, many = self.run_query()
+        self.assertEqual(len(data["users"]["edges"]), 7)
+        self.assertEqual(few, many)
+
+    def test_owner_is_loaded_once_per_request(self):
+        self.add_users(1, apps_per_user=4)
+        data, _ = self.run_query()
+        (edge,) = data["users"]["edges"]
+        user = edge["node"]
+        owners = {edge["node"]["owner"]["id"] for edge in user["apps"]["edges"]}
+        self.assertEqual(owners, {user["id"]})
+
+
+class MemoryBackendTests(TestCase):
+    def get(self, backend, *keys):
+        return async_to_sync(backend.get_many)(keys)
+
+    def test_evicts_least_recently_used(self):
+        backend = MemoryBackend(ttl=60, max_entries=2)
+        async_to_sync(backend.set_many)({"a": 1, "b": 2})
+        self.get(backend, "a")
+        async_to_sync(backend.set_many)({"c": 3})
+        self.assertEqual(self.get(backend, "a", "b", "c"), {"a": 1, "c": 3})
+
+    def test_expires(self):
+        backend = MemoryBackend(ttl=0, max_entries=2)
+        async_to_sync(backend.set_many)({"a": 1})
+        self.assertEqual(self.get(backend, "a"), {})
+        self.assertEqual(len(backend), 0)
+
+
+class LoaderCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="cached", full_name="Cached")
+        cls.app = DeployedApp.objects.create(owner=cls.user, name="cached app")
+
+    def setUp(self):
+        user_cache.clear()
+        app_cache.clear()
+
+    def load(self, loader_class, key):
+        async def load():
+            return await loader_class().load(key)
+
+        return async_to_sync(load)()
+
+    def test_second_request_is_served_from_the_cache(self):
+        hits = user_cache.hits
+        with self.assertNumQueries(1):
+            self.load(UserLoader, self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.load(UserLoader, self.user.pk).username, "cached")
+        self.assertEqual(user_cache.hits, hits + 1)
+
+    def test_missing_keys_are_not_cached(self):
+        self.assertIsNone(self.load(AppLoader, "missing"))
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.load(AppLoader, "missing"))
+
+    def test_save_invalidates(self):
+        self.load(AppLoader, self.app.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.app.name = "renamed"
+            self.app.save()
+        self.assertEqual(self.load(AppLoader, self.app.pk).name, "renamed")
+
+    def test_mutation_invalidates(self):
+        self.assertEqual(self.load(UserLoader, self.user.pk).plan, "hobby")
+        response = self.client.post(
+            "/graphql/",
+            {"query": f'mutation {{ upgradeAccount(id: "{CustomNode.to_global_id("User", self.user.pk)}") {{ ok }} }}'},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["data"], {"upgradeAccount": {"ok": True}})
+        self.assertEqual(self.load(UserLoader, self.user.pk).plan, "pro")
+
+
+USERS_PAGE = """
+query($first: Int, $after: String, $last: Int, $before: String, $apps: Int) {
+  users(first: $first, after: $after, last: $last, before: $before) {
+    edges { node { id apps(first: $apps) { edges { node { id } } pageInfo { hasNextPage endCursor } } } }
+    pageInfo { hasNextPage hasPreviousPage startCursor endCursor }
+  }
+}
+"""
+
+
+class PaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(5):
+            user = User.objects.create(username=f"user {i}", full_name="Someone")
+            for j in range(i):
+                DeployedApp.objects.create(owner=user, name=f"app {j}")
+        cls.user_ids = sorted(User.objects.values_list("pk", flat=True))
+
+    def setUp(self):
+        user_cache.clear()
+        app_cache.clear()
+
+    def query(self, **variables) -> dict:
+        response = self.client.post(
+            "/graphql/", {"query": USERS_PAGE, "variables": variables}, content_type="application/json"
+        )
+        return response.json()
+
+    def user_ids_of(self, result: dict) -> list[str]:
+        return [CustomNode.from_global_id(edge["node"]["id"])[1] for edge in result["data"]["users"]["edges"]]
+
+    def test_pages_forward_without_offset(self):
+        seen, after = [], None
+        with CaptureQueriesContext(connection) as queries:
+            while True:
+                result = self.query(first=2, after=after)
+                seen += self.user_ids_of(result)
+                page_info = result["data"]["users"]["pageInfo"]
+                if not page_info["hasNextPage"]:
+                    break
+                after = page_info["endCursor"]
+        self.assertEqual(seen, self.user_ids)
+        self.assertFalse(any("OFFSET" in query["sql"] for query in queries.captured_queries))
+
+    def test_pages_backward(self):
+        result = self.query(last=2, before=encode_cursor(self.user_ids[3]))
+        self.assertEqual(self.user_ids_of(result), self.user_ids[1:3])
+        page_info = result["data"]["users"]["pageInfo"]
+        self.assertTrue(page_info["hasPreviousPage"])
+        self.assertTrue(page_info["hasNextPage"])
+
+    def test_page_size_is_capped(self):
+        result = self.query(first=settings.PAGINATION.max_page_size + 1)
+        self.assertIsNone(result["data"]["users"])
+        self.assertIn("exceeds the `first` limit", result["errors"][0]["message"])
+        self.assertEqual(len(self.user_ids_of(self.query())), 5)  # default_page_size
+
+    def test_invalid_cursor(self):
+        result = self.query(after="not a cursor")
+        self.assertEqual(result["errors"][0]["message"], "Invalid cursor")
+
+    def test_apps_of_the_page_in_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = self.query(apps=2)
+        self.assertEqual(len(queries), 2)  # users, then the apps of all of them
+        for edge in result["data"]["users"]["edges"]:
+            user_id = CustomNode.from_global_id(edge["node"]["id"])[1]
+            expected = sorted(DeployedApp.objects.filter(owner_id=user_id).values_list("pk", flat=True))
+            apps = edge["node"]["apps"]
+            self.assertEqual([CustomNode.from_global_id(e["node"]["id"])[1] for e in apps["edges"]], expected[:2])
+            self.assertEqual(apps["pageInfo"]["hasNextPage"], len(expected) > 2)
+
+
+class QueryCostTests(TestCase):
+    def post(self, query: str, **variables) -> dict:
+        response = self.client.post(
+            "/graphql/", {"query": query, "variables": variables}, content_type="application/json"
+        )
+        return response.json()
+
+    def test_cost_in_the_extensions(self):
+        result = self.post(NESTED_QUERY)
+        self.assertNotIn("errors", result)
+        # users: 1 + 20 * (apps: 1 + 20 * (owner, emails, totalEmailsCount, usage, usage.emails) + emails + sent)
+        self.assertEqual(result["extensions"]["cost"], {"requested": 7341, "maximum": 10_000, "depth": 10})
+
+    def test_fan_out_is_refused_before_execution(self):
+        query = """
+        { users { edges { node { apps { edges { node { owner { apps { edges { node {
+          emails { usage(groupBy: DAY) { timestamp } }
+        } } } } } } } } } } }
+        """
+        with CaptureQueriesContext(connection) as queries:
+            result = self.post(query)
+        self.assertEqual(len(queries), 0)
+        self.assertIsNone(result["data"])
+        # the walk stops at the first limit it passes, the nesting here
+        codes = [error["extensions"]["code"] for error in result["errors"]]
+        self.assertEqual(codes, ["QUERY_TOO_DEEP"])
+
+    def test_doubling_fragments_stop_early(self):
+        # each fragment spreads the next one twice: 2**21 copies of `users` once expanded
+        fragments = [f"fragment F{i} on Query {{ ...F{i + 1} ...F{i + 1} }}" for i in range(21)]
+        fragments.append("fragment F21 on Query { users { edges { node { id } } } }")
+        query = "{ ...F0 }\n" + "\n".join(fragments)
+        started = time.perf_counter()
+        result = self.post(query)
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual(result["errors"][0]["extensions"]["code"], "QUERY_TOO_EXPENSIVE")
+
+    def test_page_size_variables(self):
+        query = """
+        query($first: Int) { users(first: $first) { edges { node { emails { usage(groupBy: DAY) { timestamp } } } } } }
+        """
+        self.assertEqual(self.post(query, first=10)["extensions"]["cost"]["requested"], 1 + 10 * (1 + 10))
+        with override_settings(QUERY_COST=msgspec.structs.replace(settings.QUERY_COST, max_cost=100)):
+            result = self.post(query, first=50)
+        self.assertEqual(result["errors"][0]["extensions"]["code"], "QUERY_TOO_EXPENSIVE")
+        # measured until the walk passed the limit
+        self.assertGreater(result["errors"][0]["extensions"]["cost"]["requested"], 100)
+
+
+class PersistedQueryTests(TestCase):
+    QUERY = "{ users { edges { node { id } } } }"
+
+    def setUp(self):
+        persisted_queries.documents.clear()
+        self.hash = persisted_queries.query_hash(self.QUERY)
+
+    def post(self, query=None, persisted: bool = True) -> dict:
+        data = {}
+        if query is not None:
+            data["query"] = query
+        if persisted:
+            data["extensions"] = {"persistedQuery": {"version": 1, "sha256Hash": self.hash}}
+        return self.client.post("/graphql/", data, content_type="application/json").json()
+
+    def mode(self, mode: str):
+        return override_settings(PERSISTED_QUERIES=msgspec.structs.replace(settings.PERSISTED_QUERIES, mode=mode))
+
+    def test_automatic_registration(self):
+        result = self.post()
+        self.assertEqual(result["errors"][0]["message"], "PersistedQueryNotFound")
+
+        self.assertEqual(self.post(self.QUERY)["data"], {"users": {"edges": []}})
+        self.assertEqual(PersistedQuery.objects.get(hash=self.hash).query, self.QUERY)
+
+        persisted_queries.documents.clear()  # as in another process
+        self.assertEqual(self.post()["data"], {"users": {"edges": []}})
+
+    def test_hash_must_match(self):
+        result = self.post("{ users { edges { cursor } } }")
+        self.assertEqual(result["errors"][0]["extensions"]["code"], "BAD_USER_INPUT")
+        self.assertFalse(PersistedQuery.objects.exists())
+
+    def test_plain_queries_are_not_stored(self):
+        self.assertNotIn("errors", self.post(self.QUERY, persisted=False))
+        self.assertFalse(PersistedQuery.objects.exists())
+
+    def test_documents_are_parsed_once(self):
+        with mock.patch.object(persisted_queries, "parse", wraps=persisted_queries.parse) as parse:
+            for _ in range(3):
+                self.assertNotIn("errors", self.post(self.QUERY, persisted=False))
+        self.assertEqual(parse.call_count, 1)
+
+    def test_invalid_documents_are_not_cached(self):
+        result = self.post("{ users { nope } }", persisted=False)
+        self.assertEqual(len(result["errors"]), 1)
+        self.assertEqual(len(persisted_queries.documents), 0)
+
+    def test_documents_over_the_cost_limit_are_not_cached_or_stored(self):
+        with override_settings(QUERY_COST=msgspec.structs.replace(settings.QUERY_COST, max_cost=0)):
+            result = self.post(self.QUERY)
+        self.assertEqual(result["errors"][0]["extensions"]["code"], "QUERY_TOO_EXPENSIVE")
+        self.assertEqual(len(persisted_queries.documents), 0)
+        self.assertFalse(PersistedQuery.objects.exists())
+
+    def test_long_documents_are_not_cached(self):
+        limits = msgspec.structs.replace(settings.PERSISTED_QUERIES, max_cached_length=len(self.QUERY) - 1)
+        with override_settings(PERSISTED_QUERIES=limits):
+            self.assertNotIn("errors", self.post(self.QUERY, persisted=False))
+        self.assertEqual(len(persisted_queries.documents), 0)
+
+    def test_allowlist(self):
+        with self.mode("allowlist"):
+            result = self.post(self.QUERY, persisted=False)
+            self.assertEqual(result["errors"][0]["message"], "PersistedQueryNotAllowed")
+            self.assertFalse(PersistedQuery.objects.exists())
+
+            with tempfile.NamedTemporaryFile("w", suffix=".graphql") as document:
+                document.write(self.QUERY)
+                document.flush()
+                call_command("persist_queries", document.name, stdout=mock.Mock())
+            self.assertNotIn("errors", self.post())
+            self.assertNotIn("errors", self.post(self.QUERY, persisted=False))
+
+            # removed from the allowlist, maybe by another process: the cached document stops running
+            PersistedQuery.objects.filter(hash=self.hash).delete()
+            self.assertEqual(self.post()["errors"][0]["message"], "PersistedQueryNotAllowed")
+            self.assertEqual(len(persisted_queries.documents), 0)
+
+    def test_off(self):
+        with self.mode("off"):
+            self.assertEqual(self.post(self.QUERY)["errors"][0]["message"], "PersistedQueryNotSupported")
+            self.assertNotIn("errors", self.post(self.QUERY, persisted=False))
+
+
+class RandomIDTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username="owner", full_name="Owner")
+
+    def test_taken_id_is_replaced_on_insert(self):
+        taken = DeployedApp.objects.create(owner=self.owner, name="first").pk
+        # the default draws the taken id, the retry a fresh one
+        with mock.patch("core.models.generate_id", side_effect=[taken, "fresh1234567"]) as generate_id:
+            app = DeployedApp(owner=self.owner, name="second")
+            self.assertEqual(app.pk, taken)
+            app.save()
+        self.assertEqual(generate_id.call_count, 2)
+        self.assertEqual(app.pk, "fresh1234567")
+        self.assertEqual(DeployedApp.objects.count(), 2)
+
+    def test_given_id_and_other_violations_are_not_retried(self):
+        taken = DeployedApp.objects.create(owner=self.owner, name="first").pk
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            DeployedApp.objects.create(id=taken, owner=self.owner, name="second")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            User.objects.create(username="owner", full_name="Same username")
+
+    def test_allocate_ids(self):
+        taken = DeployedApp.objects.create(owner=self.owner, name="first").pk
+        apps = [DeployedApp(owner=self.owner, name=str(i)) for i in range(4)]
+        apps[0].pk = taken
+        apps[2].pk = apps[1].pk
+        DeployedApp.objects.bulk_create(allocate_ids(apps, chunk_size=3))
+        self.assertEqual(len({app.pk for app in apps}), 4)
+        self.assertEqual(DeployedApp.objects.count(), 5)
+
+
+class PopulateDBTests(TestCase):
+    def test_tenants_link_to_events(self):
+        populate_db(users=5, apps_per_user=2, events=40, seed=3)
+        self.assertEqual(User.objects.count(), 5)
+        apps = DeployedApp.objects.count()
+        self.assertGreaterEqual(apps, 5)
+        self.assertEqual(EmailProvider.objects.filter(active=True).count(), apps)
+        senders = set(EmailProvider.objects.values_list("from_address", flat=True))
+        self.assertEqual(EmailEvent.objects.count(), 40)
+        self.assertLessEqual(set(EmailEvent.objects.values_list("from_address", flat=True)), senders)
+
+    def test_seed_is_deterministic(self):
+        first = populate_db(users=3, apps_per_user=2, seed=7)
+        DeployedApp.objects.all().delete()
+        User.objects.all().delete()
+        second = populate_db(users=3, apps_per_user=2, seed=7)
+        self.assertEqual((first.apps, first.senders), (second.apps, second.senders))
+
+
+class DatabasePoolTests(TestCase):
+    def test_pool_stats(self):
+        User.objects.count()
+        stats = pool_stats()["default"]
+        self.assertEqual(stats["pool_max"], settings.DATABASES["default"]["OPTIONS"]["pool"]["max_size"])
+        self.assertGreaterEqual(stats["pool_size"] - stats["pool_available"], 1)  # this test's connection
+
+
+class RecordingRouter(ReplicaRouter):
+    """Routes as if a replica was configured, records it and sends every query to the test database"""
+
+    def __init__(self):
+        self.replica = REPLICA_DB_ALIAS
+        self.reads = []
+
+    @staticmethod
+    def is_test_mirror(alias: str) -> bool:
+        return False
+
+    def db_for_read(self, model, **hints):
+        self.reads.append(super().db_for_read(model, **hints))
+        return DEFAULT_DB_ALIAS
+
+
+class ReplicaRouterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="someone", full_name="Someone")
+        cls.app = DeployedApp.objects.create(owner=cls.user, name="app")
+
+    def setUp(self):
+        user_cache.clear()
+        app_cache.clear()
+        self.router = RecordingRouter()
+        routers = override_settings(DATABASE_ROUTERS=[self.router])
+        routers.enable()
+        self.addCleanup(routers.disable)
+
+    def test_reads_use_the_primary_by_default(self):
+        User.objects.count()
+        self.assertEqual(self.router.reads, [DEFAULT_DB_ALIAS])
+
+    def test_pinned_after_a_write(self):
+        with read_from_replica():
+            User.objects.count()
+            User.objects.filter(pk=self.user.pk).update(full_name="Someone else")
+            self.assertEqual(User.objects.get(pk=self.user.pk).full_name, "Someone else")
+        self.assertEqual(self.router.reads, [REPLICA_DB_ALIAS, DEFAULT_DB_ALIAS])
+
+    def test_cached_rows_are_read_from_the_primary(self):
+        with read_from_replica():
+            users = async_to_sync(load_users)([self.user.pk])
+            apps = async_to_sync(load_apps)([self.app.pk])
+        # the loaders ask for the primary, the router is not consulted
+        self.assertEqual(self.router.reads, [])
+        self.assertEqual(users[self.user.pk]._state.db, DEFAULT_DB_ALIAS)
+        self.assertEqual(apps[self.app.pk]._state.db, DEFAULT_DB_ALIAS)
+
+    def test_graphql_queries_read_from_the_replica(self):
+        response = self.client.post("/graphql/", {"query": NESTED_QUERY}, content_type="application/json")
+        self.assertNotIn("errors", response.json())
+        self.assertTrue(self.router.reads)
+        self.assertEqual(set(self.router.reads), {REPLICA_DB_ALIAS})
+
+    def test_graphql_mutations_read_from_the_primary(self):
+        mutation = "mutation($id: ID) { upgradeAccount(id: $id) { ok } }"
+        user_id = CustomNode.to_global_id("User", self.user.pk)
+        response = self.client.post(
+            "/graphql/", {"query": mutation, "variables": {"id": user_id}}, content_type="application/json"
+        )
+        self.assertEqual(response.json()["data"], {"upgradeAccount": {"ok": True}})
+        self.assertTrue(self.router.reads)
+        self.assertEqual(set(self.router.reads), {DEFAULT_DB_ALIAS})
@@ -10,6 +10,7 @@ def register_db_enum(db_connection, db_enum_name: str, enum_class):
 
         if info := EnumInfo.fetch(conn, db_enum_name):
             logger.info(f"Registering {enum_class.__name__}({info})")
-            register_enum(info, conn, enum_class, mapping=[(plan.name, plan.value) for plan in enum_class])
+            # globally, not on this connection only: the other connections of the pool need it too
+            register_enum(info, None, enum_class, mapping=[(plan.name, plan.value) for plan in enum_class])
         else:
             logger.warning(f"Enum '{db_enum_name}' not found in the database. You need to run the migration.")
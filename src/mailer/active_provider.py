@@ -0,0 +1,171 @@
+"""In-process map of every app's active EmailProvider
+
+Sending, the quota check and the usage stats all need the app's active sender. The map keeps it per app
+(or that the app has none), the hot path is a dict lookup.
+
+Invalidation is versioned: every invalidation bumps the app's version and a load only stores its result if the
+version did not move while it was querying, a switch racing with a load never leaves the old provider cached.
+The versions are only kept while a load is in flight, the map holds at most `max_entries` apps (LRU).
+
+Invalidations only reach this process, the TTL bounds how long the other processes serve the old value. That is
+fine for the stats, not for sending, so the send path reads the app with `get_current`:
+- with the `redis` loader cache every invalidation also replaces the app's token in it, `get_current` serves the
+  entry while it was loaded under the current token, one cache read, and reloads it once another process changed it.
+- without a shared cache, `get_current` serves the entry for `send_ttl` seconds after it was loaded.
+"""
+
+from collections import OrderedDict
+from datetime import date
+import threading
+import time
+from typing import Iterable, Optional
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+import msgspec
+
+from core.cache import CACHE_ALIAS
+
+
+class ActiveProvider(msgspec.Struct, frozen=True):
+    provider_id: int
+    provider_name: str
+    from_address: str
+    external_id: str
+    maxed_quota_for: Optional[date]
+
+
+class ActiveProviderCache:
+    def __init__(self, ttl: float, max_entries: int, send_ttl: float, shared_alias: Optional[str] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.send_ttl = send_ttl
+        self.shared_alias = shared_alias
+        # app id: (expires at, trusted by the send path until, token it was loaded under, active provider)
+        self._entries: OrderedDict[str, tuple[float, float, Optional[str], Optional[ActiveProvider]]] = OrderedDict()
+        self._versions: dict[str, int] = {}
+        self._loading = 0
+        # invalidations also come from the threads of sync_to_async
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias] if self.shared_alias else None
+
+    @staticmethod
+    def _token_key(app_id: str) -> str:
+        return f"active_provider:{app_id}"
+
+    async def get(self, app_id: str) -> Optional[ActiveProvider]:
+        return (await self.get_many([app_id]))[app_id]
+
+    async def get_many(self, app_ids: Iterable[str]) -> dict[str, Optional[ActiveProvider]]:
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for app_id in app_ids:
+                entry = self._entries.get(app_id)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(app_id)
+                    found[app_id] = entry[3]
+                else:
+                    missing.append(app_id)
+        if missing:
+            found.update(await self._refresh(missing))
+        return found
+
+    async def get_current(self, app_id: str) -> Optional[ActiveProvider]:
+        """The app's active provider for the send path, reloaded once another process changed it"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(app_id)
+        if entry is not None and entry[0] > now:
+            if self.shared_alias:
+                current = entry[2] is not None and await self.shared.aget(self._token_key(app_id)) == entry[2]
+            else:
+                current = entry[1] > now
+            if current:
+                with self._lock:
+                    if app_id in self._entries:
+                        self._entries.move_to_end(app_id)
+                return entry[3]
+        return (await self._refresh([app_id]))[app_id]
+
+    async def _tokens(self, app_ids: list[str]) -> dict[str, str]:
+        """The shared token of each app, the apps without one get one"""
+        if not self.shared_alias:
+            return {}
+        keys = {self._token_key(app_id): app_id for app_id in app_ids}
+        tokens = await self.shared.aget_many(keys)
+        if len(tokens) < len(keys):
+            for key in keys.keys() - tokens.keys():
+                await self.shared.aadd(key, uuid.uuid4().hex, timeout=None)
+            tokens = await self.shared.aget_many(keys)
+        return {keys[key]: token for key, token in tokens.items()}
+
+    async def _refresh(self, app_ids: list[str]) -> dict[str, Optional[ActiveProvider]]:
+        with self._lock:
+            versions = {app_id: self._versions.get(app_id, 0) for app_id in app_ids}
+            self._loading += 1
+        try:
+            # read before the load, a change committed after it replaces the token
+            tokens = await self._tokens(app_ids)
+            loaded = await self._load(app_ids)
+        finally:
+            with self._lock:
+                self._loading -= 1
+        found = {app_id: loaded.get(app_id) for app_id in app_ids}
+        now = time.monotonic()
+        with self._lock:
+            for app_id, active in found.items():
+                if self._versions.get(app_id, 0) == versions[app_id]:
+                    self._entries[app_id] = (now + self.ttl, now + self.send_ttl, tokens.get(app_id), active)
+                    self._entries.move_to_end(app_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if not self._loading:
+                # no load left to compare with
+                self._versions.clear()
+        return found
+
+    async def _load(self, app_ids: list[str]) -> dict[str, ActiveProvider]:
+        from .models import EmailProvider
+
+        # from the primary even inside a GraphQL query, a lagging replica would refill an invalidated app
+        return {
+            app_id: ActiveProvider(provider_id, provider_name, from_address, external_id, maxed_quota_for)
+            async for app_id, provider_id, provider_name, from_address, external_id, maxed_quota_for in (
+                EmailProvider.objects.using(DEFAULT_DB_ALIAS)
+                .filter(app_id__in=app_ids, active=True)
+                .values_list(
+                    "app_id", "provider_id", "provider__name", "from_address", "external_id", "maxed_quota_for"
+                )
+            )
+        }
+
+    def invalidate(self, *app_ids: str):
+        self._forget(app_ids)
+        if self.shared_alias and app_ids:
+            # the entries of the other processes no longer match
+            self.shared.set_many({self._token_key(app_id): uuid.uuid4().hex for app_id in app_ids}, timeout=None)
+
+    def _forget(self, app_ids: Iterable[str]):
+        with self._lock:
+            for app_id in app_ids:
+                self._entries.pop(app_id, None)
+                if self._loading:
+                    self._versions[app_id] = self._versions.get(app_id, 0) + 1
+
+    def clear(self):
+        """Forget the entries of this process only"""
+        self._forget(list(self._entries))
+
+
+active_providers = ActiveProviderCache(
+    ttl=settings.ACTIVE_PROVIDERS.ttl,
+    max_entries=settings.ACTIVE_PROVIDERS.max_entries,
+    send_ttl=settings.ACTIVE_PROVIDERS.send_ttl,
+    shared_alias=CACHE_ALIAS if settings.LOADER_CACHE.backend == "redis" else None,
+)
@@ -1,3 +1,16 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import SMTPProvider
+from .provider_registry import provider_registry
+
+
+@admin.register(SMTPProvider)
+class SMTPProviderAdmin(admin.ModelAdmin):
+    list_display = ("name", "verified_domain")
+    actions = ["reload_registry"]
+
+    @admin.action(description="Reload the provider registry")
+    def reload_registry(self, request, queryset):
+        # the other processes reload when they get a name they do not know
+        provider_registry.reset()
+        self.message_user(request, "The provider registry will be reloaded on the next lookup")
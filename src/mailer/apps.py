@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class MailerConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "mailer"
+
+    def ready(self):
+        from . import ingestion, provider_registry, signals, smtp_pool  # noqa: F401
+        from .smtp_providers import http
+
+        ingestion.register_lifespan_hooks()
+        http.register_lifespan_hooks()
+        provider_registry.register_lifespan_hooks()
+        smtp_pool.register_lifespan_hooks()
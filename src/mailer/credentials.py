@@ -0,0 +1,67 @@
+"""Cache of the apps' SMTP credentials
+
+SMTP usernames and passwords almost never change, so `get_smtp_user_config` keeps what the provider's API
+returned for `ttl` seconds, keyed by (provider, external_id). Concurrent misses for the same key share one API
+call, a burst of sends from one app costs at most one call per TTL.
+Entries are dropped when the app switches provider and when the SMTP server rejects them.
+"""
+
+import asyncio
+from logging import getLogger
+import time
+from typing import Awaitable, Callable
+
+from django.conf import settings
+
+logger = getLogger(__name__)
+
+Key = tuple[str, str]
+
+
+class CredentialCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: dict[Key, tuple[float, dict[str, str]]] = {}
+        self._inflight: dict[Key, tuple[asyncio.AbstractEventLoop, asyncio.Task]] = {}
+
+    async def get(
+        self, provider: str, external_id: str, fetch: Callable[[], Awaitable[dict[str, str]]]
+    ) -> dict[str, str]:
+        key = (provider, external_id)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        loop = asyncio.get_running_loop()
+        inflight_loop, task = self._inflight.get(key, (None, None))
+        if task is None or inflight_loop is not loop:
+            task = loop.create_task(self._fetch(key, fetch))
+            self._inflight[key] = (loop, task)
+        # one waiter being cancelled must not cancel the call the others wait for
+        return await asyncio.shield(task)
+
+    def _is_current(self, key: Key) -> bool:
+        return self._inflight.get(key, (None, None))[1] is asyncio.current_task()
+
+    async def _fetch(self, key: Key, fetch: Callable[[], Awaitable[dict[str, str]]]) -> dict[str, str]:
+        try:
+            credentials = await fetch()
+            # failures are not cached, the next send asks again
+            # and neither are the answers to a call started before an invalidation
+            if self._is_current(key):
+                self._entries[key] = (time.monotonic() + self.ttl, credentials)
+            return credentials
+        finally:
+            if self._is_current(key):
+                del self._inflight[key]
+
+    def invalidate(self, provider: str, external_id: str):
+        self._inflight.pop((provider, external_id), None)
+        if self._entries.pop((provider, external_id), None) is not None:
+            logger.info("Invalidated SMTP credentials", extra={"provider": provider, "external_id": external_id})
+
+    def clear(self):
+        self._entries.clear()
+
+
+credential_cache = CredentialCache(ttl=settings.SMTP_CREDENTIALS.ttl)
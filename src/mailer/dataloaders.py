@@ -1,23 +1,79 @@
+from collections import Counter, defaultdict
+
 from aiodataloader import DataLoader
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 
 from . import models
+from .active_provider import active_providers
 
 
 class AppEmailLoader(DataLoader):
+    """Keys are `(senders, time_bin, *time_window)`, values the usage of all the senders together"""
+
     async def batch_load_fn(self, keys):
-        res = {
-            from_address: [i async for i in models.EmailEvent.gen_usage(from_address, time_bin, *time_window)]
-            for from_address, time_bin, *time_window in keys
-        }
-        return [res.get(key) for key, *_ in keys]
+        groups = defaultdict(set)
+        for senders, time_bin, *time_window in keys:
+            groups[(time_bin, *time_window)].update(senders)
+
+        # one aggregate per (time_bin, window), split by sender so every key picks its own rows
+        stats = {}
+        for (time_bin, *time_window), senders in groups.items():
+            per_sender = stats[(time_bin, *time_window)] = defaultdict(list)
+            async for usage in models.EmailEvent.gen_usage(senders, time_bin, *time_window, per_sender=True):
+                per_sender[usage.pop("from_address")].append(usage)
+
+        return [_merge_usage(stats[(time_bin, *time_window)], senders) for senders, time_bin, *time_window in keys]
+
+
+def _merge_usage(per_sender: dict[str, list[dict]], senders) -> list[dict]:
+    """Add up the bins of several senders"""
+    bins = {}
+    for sender in set(senders):
+        for usage in per_sender.get(sender, ()):
+            merged = bins.setdefault(usage["timestamp"], {"timestamp": usage["timestamp"], "emails": Counter()})
+            merged["emails"].update(usage["emails"])
+    return [{"timestamp": timestamp, "emails": dict(bins[timestamp]["emails"])} for timestamp in sorted(bins)]
 
 
 class AppEmailTotalLoader(DataLoader):
     async def batch_load_fn(self, keys):
-        res = {}
-        for app_id in keys:
-            app = await models.EmailProvider.objects.filter(app_id=app_id).only("from_address").afirst()
-            res[app_id] = await models.EmailEvent.objects.filter(
-                from_address=app.from_address, event=models.EmailEventChoices.SENT
-            ).acount()
-        return [res.get(key) for key in keys]
+        # one query for all the apps: every distinct (app, sender) pair with the sender's `sent` count
+        sent_count = (
+            models.EmailEvent.objects.filter(from_address=OuterRef("from_address"), event=models.EmailEventChoices.SENT)
+            .order_by()
+            .values("from_address")
+            .annotate(count=Count("id"))
+            .values("count")
+        )
+        res = defaultdict(int)  # apps without a provider sent nothing
+        async for row in (
+            models.EmailProvider.objects.filter(app_id__in=keys)
+            .values("app_id", "from_address")
+            .distinct()
+            .annotate(sent=Coalesce(Subquery(sent_count), 0))
+        ):
+            res[row["app_id"]] += row["sent"]
+        return [res[key] for key in keys]
+
+
+class AppProvidersLoader(DataLoader):
+    """The email providers of every app, active first"""
+
+    async def batch_load_fn(self, keys):
+        providers = {app_id: [] for app_id in keys}
+        async for provider in (
+            models.EmailProvider.objects.filter(app_id__in=keys)
+            .only("app_id", "from_address", "active")
+            .order_by("-active", "pk")
+        ):
+            providers[provider.app_id].append(provider)
+        return [providers[app_id] for app_id in keys]
+
+
+class ActiveProviderLoader(DataLoader):
+    """The active provider of every app, None for the apps without one, from the process wide map"""
+
+    async def batch_load_fn(self, keys):
+        active = await active_providers.get_many(keys)
+        return [active[app_id] for app_id in keys]
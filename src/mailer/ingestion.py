@@ -0,0 +1,159 @@
+"""Queued webhook ingestion
+
+In `queued` mode the webhook view only parses the payload and puts it on an in-process queue, a background
+task drains the queue and stores the events with one `bulk_create` per batch. A batch is flushed when it
+reaches `batch_size` events or when its oldest event waited `flush_interval` seconds.
+
+The queue is bounded: once `max_queue_size` events are waiting, enqueueing blocks (back-pressure) and after
+`enqueue_timeout` the webhook answers 503 so the provider retries later.
+Events still in the queue are flushed on ASGI shutdown, they are lost only if the process dies abruptly.
+
+A batch that fails to be stored is retried `flush_retries` times with an exponential backoff, the insert is atomic
+so a retry never stores an event twice. A batch that still fails is dropped: counted in
+`webhook_ingestion.dropped` and logged with its events so they can be replayed.
+"""
+
+import asyncio
+from logging import getLogger
+import time
+
+from django.conf import settings
+from opentelemetry import metrics
+
+from config.lifespan import on_shutdown, on_startup
+
+from .utils import enforce_hobby_quotas, insert_email_events, new_email_event
+
+logger = getLogger(__name__)
+meter = metrics.get_meter(__name__)
+dropped_counter = meter.create_counter(
+    "webhook_ingestion.dropped", description="Webhook events dropped after their batch failed to be stored"
+)
+
+
+class IngestionQueueFull(Exception): ...
+
+
+class WebhookEventQueue:
+    _STOP = object()
+
+    def __init__(
+        self,
+        batch_size: int,
+        flush_interval: float,
+        max_queue_size: int,
+        enqueue_timeout: float,
+        flush_retries: int = 0,
+        retry_backoff: float = 0.0,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.enqueue_timeout = enqueue_timeout
+        self.flush_retries = flush_retries
+        self.retry_backoff = retry_backoff
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._worker = asyncio.create_task(self._run(), name="webhook-ingestion")
+        logger.info("Webhook ingestion queue started", extra={"batch_size": self.batch_size})
+
+    async def stop(self):
+        """Flush whatever is waiting and stop the background task"""
+        if not self.running:
+            return
+        await self._queue.put(self._STOP)
+        await self._worker
+        self._worker = None
+        logger.info("Webhook ingestion queue stopped")
+
+    async def put(self, provider_id: int, webhook_data: dict):
+        if not self.running:
+            # servers without lifespan support never call start
+            await self.start()
+        try:
+            await asyncio.wait_for(self._queue.put((provider_id, webhook_data)), timeout=self.enqueue_timeout)
+        except TimeoutError:
+            raise IngestionQueueFull("Webhook ingestion queue is full")
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout <= 0:
+                        item = self._queue.get_nowait()
+                    else:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                except (asyncio.QueueEmpty, TimeoutError):
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+        # drain anything that was queued after the stop signal
+        leftover = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not self._STOP:
+                leftover.append(item)
+        for start in range(0, len(leftover), self.batch_size):
+            await self._flush(leftover[start : start + self.batch_size])
+
+    async def _flush(self, batch: list[tuple[int, dict]]):
+        for attempt in range(self.flush_retries + 1):
+            try:
+                events, counters = await insert_email_events(
+                    [new_email_event(provider_id, webhook_data) for provider_id, webhook_data in batch]
+                )
+                break
+            except Exception:
+                # never let one bad batch kill the worker
+                if attempt == self.flush_retries:
+                    dropped_counter.add(len(batch))
+                    logger.exception("Dropped webhook batch", extra={"count": len(batch), "events": batch})
+                    return
+                delay = self.retry_backoff * 2**attempt
+                logger.warning(
+                    "Failed to store webhook batch, retrying",
+                    exc_info=True,
+                    extra={"count": len(batch), "attempt": attempt + 1, "delay": delay},
+                )
+                await asyncio.sleep(delay)
+        logger.info("Email webhook batch", extra={"count": len(events)})
+        try:
+            await enforce_hobby_quotas(counters)
+        except Exception:
+            # the events are stored, the next batch of the sender checks its quota again
+            logger.exception("Failed to check the quota of the webhook batch senders")
+
+
+ingestion_queue = WebhookEventQueue(
+    batch_size=settings.WEBHOOK_INGESTION.batch_size,
+    flush_interval=settings.WEBHOOK_INGESTION.flush_interval,
+    max_queue_size=settings.WEBHOOK_INGESTION.max_queue_size,
+    enqueue_timeout=settings.WEBHOOK_INGESTION.enqueue_timeout,
+    flush_retries=settings.WEBHOOK_INGESTION.flush_retries,
+    retry_backoff=settings.WEBHOOK_INGESTION.retry_backoff,
+)
+
+
+def register_lifespan_hooks():
+    if settings.WEBHOOK_INGESTION.mode == "queued":
+        on_startup(ingestion_queue.start)
+        on_shutdown(ingestion_queue.stop)
@@ -0,0 +1,89 @@
+import asyncio
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import httpx
+import msgspec
+import uvicorn
+
+from mailer.smtp_providers import SMTPServiceProvider
+from mailer.smtp_providers.http import provider_clients
+
+from .bench_webhook import percentile
+
+BENCH_USER = "bench_user"
+
+
+async def mock_smtp2go(scope, receive, send):
+    """Answers every request like SMTP2GO's users/smtp/view finding BENCH_USER"""
+    while (await receive()).get("more_body"):
+        pass
+    body = msgspec.json.encode(
+        {"data": {"results": [{"username": BENCH_USER, "email_password": "secret", "sending_allowed": True}]}}
+    )
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def start_mock_server() -> str:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(mock_smtp2go, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+async def per_call_client(provider: SMTPServiceProvider):
+    """How the credentials were fetched before the shared clients: a new client, and connection, per call"""
+    method, url, headers, body = provider.get_credentials_request(BENCH_USER)
+    async with httpx.AsyncClient() as client:
+        resp = await client.request(method=method, url=url, headers=headers, json=body)
+    return provider.parse_credentials(resp.json(), BENCH_USER)
+
+
+class Command(BaseCommand):
+    help = "Compare provider API latency with a client per call and with the shared pooled client"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", help="A running mock of the SMTP2GO API, one is started locally by default")
+        parser.add_argument("--requests", "-n", type=int, default=2000)
+        parser.add_argument("--concurrency", "-c", type=int, default=20)
+
+    def handle(self, *args, **options):
+        url = options["url"] or start_mock_server()
+        settings.STMP_PROVIDERS["smtp2go"] = msgspec.structs.replace(settings.STMP_PROVIDERS["smtp2go"], api_url=url)
+        print(f"Provider API: {url}, {options['requests']} calls, concurrency {options['concurrency']}")
+        asyncio.run(self.run(options["requests"], options["concurrency"]))
+
+    async def run(self, total: int, concurrency: int):
+        provider = SMTPServiceProvider.get_provider("smtp2go")
+        for label, call in [
+            ("client per call", lambda: per_call_client(provider)),
+            ("shared client", lambda: provider.get_user_credentials(BENCH_USER)),
+        ]:
+            latencies, elapsed = await self.measure(call, total, concurrency)
+            print(
+                f"{label:<16} {len(latencies) / elapsed:>7.0f} calls/s  "
+                f"p50={percentile(latencies, 50) * 1000:.2f}ms  p99={percentile(latencies, 99) * 1000:.2f}ms"
+            )
+        await provider_clients.close()
+
+    async def measure(self, call, total: int, concurrency: int) -> tuple[list[float], float]:
+        latencies: list[float] = []
+        pending = iter(range(total))
+
+        async def worker():
+            for _ in pending:
+                started = time.perf_counter()
+                await call()
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latencies, time.perf_counter() - started
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import socket
+import time
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.management.base import BaseCommand, CommandError
+
+from mailer.smtp_pool import SMTPConnectionPool
+
+from .bench_webhook import percentile
+
+USERNAME, PASSWORD = "bench", "secret"
+
+
+class CountingHandler:
+    def __init__(self):
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return "250 OK"
+
+
+def start_smtp_server(handler) -> tuple[object, int]:
+    try:
+        from aiosmtpd.controller import Controller
+        from aiosmtpd.smtp import AuthResult
+    except ImportError:
+        raise CommandError("The benchmark needs a local SMTP server: pip install aiosmtpd")
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    controller = Controller(
+        handler,
+        hostname="127.0.0.1",
+        port=port,
+        auth_require_tls=False,
+        authenticator=lambda server, session, envelope, mechanism, auth_data: AuthResult(success=True),
+    )
+    logging.getLogger("mail.log").setLevel(logging.ERROR)
+    controller.start()
+    return controller, port
+
+
+def message(i: int) -> EmailMultiAlternatives:
+    msg = EmailMultiAlternatives(
+        subject=f"Bench {i}", body="<p>Hello</p>", from_email="bench@nicedomain.com", to=["someone@example.com"]
+    )
+    msg.attach_alternative("<p>Hello</p>", "text/html")
+    return msg
+
+
+class Command(BaseCommand):
+    help = "Compare sending with a new SMTP connection per email and with the connection pool, on a local server"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", "-n", type=int, default=500)
+        parser.add_argument("--concurrency", "-c", type=int, default=8)
+
+    def handle(self, *args, **options):
+        handler = CountingHandler()
+        controller, port = start_smtp_server(handler)
+        try:
+            print(f"SMTP server on port {port}, {options['messages']} emails, concurrency {options['concurrency']}")
+            asyncio.run(self.run(port, options["messages"], options["concurrency"]))
+        finally:
+            controller.stop()
+        print(f"Received:         {handler.received} emails")
+
+    async def run(self, port: int, total: int, concurrency: int):
+        def connection_per_email(msg):
+            # what sendEmail did before the pool, blocking the event loop
+            msg.connection = get_connection(
+                backend="django.core.mail.backends.smtp.EmailBackend",
+                host="127.0.0.1",
+                port=port,
+                username=USERNAME,
+                password=PASSWORD,
+            )
+            msg.send()
+
+        async def blocking(msg):
+            connection_per_email(msg)
+
+        pool = SMTPConnectionPool("127.0.0.1", port, USERNAME, PASSWORD, use_tls=False, size=concurrency)
+
+        async def pooled(msg):
+            await pool.send_messages([msg])
+
+        for label, send in [("connection per email", blocking), ("pooled", pooled)]:
+            latencies, elapsed, loop_stall = await self.measure(send, total, concurrency)
+            print(
+                f"{label:<21} {len(latencies) / elapsed:>7.0f} emails/s  "
+                f"p50={percentile(latencies, 50) * 1000:.2f}ms  p99={percentile(latencies, 99) * 1000:.2f}ms  "
+                f"event loop stalled up to {loop_stall * 1000:.1f}ms"
+            )
+        pool.close()
+
+    async def measure(self, send, total: int, concurrency: int) -> tuple[list[float], float, float]:
+        latencies: list[float] = []
+        pending = iter(range(total))
+
+        async def worker():
+            for i in pending:
+                started = time.perf_counter()
+                await send(message(i))
+                latencies.append(time.perf_counter() - started)
+
+        stalls = [0.0]
+
+        async def loop_lag(interval=0.005):
+            # how late the loop wakes this task up is how long the other requests of the server would wait
+            while True:
+                started = time.perf_counter()
+                await asyncio.sleep(interval)
+                stalls.append(time.perf_counter() - started - interval)
+
+        lag = asyncio.create_task(loop_lag())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(0.01)  # let the probe see a stall that lasted until the end
+        lag.cancel()
+        return latencies, elapsed, max(stalls)
@@ -0,0 +1,45 @@
+import asyncio
+import statistics
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from mailer.models import EmailEvent
+
+
+async def timed_usage(senders: tuple[str, ...], time_bin: str, from_events: bool) -> tuple[float, list]:
+    started = time.perf_counter()
+    usage = [i async for i in EmailEvent.gen_usage(senders, time_bin, from_events=from_events)]
+    return time.perf_counter() - started, usage
+
+
+class Command(BaseCommand):
+    help = "Compare EmailEvent.gen_usage answered from the raw events and from the daily rollups"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--generate", "-g", type=int, default=0, help="Generate this many sent emails first")
+        parser.add_argument("--repeat", "-r", type=int, default=5)
+
+    def handle(self, *args, **options):
+        if options["generate"]:
+            call_command("generate_email_events", count=options["generate"])
+            call_command("rollup_email_usage")
+        senders = tuple(EmailEvent.objects.values_list("from_address", flat=True).distinct())
+        print(f"{EmailEvent.objects.count()} events from {len(senders)} senders, median of {options['repeat']} runs")
+        asyncio.run(self.compare(senders, options["repeat"]))
+
+    async def compare(self, senders: tuple[str, ...], repeat: int):
+        for time_bin in ("day", "week", "month"):
+            timings = {}
+            for from_events in (True, False):
+                runs = [await timed_usage(senders, time_bin, from_events) for _ in range(repeat)]
+                timings[from_events] = statistics.median(elapsed for elapsed, _ in runs)
+                if from_events:
+                    expected = runs[0][1]
+                elif runs[0][1] != expected:
+                    print(f"  {time_bin}: rollups disagree with the events, run rollup_email_usage")
+            print(
+                f"{time_bin:>5}: events {timings[True] * 1000:8.1f} ms | rollups {timings[False] * 1000:8.1f} ms"
+                f" | x{timings[True] / timings[False]:.1f}"
+            )
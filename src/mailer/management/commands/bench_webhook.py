@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import random
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import httpx
+
+from mailer.models import EmailEvent
+
+from .generate_email_events import FROMS, RECIPIENTS, RANDOM_ID_LENGTH, alpha_numeric, generate
+
+
+def smtp2go_payload() -> dict:
+    send_time = datetime.now(timezone.utc) - timedelta(seconds=random.randint(0, 60))
+    event = random.choice(["processed", "delivered", "bounce"])
+    return {
+        "event": event,
+        "time": (send_time + timedelta(seconds=random.randint(1, 30))).isoformat(),
+        "sendtime": send_time.isoformat(),
+        "email_id": generate(alphabet=alpha_numeric, size=RANDOM_ID_LENGTH),
+        "auth": "bench",
+        "from_address": random.choice(FROMS),
+        "rcpt": random.choice(RECIPIENTS),
+        "bounce": random.choice(["soft", "hard"]),
+        "message": "User unknown" if event == "bounce" else None,
+    }
+
+
+def percentile(latencies: list[float], p: float) -> float:
+    return statistics.quantiles(latencies, n=100)[int(p) - 1] if len(latencies) > 1 else latencies[0]
+
+
+class Command(BaseCommand):
+    help = "Load test the email webhook of a running server and report throughput and latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://localhost:8000")
+        parser.add_argument("--requests", "-n", type=int, default=5000)
+        parser.add_argument("--concurrency", "-c", type=int, default=50)
+        parser.add_argument("--batch", "-b", type=int, default=0, help="Post arrays of this many events to /batch")
+
+    def handle(self, *args, **options):
+        before = EmailEvent.objects.count()
+        latencies, statuses, elapsed = asyncio.run(
+            self.run(options["url"], options["requests"], options["concurrency"], options["batch"])
+        )
+        print(f"Requests:    {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} req/s)")
+        print(f"Statuses:    {dict(sorted(statuses.items()))}")
+        print(
+            "Latency ms:  "
+            f"p50={percentile(latencies, 50) * 1000:.1f} "
+            f"p95={percentile(latencies, 95) * 1000:.1f} "
+            f"p99={percentile(latencies, 99) * 1000:.1f}"
+        )
+        # in queued mode the server keeps flushing after it acknowledged, wait until the count settles
+        stored, previous = EmailEvent.objects.count() - before, -1
+        while stored != previous and stored < statuses.get(200, 0) * max(options["batch"], 1):
+            time.sleep(settings.WEBHOOK_INGESTION.flush_interval * 2)
+            stored, previous = EmailEvent.objects.count() - before, stored
+        print(f"Stored:      {stored} events")
+
+    async def run(self, base_url: str, total: int, concurrency: int, batch: int):
+        url = f"{base_url}/webhook/email/smtp2go/{settings.STMP_PROVIDERS['smtp2go'].webhook_token}"
+        if batch:
+            url += "/batch"
+        latencies: list[float] = []
+        statuses: dict[int, int] = {}
+        pending = iter(range(total))
+
+        async def worker(client: httpx.AsyncClient):
+            for _ in pending:
+                payload = [smtp2go_payload() for _ in range(batch)] if batch else smtp2go_payload()
+                started = time.perf_counter()
+                resp = await client.post(url, json=payload)
+                latencies.append(time.perf_counter() - started)
+                statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+        return latencies, statuses, elapsed
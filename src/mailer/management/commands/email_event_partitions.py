@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mailer import partitions
+
+
+class Command(BaseCommand):
+    help = "Partition the EmailEvent table by send_time month and maintain its partitions"
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest="action", required=True)
+
+        convert = subparsers.add_parser("convert", help="Rebuild the table as a partitioned table (one time)")
+        convert.add_argument("--months-ahead", type=int, default=3)
+        convert.add_argument("--keep-legacy", action="store_true", help="Keep the old table as <table>_legacy")
+
+        create = subparsers.add_parser("create", help="Create the partitions of the coming months")
+        create.add_argument("--months-ahead", type=int, default=3)
+
+        detach = subparsers.add_parser("detach", help="Detach the partitions of old months")
+        detach.add_argument("--older-than", type=int, required=True, help="Months to keep attached")
+        detach.add_argument("--archive-schema", help="Move the detached partitions to this schema")
+        detach.add_argument("--drop", action="store_true", help="Drop the detached partitions")
+
+        subparsers.add_parser("list", help="List the partitions")
+
+    def handle(self, *args, **options):
+        if options["action"] == "convert":
+            if partitions.is_partitioned():
+                raise CommandError("EmailEvent is already partitioned")
+            partitions.convert_to_partitioned(options["months_ahead"], options["keep_legacy"])
+            print(f"Converted, partitions: {', '.join(partitions.partitions())}")
+            return
+
+        if not partitions.is_partitioned():
+            raise CommandError("EmailEvent is not partitioned, run the convert action first")
+        if options["action"] == "create":
+            created = partitions.create_upcoming_partitions(options["months_ahead"])
+            print(f"Created {len(created)} partitions: {', '.join(created)}")
+        elif options["action"] == "detach":
+            if options["drop"] and options["archive_schema"]:
+                raise CommandError("Use either --drop or --archive-schema")
+            detached = partitions.detach_partitions(options["older_than"], options["archive_schema"], options["drop"])
+            print(f"Detached {len(detached)} partitions: {', '.join(detached)}")
+        else:
+            print("\n".join(partitions.partitions()))
@@ -1,11 +1,16 @@
-from datetime import datetime, timedelta
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+import multiprocessing
 import random
 from string import ascii_letters, digits
+import time
 
 from django.core.management.base import BaseCommand
+from django.db import connection
 from django.utils import timezone as dj_tz
 
-from mailer.models import EmailEvent
+from config.database import close_before_fork
+from mailer.models import EmailEvent, SMTPProvider
 
 alpha_numeric = ascii_letters + digits
 RANDOM_ID_LENGTH = 24
@@ -101,11 +106,99 @@ def gen_events_bulk(n):
     )
 
 
+@dataclass
+class Distribution:
+    senders: list[str]
+    sender_weights: list[float]
+    provider_ids: list[int]
+    hard_bounce_rate: float
+    soft_bounce_rate: float
+    days: float
+
+
+BOUNCE_REASONS = ["Host or domain name not found", "User unknown", "Mailbox full"]
+COPY_COLUMNS = (
+    "event, send_time, event_time, message_id, from_address, recipients, provider_id, reason, webhook_received_at"
+)
+
+
+def _timestamp(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+
+def gen_copy_rows(rng: random.Random, messages: int, dist: Distribution, now: float) -> str:
+    """`messages` emails as COPY text rows, a `sent` event and its outcome each.
+    Every column is drawn for the whole batch at once, the rows are only joined at the end
+    """
+    delivered_rate = 1 - dist.hard_bounce_rate - dist.soft_bounce_rate
+    outcomes = rng.choices(
+        ["delivered", "hard_bounce", "soft_bounce"],
+        weights=[delivered_rate, dist.hard_bounce_rate, dist.soft_bounce_rate],
+        k=messages,
+    )
+    senders = rng.choices(dist.senders, weights=dist.sender_weights, k=messages)
+    provider_ids = rng.choices(dist.provider_ids, k=messages)
+    span = dist.days * 24 * 60 * 60
+    send_times = [now - rng.random() * span for _ in range(messages)]
+    recipients = ["{" + ",".join(rng.sample(RECIPIENTS, rng.randint(1, 3))) + "}" for _ in range(messages)]
+    message_ids = rng.randbytes(RANDOM_ID_LENGTH // 2 * messages).hex()
+    received_at = _timestamp(now)
+
+    lines = []
+    for i in range(messages):
+        send_time = send_times[i]
+        sent_at = _timestamp(send_time)
+        outcome = outcomes[i]
+        reason = "\\N" if outcome == "delivered" else rng.choice(BOUNCE_REASONS)
+        common = (
+            f"{message_ids[i * RANDOM_ID_LENGTH : (i + 1) * RANDOM_ID_LENGTH]}\t{senders[i]}\t{recipients[i]}"
+            f"\t{provider_ids[i]}\t{reason}\t{received_at}\n"
+        )
+        lines.append(f"sent\t{sent_at}\t{_timestamp(send_time + rng.uniform(5, 15))}\t{common}")
+        lines.append(f"{outcome}\t{sent_at}\t{_timestamp(send_time + rng.uniform(15, 15 * 60))}\t{common}")
+    return "".join(lines)
+
+
+def copy_events(messages: int, dist: Distribution, seed: int | None, batch_size: int) -> int:
+    """Stream `messages` generated emails into the events table with COPY, in one transaction per batch"""
+    rng = random.Random(seed)
+    now = time.time()
+    written = 0
+    while written < messages:
+        batch = min(batch_size, messages - written)
+        rows = gen_copy_rows(rng, batch, dist, now)
+        with connection.cursor() as cursor:
+            with cursor.copy(f"COPY {EmailEvent._meta.db_table} ({COPY_COLUMNS}) FROM STDIN") as copy:
+                copy.write(rows)
+        written += batch
+    return written * 2
+
+
+def zipf_weights(count: int, skew: float) -> list[float]:
+    return [1 / (rank + 1) ** skew for rank in range(count)]
+
+
 class Command(BaseCommand):
+    help = "Generate synthetic email events, --fast streams them with COPY for the big load testing datasets"
+
     def add_arguments(self, parser):
-        parser.add_argument("--count", "-c", type=int, default=1000)
+        parser.add_argument("--count", "-c", type=int, default=1000, help="Events, two per email")
+        parser.add_argument("--fast", action="store_true", help="Generate in bulk and COPY the rows to Postgres")
+        parser.add_argument("--workers", "-w", type=int, default=1, help="Processes, --fast only")
+        parser.add_argument("--batch-size", type=int, default=50_000, help="Emails per COPY, --fast only")
+        parser.add_argument("--senders", type=int, help="Use this many senders instead of the 5 fixed ones")
+        parser.add_argument("--sender-skew", type=float, default=0.0, help="Zipf exponent of the senders' volume")
+        parser.add_argument("--providers", type=int, nargs="+", help="Provider ids, all the providers by default")
+        parser.add_argument("--hard-bounce-rate", type=float, default=0.02)
+        parser.add_argument("--soft-bounce-rate", type=float, default=0.03)
+        parser.add_argument("--days", type=float, default=90, help="Spread the send times over the last days")
+        parser.add_argument("--seed", type=int)
 
     def handle(self, *args, **options):
+        if options["fast"]:
+            self.handle_fast(options)
+            return
+
         BULK_COUNT = 100
         total = options["count"]
         rounds, final = divmod(total, BULK_COUNT)
@@ -119,3 +212,32 @@ class Command(BaseCommand):
         gen_events_bulk(final)
         print(f"\rGenerated {counter + final} events")
         print()
+
+    def handle_fast(self, options):
+        senders = [f"sender.{i}@nicedomain.com" for i in range(options["senders"])] if options["senders"] else FROMS
+        dist = Distribution(
+            senders=senders,
+            sender_weights=zipf_weights(len(senders), options["sender_skew"]),
+            provider_ids=options["providers"] or list(SMTPProvider.objects.values_list("id", flat=True)) or [1, 2],
+            hard_bounce_rate=options["hard_bounce_rate"],
+            soft_bounce_rate=options["soft_bounce_rate"],
+            days=options["days"],
+        )
+        workers = options["workers"]
+        share, extra = divmod(options["count"] // 2, workers)
+        jobs = [
+            (share + (i < extra), dist, None if options["seed"] is None else options["seed"] + i, options["batch_size"])
+            for i in range(workers)
+        ]
+
+        started = time.perf_counter()
+        if workers == 1:
+            written = copy_events(*jobs[0])
+        else:
+            # every worker opens its own database connection
+            close_before_fork()
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                written = sum(pool.starmap(copy_events, jobs))
+        elapsed = time.perf_counter() - started
+        print(f"Generated {written} events in {elapsed:.1f}s, {written / elapsed:,.0f} rows/s")
+        print("The usage rollups are not updated, run rebuild_usage_counters and rollup_email_usage")
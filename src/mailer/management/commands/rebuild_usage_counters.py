@@ -0,0 +1,51 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+import django.db.models.functions as dj_functions
+from django.utils import timezone as dj_tz
+
+from mailer.models import EmailEvent, EmailEventChoices, MonthlyEmailUsage
+from mailer.utils import billing_cycle_of
+
+
+def rebuild_usage_counters(since: datetime | None = None) -> int:
+    events = EmailEvent.objects.filter(event=EmailEventChoices.SENT.value)
+    counters = MonthlyEmailUsage.objects.all()
+    if since:
+        events = events.filter(send_time__gte=since)
+        counters = counters.filter(billing_cycle__gte=billing_cycle_of(since))
+    rows = (
+        events.annotate(month=dj_functions.TruncMonth("send_time"))
+        .values("from_address", "month")
+        .annotate(sent=Count("id"))
+        .order_by()
+    )
+    with transaction.atomic():
+        # block the webhooks from incrementing while we recount
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {MonthlyEmailUsage._meta.db_table} IN EXCLUSIVE MODE")
+        counters.delete()
+        created = MonthlyEmailUsage.objects.bulk_create(
+            MonthlyEmailUsage(
+                from_address=row["from_address"], billing_cycle=billing_cycle_of(row["month"]), sent=row["sent"]
+            )
+            for row in rows.iterator()
+        )
+    return len(created)
+
+
+class Command(BaseCommand):
+    help = "Recount the monthly `sent` counters from the EmailEvent history"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            type=lambda value: dj_tz.make_aware(datetime.strptime(value, "%Y-%m")),
+            help="Only rebuild billing cycles from this month on (YYYY-MM)",
+        )
+
+    def handle(self, *args, **options):
+        count = rebuild_usage_counters(options["since"])
+        print(f"Rebuilt {count} usage counters")
@@ -0,0 +1,43 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+import django.db.models.functions as dj_functions
+
+from mailer.models import DailyEmailUsage, EmailEvent
+
+
+def rollup_email_usage(since: date | None = None) -> int:
+    events = EmailEvent.objects.all()
+    rollups = DailyEmailUsage.objects.all()
+    if since:
+        events = events.filter(send_time__date__gte=since)
+        rollups = rollups.filter(day__gte=since)
+    rows = (
+        events.annotate(day=dj_functions.TruncDate("send_time"))
+        .values("from_address", "day", "event")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    with transaction.atomic():
+        # block the webhooks from incrementing while we recount
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {DailyEmailUsage._meta.db_table} IN EXCLUSIVE MODE")
+        rollups.delete()
+        created = DailyEmailUsage.objects.bulk_create(
+            (DailyEmailUsage(**row) for row in rows.iterator()),
+            batch_size=5000,
+        )
+    return len(created)
+
+
+class Command(BaseCommand):
+    help = "Backfill the daily usage rollups from the EmailEvent history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=date.fromisoformat, help="Only rebuild days from this one on (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        count = rollup_email_usage(options["since"])
+        print(f"Rolled up {count} daily usage rows")
@@ -0,0 +1,67 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+
+from django.core.management.base import BaseCommand
+
+from config.database import close_before_fork
+from mailer.outbound import process_batch, run_worker
+
+
+async def run_workers(workers: int):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        # finish the batches in flight, then exit
+        loop.add_signal_handler(sig, stop.set)
+    await asyncio.gather(*(run_worker(stop, f"{os.getpid()}-{i}") for i in range(workers)))
+
+
+def run_process(workers: int):
+    asyncio.run(run_workers(workers))
+
+
+async def drain() -> int:
+    sent = 0
+    while claimed := await process_batch():
+        sent += claimed
+    return sent
+
+
+class Command(BaseCommand):
+    help = "Send the queued outbound emails"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", "-w", type=int, default=4, help="Async workers per process")
+        parser.add_argument("--processes", "-p", type=int, default=1)
+        parser.add_argument("--once", action="store_true", help="Process every due email, then exit")
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            print(f"Processed {asyncio.run(drain())} emails")
+            return
+
+        if options["processes"] == 1:
+            run_process(options["workers"])
+            return
+
+        # the children must not share the parent's database connections
+        close_before_fork()
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(target=run_process, args=(options["workers"],), name=f"outbound-{i}")
+            for i in range(options["processes"])
+        ]
+        for process in processes:
+            process.start()
+
+        def forward(sig, frame):
+            for process in processes:
+                if process.is_alive():
+                    os.kill(process.pid, sig)
+
+        signal.signal(signal.SIGINT, forward)
+        signal.signal(signal.SIGTERM, forward)
+        for process in processes:
+            process.join()
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0003_emailprovider_maxed_quota_squashed_0004_remove_emailprovider_maxed_quota_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyEmailUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_address', models.EmailField(max_length=254)),
+                ('billing_cycle', models.DateField(help_text='Last day of the billing cycle, see `this_billing_cycle`')),
+                ('sent', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('from_address', 'billing_cycle'), name='unique_sender_billing_cycle')],
+            },
+        ),
+    ]
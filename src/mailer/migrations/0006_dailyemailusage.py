@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0005_monthlyemailusage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyEmailUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_address', models.EmailField(max_length=254)),
+                ('day', models.DateField()),
+                ('event', models.CharField(choices=[('sent', 'Sent'), ('delivered', 'Delivered'), ('soft_bounce', 'Soft Bounce'), ('hard_bounce', 'Hard Bounce'), ('unsubscribe', 'Unsubscribe'), ('spam', 'Spam')], max_length=16)),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('from_address', 'day', 'event'), name='unique_sender_day_event')],
+            },
+        ),
+    ]
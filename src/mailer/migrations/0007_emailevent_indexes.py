@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:29
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction, it does not block writes on the live table
+    atomic = False
+
+    dependencies = [
+        ('mailer', '0006_dailyemailusage'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='emailevent',
+            index=models.Index(condition=models.Q(('event', 'sent')), fields=['from_address', 'send_time'], name='emailevent_sent_sender_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='emailevent',
+            index=models.Index(fields=['from_address', 'send_time'], include=('event',), name='emailevent_sender_time_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='emailevent',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['send_time'], name='emailevent_send_time_brin'),
+        ),
+    ]
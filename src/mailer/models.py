@@ -1,15 +1,24 @@
-from datetime import datetime
+from datetime import date, datetime
+from functools import partial
 from typing import Iterable, Literal, Optional, Union
+import uuid
 
 from asgiref.sync import sync_to_async
 from django.contrib.postgres.fields import ArrayField
-from django.db import models
+from django.contrib.postgres.indexes import BrinIndex
+from django.db import connection, models
 from django.db import transaction
-from django.db.models import Count, constraints
+from django.db.models import Count, Sum, constraints
 import django.db.models.functions as dj_functions
+from django.db.models.functions import Coalesce
+from django.utils import timezone as dj_tz
 
+from core.cache import app_cache
 from core.models import DeployedApp
 
+from .active_provider import active_providers
+from .credentials import credential_cache
+
 
 class EmailEventChoices(models.TextChoices):
     SENT = "sent", "Sent"
@@ -62,11 +71,64 @@ class EmailProvider(models.Model):
     @classmethod
     @sync_to_async
     @transaction.atomic
-    def switch_provider(cls, app_id: str, to_provider: SMTPProvider):
+    def switch_provider(cls, app_id: str, to_provider_id: int):
         # transactions are not really supported in async so we wrap this function with sync_to_async
         # https://docs.djangoproject.com/en/5.2/topics/async/#queries-the-orm
         cls.objects.filter(app_id=app_id).update(active=False)
-        cls.objects.filter(app_id=app_id, provider=to_provider).update(active=True)
+        cls.objects.filter(app_id=app_id, provider_id=to_provider_id).update(active=True)
+        transaction.on_commit(lambda: app_cache.invalidate(app_id))
+        transaction.on_commit(lambda: active_providers.invalidate(app_id))
+        # switching drops the app's cached SMTP credentials, of the old and of the new provider
+        credentials = cls.objects.filter(app_id=app_id).values_list("provider__name", "external_id")
+        for provider_name, external_id in credentials:
+            transaction.on_commit(partial(credential_cache.invalidate, provider_name, external_id))
+
+
+def increment_counters(
+    model, key_fields: tuple[str, ...], count_field: str, counts: dict[tuple, int]
+) -> dict[tuple, int]:
+    """Upsert `counts` into the counter rows of `model`, unique on `key_fields`, and return the new totals"""
+    if not counts:
+        return {}
+    table = model._meta.db_table
+    columns = ", ".join((*key_fields, count_field))
+    values = ", ".join([f"({', '.join(['%s'] * (len(key_fields) + 1))})"] * len(counts))
+    # rows are locked in the order of VALUES, concurrent batches taking the same rows in the same order never
+    # wait on each other in a cycle
+    params = [param for key, count in sorted(counts.items()) for param in (*key, count)]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""INSERT INTO {table} ({columns}) VALUES {values}
+            ON CONFLICT ({", ".join(key_fields)})
+            DO UPDATE SET {count_field} = {table}.{count_field} + EXCLUDED.{count_field}
+            RETURNING {columns}""",
+            params,
+        )
+        return {tuple(row[:-1]): row[-1] for row in cursor.fetchall()}
+
+
+class MonthlyEmailUsage(models.Model):
+    """Running count of `sent` events per sender and billing cycle, kept up to date by webhook ingestion
+    so quota checks never have to count the events table.
+    Rebuild it from the events with `./manage.py rebuild_usage_counters`
+    """
+
+    class Meta:
+        constraints = [
+            constraints.UniqueConstraint(fields=["from_address", "billing_cycle"], name="unique_sender_billing_cycle"),
+        ]
+
+    from_address = models.EmailField()
+    billing_cycle = models.DateField(help_text="Last day of the billing cycle, see `this_billing_cycle`")
+    sent = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.from_address} {self.billing_cycle}: {self.sent}"
+
+    @classmethod
+    def increment(cls, counts: dict[tuple[str, date], int]) -> dict[tuple[str, date], int]:
+        """Atomically add `counts` to the (from_address, billing_cycle) counters and return their new values"""
+        return increment_counters(cls, ("from_address", "billing_cycle"), "sent", counts)
 
 
 class AppEmailEventsManager(models.Manager):
@@ -84,6 +146,21 @@ class EmailEvent(models.Model):
     """Registry of email events we receive via webhooks from providers
     All fields except provider and webhook_received_at come from the webhook
     """
+
+    class Meta:
+        indexes = [
+            # counting sent emails per sender, all time or in a billing cycle
+            models.Index(
+                fields=["from_address", "send_time"],
+                condition=models.Q(event="sent"),
+                name="emailevent_sent_sender_idx",
+            ),
+            # usage stats per sender and time window, covers the event so it can be an index only scan
+            models.Index(fields=["from_address", "send_time"], include=["event"], name="emailevent_sender_time_idx"),
+            # the table is append only and roughly ordered by send_time, a tiny BRIN serves time range scans
+            BrinIndex(fields=["send_time"], name="emailevent_send_time_brin"),
+        ]
+
     provider = models.ForeignKey(SMTPProvider, on_delete=models.PROTECT)
     webhook_received_at = models.DateTimeField(auto_now_add=True, help_text="The time we received the email")
 
@@ -106,15 +183,16 @@ class EmailEvent(models.Model):
         return f"{self.event} <{self.from_address}>"
 
     @classmethod
-    async def gen_usage(
+    def usage_from_events(
         cls,
         from_address: Union[Iterable[str], str],
         time_bin: Literal["day", "week", "month"],
         from_time: Optional[datetime] = None,
         to_time: Optional[datetime] = None,
-    ):
-        """Generate usage stats for an app in time bins from from_time to to_time
-        In a date range from from_time to to_time (exclusive)
+        per_sender: bool = False,
+    ) -> models.QuerySet:
+        """Aggregate the raw events, slow on big tables, `DailyEmailUsage.usage` gives the same answer.
+        With `per_sender` the bins are also split by `from_address`
         """
         if isinstance(from_address, str):
             filters = models.Q(from_address=from_address)
@@ -126,10 +204,11 @@ class EmailEvent(models.Model):
         if to_time:
             filters &= models.Q(send_time__lt=to_time)
 
-        async for result in (
+        group_by = ("from_address", "time_bin_start") if per_sender else ("time_bin_start",)
+        return (
             cls.objects.filter(filters)
             .annotate(time_bin_start=cls.BIN_MAKERS[time_bin](expression="send_time", output_field=models.DateField()))
-            .values("time_bin_start")
+            .values(*group_by)
             .annotate(
                 total=Count("id", filter=models.Q(event="sent")),
                 failed=Count("id", filter=models.Q(event__endswith="bounce")),
@@ -138,9 +217,27 @@ class EmailEvent(models.Model):
                 ),
                 sent=Count("id", filter=models.Q(event=EmailEventChoices.DELIVERED)),
             )
-            .order_by("time_bin_start")
-        ):
-            yield {
+            .order_by(*group_by)
+        )
+
+    @classmethod
+    async def gen_usage(
+        cls,
+        from_address: Union[Iterable[str], str],
+        time_bin: Literal["day", "week", "month"],
+        from_time: Optional[datetime] = None,
+        to_time: Optional[datetime] = None,
+        from_events: bool = False,
+        per_sender: bool = False,
+    ):
+        """Generate usage stats for an app in time bins from from_time to to_time
+        In a date range from from_time to to_time (exclusive)
+        Answered from the daily rollups unless `from_events` is set,
+        with `per_sender` every stat also carries its `from_address`
+        """
+        usage = cls.usage_from_events if from_events else DailyEmailUsage.usage
+        async for result in usage(from_address, time_bin, from_time, to_time, per_sender=per_sender):
+            stats = {
                 "timestamp": result["time_bin_start"],
                 "emails": {
                     "total": result["total"],
@@ -149,3 +246,121 @@ class EmailEvent(models.Model):
                     "sent": result["sent"],
                 },
             }
+            if per_sender:
+                stats["from_address"] = result["from_address"]
+            yield stats
+
+
+def event_day(moment: Union[date, datetime]) -> date:
+    """The day an event that happened at `moment` is counted for, in the project time zone"""
+    if isinstance(moment, datetime):
+        return dj_tz.localdate(moment) if dj_tz.is_aware(moment) else moment.date()
+    return moment
+
+
+class DailyEmailUsage(models.Model):
+    """Number of events per sender, day (of the send time) and event type.
+    Maintained by webhook ingestion next to the events, so usage stats never scan the events table.
+    Backfill it from the events with `./manage.py rollup_email_usage`
+    """
+
+    BIN_MAKERS = {
+        "day": dj_functions.TruncDay,
+        "week": dj_functions.TruncWeek,
+        "month": dj_functions.TruncMonth,
+    }
+
+    class Meta:
+        constraints = [
+            constraints.UniqueConstraint(fields=["from_address", "day", "event"], name="unique_sender_day_event"),
+        ]
+
+    from_address = models.EmailField()
+    day = models.DateField()
+    event = models.CharField(max_length=16, choices=EmailEventChoices.choices)
+    count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.from_address} {self.day} {self.event}: {self.count}"
+
+    @classmethod
+    def increment(cls, counts: dict[tuple[str, date, str], int]) -> dict[tuple[str, date, str], int]:
+        """Atomically add `counts` to the (from_address, day, event) rollups and return their new values"""
+        return increment_counters(cls, ("from_address", "day", "event"), "count", counts)
+
+    @classmethod
+    def usage(
+        cls,
+        from_address: Union[Iterable[str], str],
+        time_bin: Literal["day", "week", "month"],
+        from_time: Optional[Union[date, datetime]] = None,
+        to_time: Optional[Union[date, datetime]] = None,
+        per_sender: bool = False,
+    ) -> models.QuerySet:
+        """Same stats as `EmailEvent.usage_from_events`, the window is rounded to whole days"""
+        if isinstance(from_address, str):
+            filters = models.Q(from_address=from_address)
+        else:
+            filters = models.Q(from_address__in=from_address)
+
+        if from_time:
+            filters &= models.Q(day__gte=event_day(from_time))
+        if to_time:
+            filters &= models.Q(day__lt=event_day(to_time))
+
+        group_by = ("from_address", "time_bin_start") if per_sender else ("time_bin_start",)
+        return (
+            cls.objects.filter(filters)
+            .annotate(time_bin_start=cls.BIN_MAKERS[time_bin](expression="day", output_field=models.DateField()))
+            .values(*group_by)
+            .annotate(
+                total=Coalesce(Sum("count", filter=models.Q(event="sent")), 0),
+                failed=Coalesce(Sum("count", filter=models.Q(event__endswith="bounce")), 0),
+                rejected=Coalesce(
+                    Sum("count", filter=models.Q(event__in=[EmailEventChoices.SPAM, EmailEventChoices.UNSUBSCRIBE])),
+                    0,
+                ),
+                sent=Coalesce(Sum("count", filter=models.Q(event=EmailEventChoices.DELIVERED)), 0),
+            )
+            .order_by(*group_by)
+        )
+
+
+class OutboundEmailStatus(models.TextChoices):
+    QUEUED = "queued", "Queued"
+    SENDING = "sending", "Sending"
+    SENT = "sent", "Sent"
+    DEAD = "dead", "Dead"  # gave up, see last_error
+
+
+class OutboundEmail(models.Model):
+    """An email waiting for `./manage.py send_outbound_emails`, the id is the job id `sendEmail` returns.
+    `sendEmails` stores its batch as `sending` while it sends it right away
+    """
+
+    class Meta:
+        indexes = [
+            # the workers only look at the rows still to send
+            models.Index(
+                fields=["next_attempt_at"],
+                name="outboundemail_pending_idx",
+                condition=models.Q(status__in=[OutboundEmailStatus.QUEUED, OutboundEmailStatus.SENDING]),
+            ),
+        ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    app = models.ForeignKey(DeployedApp, on_delete=models.CASCADE)
+    to = models.EmailField()
+    subject = models.TextField()
+    html = models.TextField()
+
+    status = models.CharField(max_length=16, choices=OutboundEmailStatus.choices, default=OutboundEmailStatus.QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=dj_tz.now)
+    locked_at = models.DateTimeField(null=True, help_text="When a worker claimed it, reclaimed once it gets too old")
+    last_error = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"{self.pk} to {self.to}: {self.status}"
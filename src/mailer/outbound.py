@@ -0,0 +1,127 @@
+"""Outbound email queue
+
+`sendEmail` only stores the email as an `OutboundEmail` row, `./manage.py send_outbound_emails` sends them.
+Workers claim a batch of due rows with `SELECT ... FOR UPDATE SKIP LOCKED`, so any number of workers, in any
+number of processes, never claim the same email. A claimed row is marked `sending`, if its worker dies it is
+claimed again after `lock_timeout`. `sendEmails` sends its batch right away, its rows are stored as `sending`
+so the hobby quota counts them.
+
+Failures are retried with an exponential backoff until `max_attempts`, then the email is dead-lettered
+(`dead` with its `last_error`). Emails an app cannot send at all (no active provider, quota reached,
+recipient refused) are dead-lettered right away.
+"""
+
+import asyncio
+from collections import defaultdict
+from datetime import timedelta
+from logging import getLogger
+import random
+from smtplib import SMTPAuthenticationError, SMTPException, SMTPRecipientsRefused
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone as dj_tz
+
+from .credentials import credential_cache
+from .models import OutboundEmail, OutboundEmailStatus
+from .smtp_providers import SMTPUserNotFound
+from .utils import get_smtp_user_config, send_email
+
+logger = getLogger(__name__)
+
+
+@sync_to_async
+@transaction.atomic
+def claim(batch_size: int) -> list[OutboundEmail]:
+    now = dj_tz.now()
+    conf = settings.OUTBOUND_EMAIL
+    due = Q(status=OutboundEmailStatus.QUEUED, next_attempt_at__lte=now) | Q(
+        status=OutboundEmailStatus.SENDING, locked_at__lt=now - timedelta(seconds=conf.lock_timeout)
+    )
+    jobs = list(
+        OutboundEmail.objects.select_for_update(skip_locked=True).filter(due).order_by("next_attempt_at")[:batch_size]
+    )
+    OutboundEmail.objects.filter(pk__in=[job.pk for job in jobs]).update(
+        status=OutboundEmailStatus.SENDING, locked_at=now, attempts=F("attempts") + 1
+    )
+    for job in jobs:
+        job.attempts += 1
+    return jobs
+
+
+@sync_to_async
+def finish(job: OutboundEmail, error: Exception | None = None, permanent: bool = False):
+    now = dj_tz.now()
+    conf = settings.OUTBOUND_EMAIL
+    if error is None:
+        update = {"status": OutboundEmailStatus.SENT, "sent_at": now, "last_error": None}
+    elif permanent or job.attempts >= conf.max_attempts:
+        update = {"status": OutboundEmailStatus.DEAD, "last_error": repr(error)}
+        logger.error("Dead-lettered outbound email", extra={"job_id": str(job.pk), "error": repr(error)})
+    else:
+        retry_in = conf.retry_backoff * 2 ** (job.attempts - 1) * random.uniform(0.8, 1.2)
+        update = {
+            "status": OutboundEmailStatus.QUEUED,
+            "next_attempt_at": now + timedelta(seconds=retry_in),
+            "last_error": repr(error),
+        }
+    OutboundEmail.objects.filter(pk=job.pk).update(locked_at=None, **update)
+
+
+async def send_app_emails(app_id: str, jobs: list[OutboundEmail]):
+    try:
+        credentials = await get_smtp_user_config(app_id)
+    except SMTPUserNotFound as e:
+        # no active provider or the quota is maxed, retrying will not help
+        for job in jobs:
+            await finish(job, e, permanent=True)
+        return
+    except Exception as e:
+        logger.exception("Could not get the SMTP config", extra={"app_id": app_id})
+        for job in jobs:
+            await finish(job, e)
+        return
+
+    for job in jobs:
+        try:
+            await send_email(credentials, job.to, job.subject, job.html)
+        except SMTPAuthenticationError as e:
+            # the cached credentials may be stale, the retry asks the provider again
+            credential_cache.invalidate(credentials.provider, credentials.external_id)
+            await finish(job, e)
+        except SMTPRecipientsRefused as e:
+            await finish(job, e, permanent=True)
+        except (SMTPException, OSError) as e:
+            await finish(job, e)
+        else:
+            await finish(job)
+
+
+async def process_batch(batch_size: int | None = None) -> int:
+    """Claim and send one batch, the emails of different apps are sent concurrently. The number claimed"""
+    jobs = await claim(batch_size or settings.OUTBOUND_EMAIL.batch_size)
+    by_app = defaultdict(list)
+    for job in jobs:
+        by_app[job.app_id].append(job)
+    await asyncio.gather(*(send_app_emails(app_id, app_jobs) for app_id, app_jobs in by_app.items()))
+    return len(jobs)
+
+
+async def run_worker(stop: asyncio.Event, name: str):
+    conf = settings.OUTBOUND_EMAIL
+    logger.info("Outbound email worker started", extra={"worker": name})
+    while not stop.is_set():
+        try:
+            claimed = await process_batch()
+        except Exception:
+            logger.exception("Outbound email worker failed", extra={"worker": name})
+            claimed = 0
+        if claimed < conf.batch_size:
+            # the queue is drained, poll again later, with jitter so the workers do not poll in lockstep
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=conf.poll_interval * random.uniform(0.5, 1.5))
+            except TimeoutError:
+                pass
+    logger.info("Outbound email worker stopped", extra={"worker": name})
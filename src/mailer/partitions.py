@@ -0,0 +1,148 @@
+"""Monthly range partitioning of the EmailEvent table on `send_time`
+
+Postgres requires the partition key in the primary key, so the partitioned table's key is (id, send_time).
+`id` keeps its own sequence and stays unique, Django keeps treating it as the primary key
+and every query on EmailEvent works unchanged, the month scoped ones only read the matching partitions.
+
+Partitions are named `<table>_pYYYY_MM`, rows outside of every partition land in `<table>_default`.
+"""
+
+from datetime import date, datetime, timezone
+from logging import getLogger
+
+from django.db import connection, transaction
+
+from .models import EmailEvent
+
+logger = getLogger(__name__)
+
+TABLE = EmailEvent._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+LEGACY_TABLE = f"{TABLE}_legacy"
+
+
+def partition_name(month: date) -> str:
+    return f"{TABLE}_p{month.year:04d}_{month.month:02d}"
+
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    year, month_index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return date(year, month_index + 1, 1)
+
+
+def _bound(month: date) -> str:
+    # bounds are generated by us, never from user input
+    return f"'{datetime(month.year, month.month, 1, tzinfo=timezone.utc).isoformat()}'"
+
+
+def is_partitioned() -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [TABLE])
+        row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def partitions() -> list[str]:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname",
+            [TABLE],
+        )
+        return [name for (name,) in cursor.fetchall()]
+
+
+def create_partition(month: date) -> bool:
+    """Create the partition for `month`, moving the rows the default partition holds for it. False if it exists"""
+    name = partition_name(month)
+    if name in partitions():
+        return False
+    lower, upper = _bound(month), _bound(add_months(month, 1))
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+        # attaching fails while the default partition holds rows of the new range
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE send_time >= {lower} AND send_time < {upper} "
+            f"RETURNING *) INSERT INTO {name} SELECT * FROM moved"
+        )
+        cursor.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM ({lower}) TO ({upper})")
+    logger.info("Created EmailEvent partition", extra={"partition": name})
+    return True
+
+
+def create_upcoming_partitions(months_ahead: int, today: date | None = None) -> list[str]:
+    current = month_start(today or date.today())
+    return [
+        partition_name(month)
+        for month in (add_months(current, i) for i in range(months_ahead + 1))
+        if create_partition(month)
+    ]
+
+
+def detach_partitions(older_than: int, archive_schema: str | None = None, drop: bool = False, today=None) -> list[str]:
+    """Detach the partitions of months before `older_than` months ago, then archive or drop them"""
+    cutoff = partition_name(add_months(month_start(today or date.today()), -older_than))
+    detached = [name for name in partitions() if name != DEFAULT_PARTITION and name < cutoff]
+    with transaction.atomic(), connection.cursor() as cursor:
+        if archive_schema:
+            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {archive_schema}")
+        for name in detached:
+            cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+            if drop:
+                cursor.execute(f"DROP TABLE {name}")
+            elif archive_schema:
+                cursor.execute(f"ALTER TABLE {name} SET SCHEMA {archive_schema}")
+    logger.info("Detached EmailEvent partitions", extra={"partitions": detached})
+    return detached
+
+
+def convert_to_partitioned(months_ahead: int = 3, keep_legacy: bool = False):
+    """Rebuild the EmailEvent table as a partitioned table, copying the existing rows.
+    Runs in one transaction and locks the table for the duration of the copy.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {LEGACY_TABLE}")
+        # index names are global to the schema, free them for the new table
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", [LEGACY_TABLE])
+        for (index,) in cursor.fetchall():
+            cursor.execute(f"ALTER INDEX {index} RENAME TO {index[:56]}_legacy")
+
+        cursor.execute(f"CREATE TABLE {TABLE} (LIKE {LEGACY_TABLE} INCLUDING DEFAULTS) PARTITION BY RANGE (send_time)")
+        cursor.execute(f"CREATE SEQUENCE {TABLE}_id_seq_p OWNED BY {TABLE}.id")
+        cursor.execute(
+            f"SELECT setval('{TABLE}_id_seq_p', COALESCE((SELECT max(id) FROM {LEGACY_TABLE}), 0) + 1, false)"
+        )
+        cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{TABLE}_id_seq_p')")
+        cursor.execute(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id, send_time)")
+        cursor.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT")
+
+        cursor.execute(f"SELECT min(send_time) FROM {LEGACY_TABLE}")
+        (oldest,) = cursor.fetchone()
+        month = month_start(oldest.date() if oldest else date.today())
+        last = add_months(month_start(date.today()), months_ahead)
+        while month <= last:
+            cursor.execute(
+                f"CREATE TABLE {partition_name(month)} PARTITION OF {TABLE} "
+                f"FOR VALUES FROM ({_bound(month)}) TO ({_bound(add_months(month, 1))})"
+            )
+            month = add_months(month, 1)
+
+        cursor.execute(f"INSERT INTO {TABLE} SELECT * FROM {LEGACY_TABLE}")
+        if not keep_legacy:
+            cursor.execute(f"DROP TABLE {LEGACY_TABLE}")
+
+        # indexes and the foreign key are built once over the copied rows, on the parent they cascade to every partition
+        with connection.schema_editor() as editor:
+            for index in EmailEvent._meta.indexes:
+                editor.add_index(EmailEvent, index)
+        provider = EmailEvent._meta.get_field("provider")
+        cursor.execute(f"CREATE INDEX ON {TABLE} ({provider.column})")
+        cursor.execute(
+            f"ALTER TABLE {TABLE} ADD FOREIGN KEY ({provider.column}) "
+            f"REFERENCES {provider.related_model._meta.db_table} (id) DEFERRABLE INITIALLY DEFERRED"
+        )
@@ -0,0 +1,58 @@
+"""Warm registry of the SMTP providers
+
+The providers are a handful of rows that only change when one is added. The registry keeps their ids by name and
+one handler per provider, so the webhooks and `switch_provider` resolve a provider without a query and without
+building a handler. It is loaded at startup and reloaded after an SMTPProvider is saved or deleted, from the
+admin, and when it is asked for a name it does not know yet (a provider added by another process).
+"""
+
+from typing import Optional
+
+from config.lifespan import on_startup
+
+from .models import SMTPProvider
+from .smtp_providers import SMTPServiceProvider
+
+
+class ProviderRegistry:
+    def __init__(self):
+        self._ids: Optional[dict[str, int]] = None
+        self._handlers: dict[str, SMTPServiceProvider] = {}
+        self._generation = 0
+
+    async def load(self) -> dict[str, int]:
+        generation = self._generation
+        ids = {name: pk async for name, pk in SMTPProvider.objects.values_list("name", "id")}
+        # a reset while loading means these rows may already be outdated, the next lookup loads again
+        if generation == self._generation:
+            self._ids = ids
+        return ids
+
+    async def start(self):
+        await self.load()
+        for name in SMTPServiceProvider.providers:
+            self.handler(name)
+
+    def reset(self):
+        self._generation += 1
+        self._ids = None
+
+    async def provider_id(self, name: str) -> Optional[int]:
+        ids = self._ids
+        if ids is None or name not in ids:
+            ids = await self.load()
+        return ids.get(name)
+
+    def handler(self, name: str) -> SMTPServiceProvider:
+        """The handler of the provider `name`, raises KeyError if it is not registered or configured"""
+        handler = self._handlers.get(name)
+        if handler is None:
+            handler = self._handlers[name] = SMTPServiceProvider.get_provider(name)
+        return handler
+
+
+provider_registry = ProviderRegistry()
+
+
+def register_lifespan_hooks():
+    on_startup(provider_registry.start)
@@ -1,19 +1,30 @@
+import asyncio
 from datetime import datetime
 from logging import getLogger
+from smtplib import SMTPAuthenticationError, SMTPException
 from typing import Optional
 
-from asgiref.sync import sync_to_async
-from django.core.mail import EmailMultiAlternatives
-from django.core.mail import get_connection
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils import timezone as dj_tz
 import graphene
 from graphene import relay
+from graphene_django import DjangoObjectType
 
 from core.custom_node import CustomNode
-from mailer.dataloaders import AppEmailLoader, AppEmailTotalLoader
 
 from . import models
+from .credentials import credential_cache
 from .smtp_providers import SMTPServiceProvider, SMTPUserNotFound
-from .utils import get_smtp_user_config
+from .utils import (
+    SMTPUserConfig,
+    enforce_hobby_quota,
+    finish_sent_emails,
+    get_active_provider,
+    get_smtp_user_config,
+    send_email,
+    store_within_quota,
+)
 
 
 logger = getLogger(__name__)
@@ -42,20 +53,17 @@ class UserEmails(graphene.ObjectType):
     usage = graphene.List(Usage, group_by=DateBin(required=True), time_window=graphene.List(graphene.Date))
 
     async def resolve_sent_emails_count(parent, info):
-        values = await AppEmailTotalLoader().load_many(
-            [app_id async for app_id in parent.apps.values_list("pk", flat=True)]
-        )
-        return sum(values)
+        loaders = info.context.loaders
+        return sum(await loaders.app_email_total.load_many(await loaders.user_app_ids.load(parent.pk)))
 
     async def resolve_usage(parent, info, group_by, time_window: Optional[list[datetime]] = None):
         if time_window is None:  # a python gatcha
             time_window = []
-        app_ids = await sync_to_async(list)(parent.apps.values_list("pk", flat=True))
-        senders = await sync_to_async(set)(
-            models.EmailProvider.objects.filter(app_id__in=app_ids).values_list("from_address", flat=True)
-        )
+        loaders = info.context.loaders
+        app_providers = await loaders.app_providers.load_many(await loaders.user_app_ids.load(parent.pk))
+        senders = {provider.from_address for providers in app_providers for provider in providers}
         if senders:
-            return await AppEmailLoader().load((tuple(senders), group_by.value, *time_window))
+            return await loaders.app_email.load((tuple(sorted(senders)), group_by.value, *time_window))
 
 
 class AppEmails(graphene.ObjectType):
@@ -70,15 +78,15 @@ class AppEmails(graphene.ObjectType):
         raise ValueError("get_node")
 
     async def resolve_total_emails_count(parent, info):
-        return await AppEmailTotalLoader().load(parent.pk)
+        return await info.context.loaders.app_email_total.load(parent.pk)
 
     async def resolve_usage(parent, info, group_by, time_window: Optional[list[datetime]] = None):
         if time_window is None:  # a python gotcha
             time_window = []
         # TODO: switch to app_id, or not?!
-        app = await parent.emailprovider_set.filter(active=True).only("from_address").afirst()
-        if app:
-            return await AppEmailLoader().load(((app.from_address,), group_by.value, *time_window))
+        active = await info.context.loaders.active_provider.load(parent.pk)
+        if active:
+            return await info.context.loaders.app_email.load(((active.from_address,), group_by.value, *time_window))
 
 
 class AppEmailsConnection(relay.Connection):
@@ -102,6 +110,8 @@ class getSMTPCredentials(graphene.Mutation):
 
 
 class sendEmail(graphene.Mutation):
+    """Queue an email, `outboundEmail(id: jobId)` follows its delivery"""
+
     class Arguments:
         app_id = graphene.String(required=True)
         to = graphene.String(required=True)
@@ -109,35 +119,130 @@ class sendEmail(graphene.Mutation):
         html = graphene.String(required=True)
 
     successful = graphene.Boolean()
+    job_id = graphene.ID()
 
     async def mutate(root, info, app_id, to, subject, html):
+        app_id = CustomNode.from_global_id(app_id)[1]
+        active = await get_active_provider(app_id)
+        _, stored = await store_within_quota(
+            app_id, active.from_address, [models.OutboundEmail(app_id=app_id, to=to, subject=subject, html=html)]
+        )
+        if not stored:
+            raise SMTPUserNotFound("Monthly quota reached")
+        job = stored[0]
+        return sendEmail(successful=True, job_id=job.pk)
+
+
+class EmailMessageInput(graphene.InputObjectType):
+    to = graphene.String(required=True)
+    subject = graphene.String(required=True)
+    html = graphene.String(required=True)
+
+
+class SendEmailResult(graphene.ObjectType):
+    to = graphene.String()
+    successful = graphene.Boolean()
+    error = graphene.String()
+
+
+class sendEmails(graphene.Mutation):
+    """Send many emails from one app, the results are in the order of `messages`"""
+
+    class Arguments:
+        app_id = graphene.String(required=True)
+        messages = graphene.List(graphene.NonNull(EmailMessageInput), required=True)
+
+    sent = graphene.Int()
+    results = graphene.List(SendEmailResult)
+
+    async def mutate(root, info, app_id, messages):
         app_id = CustomNode.from_global_id(app_id)[1]
         credentials = await get_smtp_user_config(app_id)
-        msg = EmailMultiAlternatives(
-            subject=subject,
-            body=html,
-            from_email=credentials.from_address,
-            to=[to],
-            connection=get_connection(
-                backend="django.core.mail.backends.smtp.EmailBackend",
-                host=credentials.host,
-                port=credentials.port,
-                username=credentials.username,
-                password=credentials.password,
-                use_tls=True,
-            ),
+
+        # hobby apps send what is left of their quota, the rest of the batch is refused. The batch is stored as
+        # sending, so the other sends of the app count it until it is done
+        remaining, allowed = await store_within_quota(
+            app_id,
+            credentials.from_address,
+            [
+                models.OutboundEmail(
+                    app_id=app_id,
+                    to=message.to,
+                    subject=message.subject,
+                    html=message.html,
+                    status=models.OutboundEmailStatus.SENDING,
+                    attempts=1,
+                    locked_at=dj_tz.now(),
+                )
+                for message in messages
+            ],
         )
+        errors: list[Optional[BaseException]] = await send_concurrently(credentials, allowed)
+
+        stale = [i for i, error in enumerate(errors) if isinstance(error, SMTPAuthenticationError)]
+        if stale:
+            # the cached credentials may be stale, ask the provider again once
+            credential_cache.invalidate(credentials.provider, credentials.external_id)
+            credentials = await get_smtp_user_config(app_id)
+            for i, error in zip(stale, await send_concurrently(credentials, [allowed[i] for i in stale])):
+                errors[i] = error
+
+        await finish_sent_emails(allowed, errors)
+        sent = errors.count(None)
+        if remaining is not None and sent:
+            # the webhooks count these sends later, if the batch used up the quota stop the next sends now
+            await enforce_hobby_quota(credentials.from_address, settings.HOBBY_MONTHLY_EMAIL_LIMIT - remaining + sent)
+
+        results = [
+            SendEmailResult(to=message.to, successful=error is None, error=str(error) if error else None)
+            for message, error in zip(allowed, errors)
+        ]
+        results += [
+            SendEmailResult(to=message.to, successful=False, error="Monthly quota reached")
+            for message in messages[len(allowed) :]
+        ]
+        return sendEmails(sent=sent, results=results)
+
+
+async def send_concurrently(credentials: SMTPUserConfig, messages) -> list[Optional[BaseException]]:
+    """Send every message on its own, over at most `SMTP_POOL.size` connections. The error of each, or None"""
+    slots = asyncio.Semaphore(settings.SMTP_POOL.size)
+
+    async def send(message) -> Optional[BaseException]:
+        async with slots:
+            try:
+                await send_email(credentials, message.to, message.subject, message.html)
+            except (SMTPException, OSError) as e:
+                logger.warning("Failed to send an email", extra={"to": message.to, "error": repr(e)})
+                return e
+        return None
+
+    return await asyncio.gather(*(send(message) for message in messages))
+
+
+class OutboundEmail(DjangoObjectType):
+    class Meta:
+        model = models.OutboundEmail
+        fields = ["id", "to", "status", "attempts", "next_attempt_at", "last_error", "created_at", "sent_at"]
+
+
+class Query(graphene.ObjectType):
+    outbound_email = graphene.Field(OutboundEmail, id=graphene.ID(required=True))
 
-        msg.attach_alternative(html, "text/html")
-        msg.send()
-        return sendEmail(successful=True)
+    async def resolve_outbound_email(root, info, id):
+        try:
+            return await models.OutboundEmail.objects.aget(pk=id)
+        except (models.OutboundEmail.DoesNotExist, ValidationError):
+            return None
 
 
 class Mutation(graphene.ObjectType):
     getSMTP_credentials = getSMTPCredentials.Field()
     send_email = sendEmail.Field()
+    send_emails = sendEmails.Field()
 
 
 schema = graphene.Schema(
+    query=Query,
     mutation=Mutation,
 )
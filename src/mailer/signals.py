@@ -0,0 +1,18 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import models
+from .active_provider import active_providers
+from .provider_registry import provider_registry
+
+
+@receiver([post_save, post_delete], sender=models.EmailProvider)
+def invalidate_active_provider(sender, instance, **kwargs):
+    # saves from the admin and new providers, the bulk updates invalidate themselves
+    transaction.on_commit(lambda: active_providers.invalidate(instance.app_id))
+
+
+@receiver([post_save, post_delete], sender=models.SMTPProvider)
+def reload_provider_registry(sender, instance, **kwargs):
+    transaction.on_commit(provider_registry.reset)
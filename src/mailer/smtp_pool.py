@@ -0,0 +1,182 @@
+"""Pooled SMTP sessions
+
+Opening an SMTP connection costs a TCP connect, the TLS handshake and the login before the first message.
+The pools keep authenticated sessions per (host, port, username) and reuse them for the next sends.
+smtplib blocks, so every SMTP dialogue runs in a worker thread, off the event loop.
+
+A pool never makes a send wait for a free connection, it opens a new one. Only `size` idle sessions are kept,
+the callers bound the concurrency. Sessions idle for longer than `max_idle` or older than `max_age` are closed
+instead of reused. Providers drop idle clients, and a reused session the server already closed is replaced
+and the send retried once.
+"""
+
+from dataclasses import dataclass, field
+from logging import getLogger
+from smtplib import SMTPServerDisconnected
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.core.mail.backends.smtp import EmailBackend
+
+from config.lifespan import on_shutdown
+
+logger = getLogger(__name__)
+
+
+@dataclass
+class PooledConnection:
+    backend: EmailBackend
+    created_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class SMTPConnectionPool:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        *,
+        use_tls: bool = True,
+        size: int = 4,
+        max_idle: float = 30.0,
+        max_age: float = 300.0,
+        timeout: float = 10.0,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.size = size
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.timeout = timeout
+        self._idle: list[PooledConnection] = []
+        # the connections are checked in and out from worker threads
+        self._lock = threading.Lock()
+
+    async def send_messages(self, messages: list[EmailMessage]) -> int:
+        return await sync_to_async(self._send_messages, thread_sensitive=False)(messages)
+
+    def _send_messages(self, messages: list[EmailMessage]) -> int:
+        connection, reused = self._checkout()
+        try:
+            sent = connection.backend.send_messages(messages)
+        except SMTPServerDisconnected:
+            self._discard(connection)
+            if not reused:
+                raise
+            # the server closed the session while it was idle in the pool
+            connection = self._connect()
+            try:
+                sent = connection.backend.send_messages(messages)
+            except Exception:
+                self._discard(connection)
+                raise
+        except Exception:
+            # the session may be in the middle of a transaction, do not hand it to another send
+            self._discard(connection)
+            raise
+        self._checkin(connection)
+        return sent
+
+    def _checkout(self) -> tuple[PooledConnection, bool]:
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                return self._connect(), False
+            if now - connection.last_used < self.max_idle and now - connection.created_at < self.max_age:
+                return connection, True
+            self._discard(connection)
+
+    def _checkin(self, connection: PooledConnection):
+        connection.last_used = time.monotonic()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        self._discard(connection)
+
+    def _connect(self) -> PooledConnection:
+        backend = EmailBackend(
+            host=self.host,
+            port=self.port,
+            username=self.username,
+            password=self.password,
+            use_tls=self.use_tls,
+            timeout=self.timeout,
+            fail_silently=False,
+        )
+        # opened here, send_messages leaves the connections it did not open itself open
+        backend.open()
+        return PooledConnection(backend)
+
+    def _discard(self, connection: PooledConnection):
+        try:
+            connection.backend.close()
+        except Exception:
+            logger.debug("Error closing an SMTP connection", exc_info=True)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._discard(connection)
+
+
+class SMTPPools:
+    def __init__(self, conf=None):
+        self.conf = conf or settings.SMTP_POOL
+        self._pools: dict[tuple[str, int, str], SMTPConnectionPool] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str, port: int, username: str, password: str) -> SMTPConnectionPool:
+        key = (host, port, username)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None and pool.password == password:
+                return pool
+            # new credentials, the sessions logged in with the old ones go
+            self._pools[key] = new_pool = SMTPConnectionPool(
+                host,
+                port,
+                username,
+                password,
+                use_tls=self.conf.use_tls,
+                size=self.conf.size,
+                max_idle=self.conf.max_idle,
+                max_age=self.conf.max_age,
+                timeout=self.conf.timeout,
+            )
+        if pool is not None:
+            pool.close()
+        return new_pool
+
+    async def send_messages(self, credentials, messages: list[EmailMessage]) -> int:
+        """Send `messages` with the SMTP account of `credentials`, a `SMTPUserConfig`"""
+        return await sync_to_async(self._send_messages, thread_sensitive=False)(credentials, messages)
+
+    def _send_messages(self, credentials, messages: list[EmailMessage]) -> int:
+        # replacing a pool closes its sessions, in this worker thread too
+        pool = self.get(credentials.host, credentials.port, credentials.username, credentials.password)
+        return pool._send_messages(messages)
+
+    async def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            await sync_to_async(pool.close, thread_sensitive=False)()
+
+
+smtp_pools = SMTPPools()
+
+
+def register_lifespan_hooks():
+    on_shutdown(smtp_pools.close)
@@ -0,0 +1,126 @@
+"""One long-lived httpx client per provider
+
+Every call to a provider's API reuses the pooled keep-alive connections of that provider's client instead of
+paying DNS, TCP and TLS handshakes. The clients are opened at ASGI startup and closed at shutdown, a client
+asked for before startup (management commands, servers without lifespan) is opened on first use.
+
+A client only works on the event loop that opened it: asked for from another loop it is replaced, and the old one
+is closed on its own loop if that loop still runs. A loop that is gone cannot close anything, its client is
+dropped and its sockets are closed when it is collected.
+"""
+
+import asyncio
+from logging import getLogger
+import random
+
+from django.conf import settings
+import httpx
+
+from config.lifespan import on_shutdown, on_startup
+
+logger = getLogger(__name__)
+
+RETRY_STATUSES = {429, 502, 503, 504}
+# the request never reached the provider, safe to retry even when it is not idempotent
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class ProviderClients:
+    def __init__(self, conf=None):
+        self.conf = conf or settings.PROVIDER_HTTP
+        # a client's connections belong to the event loop that opened them, under WSGI every request has its own
+        self._clients: dict[str, tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = {}
+
+    def new_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.conf.max_connections,
+                max_keepalive_connections=self.conf.max_keepalive_connections,
+                keepalive_expiry=self.conf.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(self.conf.timeout, connect=self.conf.connect_timeout),
+            http2=self.conf.http2,
+        )
+
+    def get(self, provider: str) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client_loop, client = self._clients.get(provider, (None, None))
+        if client is None or client.is_closed or client_loop is not loop:
+            if client is not None:
+                self._discard(client_loop, client)
+            client = self.new_client()
+            self._clients[provider] = (loop, client)
+        return client
+
+    @staticmethod
+    def _discard(client_loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient):
+        """Close a client replaced because it belongs to another loop, without waiting for it"""
+        if not client.is_closed and client_loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.aclose(), client_loop)
+
+    async def start(self):
+        for provider in settings.STMP_PROVIDERS:
+            self.get(provider)
+        logger.info("Provider HTTP clients started", extra={"providers": list(self._clients)})
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        loop = asyncio.get_running_loop()
+        for client_loop, client in clients.values():
+            if client.is_closed:
+                continue
+            if client_loop is loop:
+                await client.aclose()
+            elif client_loop.is_running():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(client.aclose(), client_loop))
+        logger.info("Provider HTTP clients closed")
+
+    async def request(
+        self, provider: str, method: str, url: str, *, idempotent: bool = True, **kwargs
+    ) -> httpx.Response:
+        return await request_with_retry(
+            self.get(provider),
+            method,
+            url,
+            retries=self.conf.retries,
+            backoff=self.conf.backoff,
+            idempotent=idempotent,
+            **kwargs,
+        )
+
+
+async def request_with_retry(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    *,
+    retries: int,
+    backoff: float,
+    idempotent: bool = True,
+    **kwargs,
+) -> httpx.Response:
+    """Send a request, retrying transient failures with exponential backoff and jitter.
+    Requests that are not `idempotent` are only retried when they were never sent
+    """
+    retryable = httpx.TransportError if idempotent else NOT_SENT_ERRORS
+    for attempt in range(retries + 1):
+        last_attempt = attempt == retries
+        try:
+            resp = await client.request(method, url, **kwargs)
+        except retryable as e:
+            if last_attempt:
+                raise
+            logger.warning("Provider request failed, retrying", extra={"url": url, "error": repr(e)})
+        else:
+            if last_attempt or resp.status_code not in RETRY_STATUSES or not idempotent:
+                return resp
+            logger.warning("Provider request answered %s, retrying", resp.status_code, extra={"url": url})
+        await asyncio.sleep(backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+
+provider_clients = ProviderClients()
+
+
+def register_lifespan_hooks():
+    on_startup(provider_clients.start)
+    on_shutdown(provider_clients.close)
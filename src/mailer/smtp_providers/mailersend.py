@@ -27,7 +27,8 @@ class MailersendProvider(SMTPServiceProvider):
         self.webhook_token = webhook_token
 
     def users_url(self, user_id: str):
-        return f"""https://api.mailersend.com/v1/domains/{settings.STMP_PROVIDERS["mailersend"].domain_id}/smtp-users/{user_id}"""
+        conf = settings.STMP_PROVIDERS["mailersend"]
+        return f"{conf.api_url}/domains/{conf.domain_id}/smtp-users/{user_id}"
 
     def gen_headers(self):
         return {
@@ -22,7 +22,7 @@ class SMTP2GoProvider(SMTPServiceProvider):
         self.webhook_token = webhook_token
 
     def users_url(self, *_):
-        return "https://api.smtp2go.com/v3/users/smtp/view"
+        return f"{settings.STMP_PROVIDERS['smtp2go'].api_url}/users/smtp/view"
 
     def gen_headers(self):
         return {
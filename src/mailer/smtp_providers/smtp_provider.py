@@ -2,7 +2,8 @@ from enum import Enum
 from logging import getLogger
 
 from django.conf import settings
-import httpx
+
+from .http import provider_clients
 
 
 class ProviderEmailEvent(Enum):
@@ -25,10 +26,13 @@ class SMTPServiceProvider:
     """Inherith this class to implement a specific SMTP provider"""
 
     providers = {}
+    name = None
     webhook_token = None
 
     @classmethod
     def register(cls, **kwargs):
+        for name, provider in kwargs.items():
+            provider.name = name
         cls.providers.update(kwargs)
 
     @classmethod
@@ -59,32 +63,48 @@ class SMTPServiceProvider:
     def parse_webhook(self, data: dict):
         raise NotImplementedError
 
+    @classmethod
+    def parse_webhook_batch(cls, payloads: list[dict]) -> tuple[list[dict], int]:
+        """Parse a batched callback, skipping the events we ignore and the duplicates a provider retry can add.
+        A malformed event is logged and rejected on its own, returns the events and the number rejected
+        """
+        events, rejected = {}, 0
+        for index, payload in enumerate(payloads):
+            try:
+                event = cls.parse_webhook(payload)
+            except Exception:
+                rejected += 1
+                logger.warning(
+                    "Invalid webhook event",
+                    exc_info=True,
+                    extra={"provider": cls.name, "index": index, "event": payload},
+                )
+                continue
+            if event:
+                events.setdefault((event["message_id"], event["event"], tuple(event["recipients"])), event)
+        return list(events.values()), rejected
+
     async def get_user_credentials(self, user_id: str) -> dict[str, str]:
         method, url, headers, body = self.get_credentials_request(user_id)
-        async with httpx.AsyncClient() as client:
-            resp = await client.request(
-                method=method,
-                url=url,
-                headers=headers,
-                json=body,
-            )
-            if resp.status_code != 200:
-                logger.error(resp.json())
-                if resp.status_code == 404:
-                    raise SMTPUserNotFound("User not found")
-                else:
-                    raise ValueError("Error looking up user credentials", resp.status_code, self.__class__)
-            return self.parse_credentials(resp.json(), user_id)
+        resp = await provider_clients.request(self.name, method, url, headers=headers, json=body)
+        if resp.status_code != 200:
+            logger.error(resp.json())
+            if resp.status_code == 404:
+                raise SMTPUserNotFound("User not found")
+            else:
+                raise ValueError("Error looking up user credentials", resp.status_code, self.__class__)
+        return self.parse_credentials(resp.json(), user_id)
 
     async def create_smtp_user(self, user_id: str):
-        async with httpx.AsyncClient() as client:
-            resp = await client.request(
-                method=self.method,
-                url=self.users_url(user_id),
-                headers=self.gen_headers(),
-                json=self.gen_body(user_id),
-            )
-            if resp.status_code != 200:
-                logger.error(resp.json())
-                raise ValueError("Error looking up user credentials", resp.status_code, self.__class__)
-            return self.parse_credentials(resp.json(), user_id)
+        resp = await provider_clients.request(
+            self.name,
+            self.method,
+            self.users_url(user_id),
+            headers=self.gen_headers(),
+            json=self.gen_body(user_id),
+            idempotent=self.method == "GET",
+        )
+        if resp.status_code != 200:
+            logger.error(resp.json())
+            raise ValueError("Error looking up user credentials", resp.status_code, self.__class__)
+        return self.parse_credentials(resp.json(), user_id)
@@ -1,3 +1,1006 @@
-from django.test import TestCase
+import asyncio
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
+import threading
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone as dj_tz
+import httpx
+import msgspec
+
+from core.models import DeployedApp, User
+
+from . import models, partitions
+from .active_provider import ActiveProviderCache, active_providers
+from .credentials import CredentialCache
+from .dataloaders import AppEmailLoader, AppEmailTotalLoader
+from .ingestion import IngestionQueueFull, WebhookEventQueue
+from .management.commands.generate_email_events import Distribution, copy_events
+from .management.commands.rebuild_usage_counters import rebuild_usage_counters
+from .management.commands.rollup_email_usage import rollup_email_usage
+from .outbound import process_batch
+from .provider_registry import ProviderRegistry, provider_registry
+from .smtp_pool import PooledConnection, SMTPConnectionPool
+from .smtp_providers import SMTPUserNotFound
+from .smtp_providers.http import ProviderClients, request_with_retry
+from .utils import (
+    SMTPUserConfig,
+    billing_cycle_of,
+    enforce_hobby_quota,
+    get_smtp_user_config,
+    store_email_events,
+    this_billing_cycle,
+)
+
+
+class HotQueryIndexTests(TestCase):
+    """The hot queries must be answered by an index, not by scanning the events table"""
+
+    sender = "sender@nicedomain.com"
+
+    def setUp(self):
+        # the test tables are tiny, forbid sequential scans so the planner shows the index it would use
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertUsesIndex(self, queryset, index_name: str):
+        plan = queryset.explain()
+        self.assertNotIn("Seq Scan", plan)
+        self.assertIn(index_name, plan)
+
+    def test_monthly_sent_count(self):
+        now = dj_tz.now()
+        self.assertUsesIndex(
+            models.EmailEvent.objects.filter(
+                event=models.EmailEventChoices.SENT.value,
+                send_time__gte=now.replace(day=1),
+                send_time__lte=now,
+                from_address__in=[self.sender],
+            ),
+            "emailevent_sent_sender_idx",
+        )
+
+    def test_total_sent_count(self):
+        self.assertUsesIndex(
+            models.EmailEvent.objects.filter(from_address=self.sender, event=models.EmailEventChoices.SENT),
+            "emailevent_sent_sender_idx",
+        )
+
+    def test_usage_from_events(self):
+        now = dj_tz.now()
+        self.assertUsesIndex(
+            models.EmailEvent.usage_from_events((self.sender,), "week", now - timedelta(days=90), now),
+            "emailevent_sender_time_idx",
+        )
+
+    def test_usage_from_rollups(self):
+        now = dj_tz.now()
+        self.assertUsesIndex(
+            models.DailyEmailUsage.usage((self.sender,), "month", now - timedelta(days=90), now),
+            "unique_sender_day_event",
+        )
+
+
+class PartitionPruningTests(TestCase):
+    """Month scoped queries on the partitioned events table only read the matching partitions"""
+
+    sender = "sender@nicedomain.com"
+
+    @classmethod
+    def setUpTestData(cls):
+        partitions.convert_to_partitioned(months_ahead=1)
+        cls.this_month = partitions.month_start(dj_tz.localdate())
+        for months in (-2, -1):
+            partitions.create_partition(partitions.add_months(cls.this_month, months))
+
+    def assertOnlyScans(self, queryset, partition: str):
+        plan = queryset.explain()
+        self.assertIn(partition, plan)
+        for other in partitions.partitions():
+            if other != partition:
+                self.assertNotIn(other, plan)
+
+    def test_monthly_sent_count(self):
+        now = dj_tz.now()
+        self.assertOnlyScans(
+            models.EmailEvent.objects.filter(
+                event=models.EmailEventChoices.SENT.value,
+                send_time__gte=now.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+                send_time__lte=now,
+                from_address__in=[self.sender],
+            ),
+            partitions.partition_name(self.this_month),
+        )
+
+    def test_usage_from_events(self):
+        last_month = partitions.add_months(self.this_month, -1)
+        self.assertOnlyScans(
+            models.EmailEvent.usage_from_events(
+                (self.sender,),
+                "day",
+                datetime.combine(last_month, time(), dt_timezone.utc),
+                datetime.combine(self.this_month, time(), dt_timezone.utc),
+            ),
+            partitions.partition_name(last_month),
+        )
+
+    def test_new_events_land_in_their_partition(self):
+        event = models.EmailEvent.objects.create(
+            provider=models.SMTPProvider.objects.create(name="smtp2go", verified_domain="nicedomain.com"),
+            event=models.EmailEventChoices.SENT.value,
+            event_time=dj_tz.now(),
+            send_time=dj_tz.now(),
+            message_id="message",
+            from_address=self.sender,
+            recipients=["someone@example.com"],
+        )
+        self.assertIsNotNone(event.pk)
+        self.assertEqual(models.EmailEvent.objects.get(pk=event.pk).from_address, self.sender)
+
+
+class AppEmailTotalLoaderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create(username="owner", full_name="Owner")
+        provider = models.SMTPProvider.objects.create(name="smtp2go", verified_domain="nicedomain.com")
+        cls.app_ids = []
+        for i in range(6):
+            app = DeployedApp.objects.create(owner=owner, name=f"app {i}")
+            cls.app_ids.append(app.pk)
+            models.EmailProvider.objects.create(
+                app=app, provider=provider, active=True, from_address=f"sender.{i}@nicedomain.com"
+            )
+            models.EmailEvent.objects.bulk_create(
+                models.EmailEvent(
+                    provider=provider,
+                    event=event,
+                    event_time=dj_tz.now(),
+                    send_time=dj_tz.now(),
+                    message_id=f"message {i}",
+                    from_address=f"sender.{i}@nicedomain.com",
+                    recipients=["someone@example.com"],
+                )
+                for event in [models.EmailEventChoices.SENT] * i + [models.EmailEventChoices.DELIVERED]
+            )
+        cls.app_without_provider = DeployedApp.objects.create(owner=owner, name="no provider").pk
+
+    def load_many(self, keys):
+        # a DataLoader is bound to the loop it was created in
+        async def load():
+            return await AppEmailTotalLoader().load_many(keys)
+
+        return async_to_sync(load)()
+
+    def test_counts_sent_emails(self):
+        self.assertEqual(self.load_many(self.app_ids), [0, 1, 2, 3, 4, 5])
+
+    def test_app_without_provider(self):
+        self.assertEqual(self.load_many([self.app_without_provider, self.app_ids[1]]), [0, 1])
+
+    def test_query_count_does_not_grow_with_apps(self):
+        for count in (1, 3, len(self.app_ids)):
+            with self.assertNumQueries(1):
+                self.load_many(self.app_ids[:count])
+
+
+class AppEmailLoaderTests(TestCase):
+    senders = ("first@nicedomain.com", "second@nicedomain.com")
+    window = (date(2025, 1, 1), date(2025, 3, 1))
+
+    @classmethod
+    def setUpTestData(cls):
+        models.DailyEmailUsage.objects.bulk_create(
+            models.DailyEmailUsage(from_address=sender, day=day, event=models.EmailEventChoices.SENT, count=count)
+            for sender, day, count in [
+                (cls.senders[0], date(2025, 1, 10), 1),
+                (cls.senders[0], date(2025, 2, 10), 2),
+                (cls.senders[1], date(2025, 2, 11), 4),
+                (cls.senders[1], date(2025, 3, 1), 8),  # outside of the window
+            ]
+        )
+
+    def load_many(self, keys):
+        async def load():
+            return await AppEmailLoader().load_many(keys)
+
+        return async_to_sync(load)()
+
+    def sent(self, usage):
+        return [(stats["timestamp"], stats["emails"]["total"]) for stats in usage]
+
+    def test_one_query_per_bin_and_window(self):
+        keys = [
+            ((self.senders[0],), "month", *self.window),
+            ((self.senders[1],), "month", *self.window),
+            (self.senders, "month", *self.window),
+            ((self.senders[1],), "month", self.window[0], date(2025, 4, 1)),
+            ((self.senders[0],), "day", *self.window),
+        ]
+        with self.assertNumQueries(3):
+            first, second, both, longer, daily = self.load_many(keys)
+
+        self.assertEqual(self.sent(first), [(date(2025, 1, 1), 1), (date(2025, 2, 1), 2)])
+        self.assertEqual(self.sent(second), [(date(2025, 2, 1), 4)])
+        self.assertEqual(self.sent(both), [(date(2025, 1, 1), 1), (date(2025, 2, 1), 6)])
+        self.assertEqual(self.sent(longer), [(date(2025, 2, 1), 4), (date(2025, 3, 1), 8)])
+        self.assertEqual(self.sent(daily), [(date(2025, 1, 10), 1), (date(2025, 2, 10), 2)])
+
+    def test_sender_without_usage(self):
+        self.assertEqual(self.load_many([(("nobody@nicedomain.com",), "week", *self.window)]), [[]])
+
+
+class RequestWithRetryTests(SimpleTestCase):
+    def send(self, statuses: list[int], method="GET", idempotent=True) -> tuple[int, int]:
+        responses = iter(statuses)
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(next(responses))
+
+        async def send():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                resp = await request_with_retry(
+                    client, method, "http://provider/api", retries=2, backoff=0, idempotent=idempotent
+                )
+            return resp.status_code
+
+        return async_to_sync(send)(), len(calls)
+
+    def test_retries_transient_statuses(self):
+        self.assertEqual(self.send([503, 502, 200]), (200, 3))
+
+    def test_gives_up_after_the_retries(self):
+        self.assertEqual(self.send([503, 503, 503, 200]), (503, 3))
+
+    def test_does_not_retry_client_errors(self):
+        self.assertEqual(self.send([404, 200]), (404, 1))
+
+    def test_does_not_resend_non_idempotent_requests(self):
+        self.assertEqual(self.send([503, 200], method="POST", idempotent=False), (503, 1))
+
+
+class ProviderClientsTests(SimpleTestCase):
+    def setUp(self):
+        self.clients = ProviderClients()
+
+    def start_loop(self) -> asyncio.AbstractEventLoop:
+        """An event loop running in another thread, like the one of another request"""
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+        self.addCleanup(stop)
+        return loop
+
+    def get_on(self, loop: asyncio.AbstractEventLoop) -> httpx.AsyncClient:
+        async def get():
+            return self.clients.get("smtp2go")
+
+        return asyncio.run_coroutine_threadsafe(get(), loop).result()
+
+    def test_reuses_the_client_of_the_loop(self):
+        async def get_twice():
+            return self.clients.get("smtp2go"), self.clients.get("smtp2go")
+
+        first, second = async_to_sync(get_twice)()
+        self.assertIs(first, second)
+
+    def test_replaced_client_is_closed_on_its_loop(self):
+        loop = self.start_loop()
+        old = self.get_on(loop)
+
+        async def get():
+            return self.clients.get("smtp2go")
+
+        self.assertIsNot(async_to_sync(get)(), old)
+        for _ in range(100):
+            if old.is_closed:
+                break
+            # let the other loop run the close
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0.01), loop).result()
+        self.assertTrue(old.is_closed)
+
+    def test_client_of_a_closed_loop_is_dropped(self):
+        async def get():
+            return self.clients.get("smtp2go")
+
+        loop = asyncio.new_event_loop()
+        old = loop.run_until_complete(get())
+        loop.close()
+        self.assertIsNot(async_to_sync(get)(), old)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(get())
+        loop.close()
+        async_to_sync(self.clients.close)()
+        self.assertEqual(self.clients._clients, {})
+
+    def test_close_reaches_the_clients_of_other_loops(self):
+        other = self.get_on(self.start_loop())
+        async_to_sync(self.clients.close)()
+        self.assertTrue(other.is_closed)
+
+
+class CredentialCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = 0
+
+    async def fetch(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return {"username": "user", "password": f"password {self.calls}"}
+
+    def get_many(self, cache: CredentialCache, count: int) -> list[dict]:
+        async def get_many():
+            return await asyncio.gather(*(cache.get("smtp2go", "app", self.fetch) for _ in range(count)))
+
+        return async_to_sync(get_many)()
+
+    def test_concurrent_misses_share_one_call(self):
+        cache = CredentialCache(ttl=60)
+        credentials = self.get_many(cache, 20)
+        self.get_many(cache, 20)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual({c["password"] for c in credentials}, {"password 1"})
+
+    def test_invalidate(self):
+        cache = CredentialCache(ttl=60)
+        self.get_many(cache, 1)
+        cache.invalidate("smtp2go", "app")
+        self.assertEqual(self.get_many(cache, 1), [{"username": "user", "password": "password 2"}])
+
+    def test_expires(self):
+        cache = CredentialCache(ttl=0)
+        self.get_many(cache, 1)
+        self.get_many(cache, 1)
+        self.assertEqual(self.calls, 2)
+
+    def test_failures_are_not_cached(self):
+        cache = CredentialCache(ttl=60)
+
+        async def fail():
+            raise SMTPUserNotFound("User not found")
+
+        with self.assertRaises(SMTPUserNotFound):
+            async_to_sync(cache.get)("smtp2go", "app", fail)
+        self.get_many(cache, 1)
+        self.assertEqual(self.calls, 1)
+
+
+class ActiveProviderCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create(username="hobbyist", full_name="Hobbyist")
+        cls.smtp2go = models.SMTPProvider.objects.create(name="smtp2go", verified_domain="nicedomain.com")
+        cls.mailjet = models.SMTPProvider.objects.create(name="mailjet", verified_domain="nicedomain.com")
+        cls.app = DeployedApp.objects.create(owner=owner, name="app")
+        cls.idle = DeployedApp.objects.create(owner=owner, name="idle")
+        models.EmailProvider.objects.create(
+            app=cls.app, provider=cls.smtp2go, active=True, from_address="a@nicedomain.com", external_id="a"
+        )
+        models.EmailProvider.objects.create(
+            app=cls.app, provider=cls.mailjet, from_address="b@nicedomain.com", external_id="b"
+        )
+
+    def setUp(self):
+        self.cache = ActiveProviderCache(ttl=60, max_entries=100, send_ttl=1)
+
+    def test_hits_do_not_query(self):
+        with self.assertNumQueries(1):
+            first = async_to_sync(self.cache.get_many)([self.app.pk, self.idle.pk])
+        with self.assertNumQueries(0):
+            second = async_to_sync(self.cache.get_many)([self.app.pk, self.idle.pk])
+        self.assertEqual(first, second)
+        self.assertEqual(first[self.app.pk].provider_name, "smtp2go")
+        self.assertIsNone(first[self.idle.pk])
+
+    def test_switch_provider_invalidates(self):
+        async_to_sync(self.cache.get)(self.app.pk)
+        with (
+            mock.patch("mailer.models.active_providers", self.cache),
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            async_to_sync(models.EmailProvider.switch_provider)(self.app.pk, self.mailjet.pk)
+        self.assertEqual(async_to_sync(self.cache.get)(self.app.pk).from_address, "b@nicedomain.com")
+
+    def test_load_racing_an_invalidation_is_not_stored(self):
+        load = self.cache._load
+
+        async def load_then_switch(app_ids):
+            loaded = await load(app_ids)
+            self.cache.invalidate(self.app.pk)  # the switch commits while the old row is on its way
+            return loaded
+
+        with mock.patch.object(self.cache, "_load", load_then_switch):
+            async_to_sync(self.cache.get)(self.app.pk)
+        self.assertNotIn(self.app.pk, self.cache._entries)
+        # the versions are only kept while a load is in flight
+        self.assertEqual(self.cache._versions, {})
+
+    def test_keeps_the_recently_used_apps(self):
+        cache = ActiveProviderCache(ttl=60, max_entries=1, send_ttl=1)
+        async_to_sync(cache.get)(self.app.pk)
+        async_to_sync(cache.get)(self.idle.pk)
+        self.assertEqual(list(cache._entries), [self.idle.pk])
+
+    def test_quota_maxing_invalidates(self):
+        with mock.patch("mailer.utils.active_providers", self.cache):
+            async_to_sync(self.cache.get)(self.app.pk)
+            async_to_sync(enforce_hobby_quota)("a@nicedomain.com", settings.HOBBY_MONTHLY_EMAIL_LIMIT)
+            with self.assertRaisesMessage(SMTPUserNotFound, "reached a quota limit"):
+                async_to_sync(get_smtp_user_config)(self.app.pk)
+
+    def test_send_path_sees_the_changes_of_other_processes(self):
+        locmem = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+        other_process = ActiveProviderCache(ttl=60, max_entries=100, send_ttl=1, shared_alias="loaders")
+        self.cache.shared_alias = "loaders"
+        with self.settings(CACHES={"default": locmem, "loaders": locmem}):
+            async_to_sync(self.cache.get_current)(self.app.pk)
+            with self.assertNumQueries(0):
+                self.assertIsNone(async_to_sync(self.cache.get_current)(self.app.pk).maxed_quota_for)
+
+            # another process maxed the quota, its invalidation replaces the shared token
+            models.EmailProvider.objects.filter(app=self.app).update(maxed_quota_for=this_billing_cycle())
+            other_process.invalidate(self.app.pk)
+            with mock.patch("mailer.utils.active_providers", self.cache):
+                with self.assertRaisesMessage(SMTPUserNotFound, "reached a quota limit"):
+                    async_to_sync(get_smtp_user_config)(self.app.pk)
+            with self.assertNumQueries(0):
+                self.assertEqual(async_to_sync(self.cache.get)(self.app.pk).maxed_quota_for, this_billing_cycle())
+
+    def test_send_path_trusts_its_copy_for_send_ttl(self):
+        async_to_sync(self.cache.get_current)(self.app.pk)
+        # another process maxed the quota, without a shared cache its invalidation does not reach this one
+        models.EmailProvider.objects.filter(app=self.app).update(maxed_quota_for=this_billing_cycle())
+        with self.assertNumQueries(0):
+            self.assertIsNone(async_to_sync(self.cache.get_current)(self.app.pk).maxed_quota_for)
+        trusted_until = self.cache._entries[self.app.pk][1]
+        with mock.patch("mailer.active_provider.time.monotonic", return_value=trusted_until):
+            self.assertEqual(async_to_sync(self.cache.get_current)(self.app.pk).maxed_quota_for, this_billing_cycle())
+
+
+class ProviderRegistryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.smtp2go = models.SMTPProvider.objects.create(name="smtp2go", verified_domain="nicedomain.com")
+
+    def setUp(self):
+        self.registry = ProviderRegistry()
+
+    def test_ids_are_loaded_once(self):
+        with self.assertNumQueries(1):
+            async_to_sync(self.registry.start)()
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(self.registry.provider_id)("smtp2go"), self.smtp2go.pk)
+
+    def test_unknown_name_reloads(self):
+        async_to_sync(self.registry.start)()
+        mailersend = models.SMTPProvider.objects.create(name="mailersend", verified_domain="nicedomain.com")
+        self.assertEqual(async_to_sync(self.registry.provider_id)("mailersend"), mailersend.pk)
+        self.assertIsNone(async_to_sync(self.registry.provider_id)("nobody"))
+
+    def test_reset(self):
+        async_to_sync(self.registry.start)()
+        models.SMTPProvider.objects.filter(pk=self.smtp2go.pk).update(name="renamed")
+        self.registry.reset()
+        self.assertIsNone(async_to_sync(self.registry.provider_id)("smtp2go"))
+
+    def test_handlers_are_reused(self):
+        self.assertIs(self.registry.handler("smtp2go"), self.registry.handler("smtp2go"))
+        with self.assertRaises(KeyError):
+            self.registry.handler("nobody")
+
+
+class FakeBackend:
+    def __init__(self, fail_with=None):
+        self.fail_with = fail_with
+        self.sent = 0
+        self.closed = False
+
+    def send_messages(self, messages):
+        if self.fail_with:
+            raise self.fail_with
+        self.sent += len(messages)
+        return len(messages)
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(SMTPConnectionPool):
+    def __init__(self, **kwargs):
+        super().__init__("smtp.nicedomain.com", 587, "user", "password", **kwargs)
+        self.backends = []
+
+    def _connect(self):
+        self.backends.append(FakeBackend())
+        return PooledConnection(self.backends[-1])
+
+
+class SMTPConnectionPoolTests(SimpleTestCase):
+    def send(self, pool):
+        return async_to_sync(pool.send_messages)(["message"])
+
+    def test_reuses_sessions(self):
+        pool = FakePool()
+        for _ in range(3):
+            self.assertEqual(self.send(pool), 1)
+        self.assertEqual(len(pool.backends), 1)
+
+    def test_recycles_idle_sessions(self):
+        pool = FakePool(max_idle=0)
+        self.send(pool)
+        self.send(pool)
+        self.assertEqual(len(pool.backends), 2)
+        self.assertTrue(pool.backends[0].closed)
+
+    def test_replaces_a_session_the_server_closed(self):
+        pool = FakePool()
+        self.send(pool)
+        pool.backends[0].fail_with = SMTPServerDisconnected()
+        self.assertEqual(self.send(pool), 1)
+        self.assertEqual(len(pool.backends), 2)
+
+    def test_keeps_at_most_size_idle_sessions(self):
+        pool = FakePool(size=1)
+        first, second = pool._checkout()[0], pool._checkout()[0]
+        pool._checkin(first)
+        pool._checkin(second)
+        self.assertEqual(pool._idle, [first])
+        self.assertTrue(second.backend.closed)
+
+
+class SendEmailsTests(TestCase):
+    sender = "newsletter@nicedomain.com"
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create(username="hobbyist", full_name="Hobbyist")
+        provider = models.SMTPProvider.objects.create(name="smtp2go", verified_domain="nicedomain.com")
+        cls.app = DeployedApp.objects.create(owner=owner, name="newsletter")
+        models.EmailProvider.objects.create(app=cls.app, provider=provider, active=True, from_address=cls.sender)
+        cls.credentials = SMTPUserConfig(
+            provider="smtp2go", host="mail.smtp2go.com", port=2525, username="u", password="p", from_address=cls.sender
+        )
+
+    def setUp(self):
+        active_providers.clear()
+
+    def send_emails(self, recipients: list[str], send_messages=None):
+        messages = ", ".join(f'{{to: "{to}", subject: "Hi", html: "<p>Hi</p>"}}' for to in recipients)
+        query = (
+            f'mutation {{ sendEmails(appId: "app_{self.app.pk}", messages: [{messages}]) '
+            "{ sent results { to successful error } } }"
+        )
+        with (
+            mock.patch("mailer.schemas.get_smtp_user_config", mock.AsyncMock(return_value=self.credentials)) as config,
+            mock.patch("mailer.smtp_pool.smtp_pools.send_messages", send_messages or mock.AsyncMock(return_value=1)),
+        ):
+            response = self.client.post("/graphql/", {"query": query}, content_type="application/json")
+        self.assertEqual(config.await_count, 1)
+        return response.json()["data"]["sendEmails"]
+
+    def test_per_message_status(self):
+        async def send_messages(credentials, messages):
+            if messages[0].to == ["bad@example.com"]:
+                raise SMTPRecipientsRefused({"bad@example.com": (550, b"No such user")})
+            return 1
+
+        with self.settings(HOBBY_MONTHLY_EMAIL_LIMIT=10):
+            result = self.send_emails(["a@example.com", "bad@example.com", "b@example.com"], send_messages)
+        self.assertEqual(result["sent"], 2)
+        self.assertEqual([r["successful"] for r in result["results"]], [True, False, True])
+        self.assertIn("No such user", result["results"][1]["error"])
+
+    def test_hobby_quota_covers_the_batch(self):
+        models.MonthlyEmailUsage.objects.create(from_address=self.sender, billing_cycle=this_billing_cycle(), sent=1)
+        with self.settings(HOBBY_MONTHLY_EMAIL_LIMIT=3):
+            result = self.send_emails(["a@example.com", "b@example.com", "c@example.com"])
+        self.assertEqual(result["sent"], 2)
+        self.assertEqual(
+            result["results"][2], {"to": "c@example.com", "successful": False, "error": "Monthly quota reached"}
+        )
+        provider = models.EmailProvider.objects.get(app=self.app)
+        self.assertEqual(provider.maxed_quota_for, this_billing_cycle())
+
+    def test_queued_emails_use_the_hobby_quota(self):
+        models.OutboundEmail.objects.create(app=self.app, to="queued@example.com", subject="Hi", html="<p>Hi</p>")
+        with self.settings(HOBBY_MONTHLY_EMAIL_LIMIT=3):
+            result = self.send_emails(["a@example.com", "b@example.com", "c@example.com"])
+        self.assertEqual(result["sent"], 2)
+        self.assertEqual(result["results"][2]["error"], "Monthly quota reached")
+
+    def test_batch_is_recorded(self):
+        async def send_messages(credentials, messages):
+            if messages[0].to == ["bad@example.com"]:
+                raise SMTPRecipientsRefused({"bad@example.com": (550, b"No such user")})
+            return 1
+
+        with self.settings(HOBBY_MONTHLY_EMAIL_LIMIT=10):
+            self.send_emails(["a@example.com", "bad@example.com"], send_messages)
+        self.assertEqual(
+            dict(models.OutboundEmail.objects.values_list("to", "status")),
+            {"a@example.com": models.OutboundEmailStatus.SENT, "bad@example.com": models.OutboundEmailStatus.DEAD},
+        )
+        # the next batch only counts the emails still pending
+        with self.settings(HOBBY_MONTHLY_EMAIL_LIMIT=2):
+            self.assertEqual(self.send_emails(["c@example.com", "d@example.com"])["sent"], 2)
+
+
+class OutboundEmailTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create(username="sender", full_name="Sender")
+        provider = models.SMTPProvider.objects.create(name="smtp2go", verified_domain="nicedomain.com")
+        cls.app = DeployedApp.objects.create(owner=owner, name="app")
+        models.EmailProvider.objects.create(
+            app=cls.app, provider=provider, active=True, from_address="app@nicedomain.com"
+        )
+        cls.credentials = SMTPUserConfig(
+            provider="smtp2go", host="mail.smtp2go.com", port=2525, username="u", password="p"
+        )
+
+    def setUp(self):
+        active_providers.clear()
+
+    def graphql(self, query: str) -> dict:
+        return self.client.post("/graphql/", {"query": query}, content_type="application/json").json()
+
+    def enqueue(self, to="someone@example.com") -> str:
+        result = self.graphql(
+            f'mutation {{ sendEmail(appId: "app_{self.app.pk}", to: "{to}", subject: "Hi", html: "<p>Hi</p>") '
+            "{ successful jobId } }"
+        )
+        self.assertTrue(result["data"]["sendEmail"]["successful"])
+        return result["data"]["sendEmail"]["jobId"]
+
+    def process(self, send_messages=None) -> int:
+        with (
+            mock.patch("mailer.outbound.get_smtp_user_config", mock.AsyncMock(return_value=self.credentials)),
+            mock.patch("mailer.smtp_pool.smtp_pools.send_messages", send_messages or mock.AsyncMock(return_value=1)),
+        ):
+            return async_to_sync(process_batch)()
+
+    def status(self, job_id: str) -> dict:
+        return self.graphql(f'{{ outboundEmail(id: "{job_id}") {{ status attempts lastError }} }}')["data"][
+            "outboundEmail"
+        ]
+
+    def test_enqueue_then_send(self):
+        job_id = self.enqueue()
+        self.assertEqual(self.status(job_id), {"status": "QUEUED", "attempts": 0, "lastError": None})
+        self.assertEqual(self.process(), 1)
+        self.assertEqual(self.status(job_id), {"status": "SENT", "attempts": 1, "lastError": None})
+        self.assertEqual(self.process(), 0)
+
+    def test_retry_with_backoff_then_dead_letter(self):
+        job_id = self.enqueue()
+        failing = mock.AsyncMock(side_effect=SMTPServerDisconnected("Connection unexpectedly closed"))
+        self.process(failing)
+        job = models.OutboundEmail.objects.get(pk=job_id)
+        self.assertEqual((job.status, job.attempts), (models.OutboundEmailStatus.QUEUED, 1))
+        self.assertGreater(job.next_attempt_at, dj_tz.now())
+        self.assertEqual(self.process(failing), 0)  # not due yet
+
+        with self.settings(OUTBOUND_EMAIL=msgspec.structs.replace(settings.OUTBOUND_EMAIL, max_attempts=2)):
+            models.OutboundEmail.objects.filter(pk=job_id).update(next_attempt_at=dj_tz.now())
+            self.process(failing)
+        self.assertEqual(self.status(job_id)["status"], "DEAD")
+        self.assertIn("Connection unexpectedly closed", self.status(job_id)["lastError"])
+
+    def test_refused_recipient_is_dead_lettered_at_once(self):
+        job_id = self.enqueue("bad@example.com")
+        self.process(mock.AsyncMock(side_effect=SMTPRecipientsRefused({"bad@example.com": (550, b"No such user")})))
+        self.assertEqual(self.status(job_id)["status"], "DEAD")
+
+    def test_app_without_provider(self):
+        models.EmailProvider.objects.filter(app=self.app).update(active=False)
+        active_providers.invalidate(self.app.pk)
+        result = self.graphql(
+            f'mutation {{ sendEmail(appId: "app_{self.app.pk}", to: "a@example.com", subject: "Hi", html: "Hi") '
+            "{ jobId } }"
+        )
+        self.assertEqual(result["errors"][0]["message"], "This app does not have an active provider")
+
+    def test_maxed_app_cannot_enqueue(self):
+        models.EmailProvider.objects.filter(app=self.app).update(maxed_quota_for=this_billing_cycle())
+        result = self.graphql(
+            f'mutation {{ sendEmail(appId: "app_{self.app.pk}", to: "a@example.com", subject: "Hi", html: "Hi") '
+            "{ jobId } }"
+        )
+        self.assertIn("reached a quota limit", result["errors"][0]["message"])
+        self.assertFalse(models.OutboundEmail.objects.exists())
+
+    def test_queued_emails_use_the_hobby_quota(self):
+        models.MonthlyEmailUsage.objects.create(
+            from_address="app@nicedomain.com", billing_cycle=this_billing_cycle(), sent=1
+        )
+        with self.settings(HOBBY_MONTHLY_EMAIL_LIMIT=3):
+            self.enqueue()
+            self.enqueue()
+            result = self.graphql(
+                f'mutation {{ sendEmail(appId: "app_{self.app.pk}", to: "a@example.com", subject: "Hi", html: "Hi") '
+                "{ jobId } }"
+            )
+        self.assertEqual(result["errors"][0]["message"], "Monthly quota reached")
+        self.assertEqual(models.OutboundEmail.objects.count(), 2)
+
+    def test_unknown_job(self):
+        self.assertIsNone(self.status("not-a-uuid"))
+
+
+class GenerateEmailEventsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.provider = models.SMTPProvider.objects.create(name="smtp2go", verified_domain="nicedomain.com")
+
+    def test_copy_events(self):
+        dist = Distribution(
+            senders=["a@nicedomain.com", "b@nicedomain.com"],
+            sender_weights=[1, 0],
+            provider_ids=[self.provider.pk],
+            hard_bounce_rate=0,
+            soft_bounce_rate=1,
+            days=30,
+        )
+        self.assertEqual(copy_events(5, dist, seed=1, batch_size=2), 10)
+        events = models.EmailEvent.objects.all()
+        self.assertEqual(
+            sorted(events.values_list("event", flat=True)), ["sent"] * 5 + [models.EmailEventChoices.SOFT_BOUNCE] * 5
+        )
+        self.assertEqual(set(events.values_list("from_address", flat=True)), {"a@nicedomain.com"})
+        self.assertFalse(events.filter(send_time__lt=dj_tz.now() - timedelta(days=30)).exists())
+        self.assertTrue(all(event.reason for event in events))
+
+
+class WebhookEventQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.flushed = []
+        self.failures = 0
+        self.release = None
+        insert = mock.patch("mailer.ingestion.insert_email_events", side_effect=self.insert)
+        quotas = mock.patch("mailer.ingestion.enforce_hobby_quotas")
+        insert.start()
+        quotas.start()
+        self.addCleanup(insert.stop)
+        self.addCleanup(quotas.stop)
+
+    async def insert(self, events):
+        if self.release is not None:
+            await self.release.wait()
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("database unavailable")
+        self.flushed.append(len(events))
+        return events, {}
+
+    def queue(self, **kwargs) -> WebhookEventQueue:
+        options = {"batch_size": 2, "flush_interval": 60, "max_queue_size": 100, "enqueue_timeout": 1} | kwargs
+        return WebhookEventQueue(**options)
+
+    @staticmethod
+    def event(n: int) -> dict:
+        now = dj_tz.now()
+        return {
+            "event": "sent",
+            "event_time": now,
+            "send_time": now,
+            "message_id": f"message-{n}",
+            "username": "user",
+            "from_address": "a@nicedomain.com",
+            "recipients": ["someone@example.com"],
+            "reason": "",
+        }
+
+    def put_and_stop(self, queue: WebhookEventQueue, count: int):
+        async def run():
+            for n in range(count):
+                await queue.put(1, self.event(n))
+            await queue.stop()
+
+        async_to_sync(run)()
+
+    def test_flushes_full_batches(self):
+        self.put_and_stop(self.queue(), 5)
+        self.assertEqual(self.flushed, [2, 2, 1])
+
+    def test_flushes_after_the_interval(self):
+        queue = self.queue(batch_size=100, flush_interval=0.01)
+
+        async def run():
+            await queue.put(1, self.event(0))
+            await asyncio.sleep(0.1)
+            flushed = list(self.flushed)
+            await queue.stop()
+            return flushed
+
+        self.assertEqual(async_to_sync(run)(), [1])
+
+    def test_stop_flushes_waiting_events(self):
+        self.put_and_stop(self.queue(batch_size=100), 3)
+        self.assertEqual(self.flushed, [3])
+        self.assertFalse(self.queue().running)
+
+    def test_full_queue_refuses_events(self):
+        queue = self.queue(batch_size=1, max_queue_size=1, enqueue_timeout=0.01)
+
+        async def run():
+            self.release = asyncio.Event()
+            await queue.put(1, self.event(0))
+            # the worker took the first event and waits on the database, the second one fills the queue
+            await asyncio.sleep(0.01)
+            await queue.put(1, self.event(1))
+            with self.assertRaises(IngestionQueueFull):
+                await queue.put(1, self.event(2))
+            self.release.set()
+            await queue.stop()
+
+        async_to_sync(run)()
+        self.assertEqual(self.flushed, [1, 1])
+
+    def test_failed_flush_is_retried(self):
+        self.failures = 2
+        with self.assertLogs("mailer.ingestion", "WARNING"):
+            self.put_and_stop(self.queue(flush_retries=2), 2)
+        self.assertEqual(self.flushed, [2])
+
+    def test_failed_batch_is_dropped_and_counted(self):
+        self.failures = 2
+        with mock.patch("mailer.ingestion.dropped_counter") as dropped, self.assertLogs("mailer.ingestion", "ERROR"):
+            self.put_and_stop(self.queue(flush_retries=1), 3)
+        dropped.add.assert_called_once_with(2)
+        # the worker survived the dropped batch
+        self.assertEqual(self.flushed, [1])
+
+
+class EmailWebhookBatchTests(TestCase):
+    url = "/webhook/email/smtp2go/bla/batch"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.provider = models.SMTPProvider.objects.create(name="smtp2go", verified_domain="nicedomain.com")
+
+    def setUp(self):
+        # the ids of the providers are cached by name, their pk changes with every test
+        provider_registry.reset()
+
+    @staticmethod
+    def payload(email_id: str, event: str = "processed") -> dict:
+        return {
+            "event": event,
+            "time": "2026-10-01T10:00:05+00:00",
+            "sendtime": "2026-10-01T10:00:00+00:00",
+            "email_id": email_id,
+            "auth": "user",
+            "from_address": "a@nicedomain.com",
+            "rcpt": "someone@example.com",
+        }
+
+    def post(self, payloads, url=None):
+        return self.client.post(url or self.url, payloads, content_type="application/json")
+
+    def test_authentication(self):
+        for url in ("/webhook/email/smtp2go/wrong/batch", "/webhook/email/nobody/bla/batch"):
+            with self.assertLogs("mailer.views", "WARNING"):
+                response = self.post([self.payload("1")], url)
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(models.EmailEvent.objects.exists())
+
+    def test_stores_the_events(self):
+        response = self.post([self.payload("1"), self.payload("2"), self.payload("3", "delivered")])
+        self.assertEqual(response.json(), {"success": True, "stored": 3, "rejected": 0, "received": 3})
+        self.assertEqual(models.EmailEvent.objects.filter(provider=self.provider).count(), 3)
+
+    def test_duplicates_are_stored_once(self):
+        response = self.post([self.payload("1"), self.payload("1"), self.payload("1", "delivered")])
+        self.assertEqual(response.json()["stored"], 2)
+        self.assertEqual(models.EmailEvent.objects.filter(message_id="1").count(), 2)
+
+    def test_malformed_events_are_rejected_alone(self):
+        missing_time = self.payload("2")
+        del missing_time["sendtime"]
+        bad_time = self.payload("3") | {"time": "yesterday"}
+        with self.assertLogs("mailer.smtp_providers.smtp_provider", "WARNING") as logs:
+            response = self.post([self.payload("1"), missing_time, bad_time, {"event": "open"}])
+        self.assertEqual(response.json(), {"success": True, "stored": 1, "rejected": 2, "received": 4})
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(list(models.EmailEvent.objects.values_list("message_id", flat=True)), ["1"])
+
+    def test_not_an_array(self):
+        with self.assertLogs("mailer.views", "WARNING"):
+            response = self.post({"event": "processed"})
+        self.assertEqual(response.status_code, 400)
+
+
+class UsageCountersTests(TestCase):
+    senders = ("b@nicedomain.com", "a@nicedomain.com")
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.provider = models.SMTPProvider.objects.create(name="smtp2go", verified_domain="nicedomain.com")
+
+    def event(self, sender: str, send_time: datetime, event=models.EmailEventChoices.SENT) -> models.EmailEvent:
+        return models.EmailEvent(
+            provider=self.provider,
+            event=event,
+            event_time=send_time,
+            send_time=send_time,
+            message_id="message",
+            from_address=sender,
+            recipients=["someone@example.com"],
+        )
+
+    def counters(self) -> dict:
+        return {
+            (usage.from_address, usage.billing_cycle): usage.sent for usage in models.MonthlyEmailUsage.objects.all()
+        }
+
+    def test_increments_match_a_rebuild(self):
+        now = dj_tz.now()
+        last_month = now - timedelta(days=40)
+        for batch in (
+            [self.event(self.senders[0], now), self.event(self.senders[1], now), self.event(self.senders[0], now)],
+            [self.event(self.senders[1], last_month), self.event(self.senders[0], now)],
+            [self.event(self.senders[1], now, models.EmailEventChoices.DELIVERED)],
+        ):
+            async_to_sync(store_email_events)(batch)
+        incremented = self.counters()
+
+        self.assertEqual(rebuild_usage_counters(), len(incremented))
+        self.assertEqual(self.counters(), incremented)
+        self.assertEqual(incremented[self.senders[0], billing_cycle_of(now)], 3)
+
+    def test_rollups_match_the_events(self):
+        now = dj_tz.now()
+        events = models.EmailEventChoices
+        async_to_sync(store_email_events)(
+            [
+                self.event(self.senders[0], now),
+                self.event(self.senders[0], now, events.DELIVERED),
+                self.event(self.senders[1], now - timedelta(days=1), events.SOFT_BOUNCE),
+                self.event(self.senders[0], now - timedelta(days=9)),
+                self.event(self.senders[1], now - timedelta(days=9), events.HARD_BOUNCE),
+                self.event(self.senders[1], now - timedelta(days=40)),
+                self.event(self.senders[0], now - timedelta(days=90)),  # before the window
+            ]
+        )
+        start = datetime.combine(dj_tz.localdate() - timedelta(days=60), time(), dt_timezone.utc)
+        end = datetime.combine(dj_tz.localdate() + timedelta(days=1), time(), dt_timezone.utc)
+
+        def usage(time_bin: str, from_events: bool) -> list[dict]:
+            async def collect():
+                return [
+                    stats
+                    async for stats in models.EmailEvent.gen_usage(
+                        self.senders, time_bin, start, end, from_events=from_events, per_sender=True
+                    )
+                ]
+
+            return async_to_sync(collect)()
+
+        for rebuilt in (False, True):
+            if rebuilt:
+                rollup_email_usage()
+            for time_bin in ("day", "week", "month"):
+                with self.subTest(time_bin=time_bin, rebuilt=rebuilt):
+                    expected = usage(time_bin, from_events=True)
+                    self.assertTrue(expected)
+                    self.assertEqual(usage(time_bin, from_events=False), expected)
+
+    def test_rows_are_locked_in_key_order(self):
+        counts = {(sender, date(2025, 1, 31)): 1 for sender in self.senders}
+        with CaptureQueriesContext(connection) as queries:
+            models.MonthlyEmailUsage.increment(counts)
+        sql = queries[0]["sql"]
+        self.assertLess(sql.index("a@nicedomain.com"), sql.index("b@nicedomain.com"))
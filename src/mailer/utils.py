@@ -1,14 +1,25 @@
 import calendar
-from datetime import date
+from collections import Counter
+from datetime import date, datetime
 import logging
 from typing import Optional
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.db.models import Q
+from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
+from django.utils import timezone as dj_tz
 from msgspec import Struct
 
+from core import models as core_models
+
 from . import models
-from .smtp_providers import SMTPServiceProvider, SMTPUserNotFound
+from .active_provider import ActiveProvider, active_providers
+from .credentials import credential_cache
+from .models import event_day
+from .provider_registry import provider_registry
+from .smtp_pool import smtp_pools
+from .smtp_providers import SMTPUserNotFound
 
 logger = logging.getLogger(__name__)
 
@@ -20,42 +31,176 @@ class SMTPUserConfig(Struct):
     username: str
     password: str
     from_address: Optional[str] = None
+    external_id: Optional[str] = None
 
 
-async def get_smtp_user_config(app_id: str) -> SMTPUserConfig:
-    try:
-        app_provider_config = await models.EmailProvider.objects.select_related("provider").aget(
-            Q(maxed_quota_for__isnull=True) | Q(maxed_quota_for__lt=this_billing_cycle()),
-            app_id=app_id,
-            active=True,
+async def get_active_provider(app_id: str) -> ActiveProvider:
+    """The app's active provider, raises if it has none or if its quota is maxed for this billing cycle.
+    Reloaded once another process switched the provider or maxed the quota, see `ActiveProviderCache.get_current`
+    """
+    active = await active_providers.get_current(app_id)
+    if active is None:
+        raise SMTPUserNotFound("This app does not have an active provider")
+    if active.maxed_quota_for is not None and active.maxed_quota_for >= this_billing_cycle():
+        raise SMTPUserNotFound(
+            f"This app has reached a quota limit, you cannot send another email until after {active.maxed_quota_for}"
         )
-    except models.EmailProvider.DoesNotExist:
-        maybe_the_no_go_app = await models.EmailProvider.objects.filter(active=True, app_id=app_id).afirst()
-        if maybe_the_no_go_app is None:
-            raise SMTPUserNotFound("This app does not have an active provider")
-        if maybe_the_no_go_app.maxed_quota_for >= this_billing_cycle():
-            raise SMTPUserNotFound(
-                f"This app has reached a quota limit, you cannot send another email until after {maybe_the_no_go_app.maxed_quota_for}"
-            )
-        logger.error("Unexpected EmailProvider.DoesNotExist reason", extra={"app_id": app_id})
-        raise SMTPUserNotFound("App does not exist")  # this should never happen
+    return active
 
-    external_id = app_provider_config.external_id
-    provider = SMTPServiceProvider.get_provider(app_provider_config.provider.name)
+
+async def get_smtp_user_config(app_id: str) -> SMTPUserConfig:
+    active = await get_active_provider(app_id)
+    external_id = active.external_id
+    provider = provider_registry.handler(active.provider_name)
     # getting the provider should raise if it was not configured
-    credentials = await provider.get_user_credentials(external_id)
+    credentials = await credential_cache.get(
+        provider.name, external_id, lambda: provider.get_user_credentials(external_id)
+    )
 
     return SMTPUserConfig(
-        provider=app_provider_config.provider.name,
-        host=settings.STMP_PROVIDERS[app_provider_config.provider.name].smtp_host,
-        port=settings.STMP_PROVIDERS[app_provider_config.provider.name].smtp_port,
+        provider=active.provider_name,
+        host=settings.STMP_PROVIDERS[active.provider_name].smtp_host,
+        port=settings.STMP_PROVIDERS[active.provider_name].smtp_port,
         username=credentials["username"],
         password=credentials["password"],
-        from_address=app_provider_config.from_address,
+        from_address=active.from_address,
+        external_id=external_id,
+    )
+
+
+def build_message(credentials: SMTPUserConfig, to: str, subject: str, html: str) -> EmailMultiAlternatives:
+    msg = EmailMultiAlternatives(subject=subject, body=html, from_email=credentials.from_address, to=[to])
+    msg.attach_alternative(html, "text/html")
+    return msg
+
+
+async def send_email(credentials: SMTPUserConfig, to: str, subject: str, html: str):
+    await smtp_pools.send_messages(credentials, [build_message(credentials, to, subject, html)])
+
+
+def new_email_event(provider_id: int, webhook_data: dict) -> models.EmailEvent:
+    """Build an unsaved EmailEvent from the output of `SMTPServiceProvider.parse_webhook`"""
+    return models.EmailEvent(
+        provider_id=provider_id,
+        event=webhook_data["event"],
+        event_time=webhook_data["event_time"],
+        send_time=webhook_data["send_time"],
+        message_id=webhook_data["message_id"],
+        username=webhook_data["username"],
+        from_address=webhook_data["from_address"],
+        recipients=webhook_data["recipients"],
+        reason=webhook_data["reason"],
+    )
+
+
+async def enforce_hobby_quota(from_address: str, sent_count: int):
+    """Mark the apps sending from `from_address` as maxed for this billing cycle if they belong to a hobby user
+    and `sent_count`, the sender's counter for this cycle, reached the monthly limit.
+    """
+    if sent_count < settings.HOBBY_MONTHLY_EMAIL_LIMIT:
+        return
+    # the sender reached the limit, is it
+    # from some app owned by user with a hobby plan
+    hobby_sender_app_ids = await sync_to_async(list)(
+        models.EmailProvider.objects.filter(
+            from_address=from_address, app__owner__plan=core_models.PlanEnum.HOBBY.value
+        )
+        .distinct()
+        .values_list("app_id", flat=True)
+    )
+    if hobby_sender_app_ids:
+        #  mark all this user apps as maxed_quota
+        await models.EmailProvider.objects.filter(app_id__in=hobby_sender_app_ids).aupdate(
+            maxed_quota_for=this_billing_cycle()
+        )
+        active_providers.invalidate(*hobby_sender_app_ids)
+        # ideally we should also pause/disable all the smtp users of these hobby_sender_app_ids, till next month
+
+
+@sync_to_async
+@transaction.atomic
+def insert_email_events(events: list[models.EmailEvent]) -> tuple[list[models.EmailEvent], dict]:
+    """Insert the events and add them to the usage rollups and counters, all committed together.
+    Returns the events and the new `sent` totals of the senders, see `enforce_hobby_quotas`
+    """
+    events = models.EmailEvent.objects.bulk_create(events)
+    models.DailyEmailUsage.increment(Counter((e.from_address, event_day(e.send_time), e.event) for e in events))
+    sent = Counter(
+        (e.from_address, billing_cycle_of(e.send_time))
+        for e in events
+        if e.event == models.EmailEventChoices.SENT.value
+    )
+    return events, models.MonthlyEmailUsage.increment(sent)
+
+
+async def enforce_hobby_quotas(counters: dict[tuple[str, date], int]):
+    """Check the quota of the senders whose counters `insert_email_events` returned"""
+    current_cycle = this_billing_cycle()
+    for (from_address, cycle), sent_count in counters.items():
+        if cycle == current_cycle:
+            await enforce_hobby_quota(from_address, sent_count)
+
+
+async def store_email_events(events: list[models.EmailEvent]) -> list[models.EmailEvent]:
+    """Insert the events in one statement, update the usage rollups and counters and check the quota of the senders"""
+    events, counters = await insert_email_events(events)
+    await enforce_hobby_quotas(counters)
+    return events
+
+
+def remaining_hobby_quota(app_id: str, from_address: str) -> Optional[int]:
+    """Emails the app can still send this billing cycle, None when its owner is not on the hobby plan.
+    The webhooks count an email once it is sent, the app's emails still queued or sending use up the quota too
+    """
+    plan = core_models.User.objects.filter(apps__id=app_id).values_list("plan", flat=True).first()
+    if plan != core_models.PlanEnum.HOBBY.value:
+        return None
+    sent = (
+        models.MonthlyEmailUsage.objects.filter(from_address=from_address, billing_cycle=this_billing_cycle())
+        .values_list("sent", flat=True)
+        .first()
     )
+    pending = models.OutboundEmail.objects.filter(
+        app_id=app_id, status__in=[models.OutboundEmailStatus.QUEUED, models.OutboundEmailStatus.SENDING]
+    ).count()
+    return max(settings.HOBBY_MONTHLY_EMAIL_LIMIT - (sent or 0) - pending, 0)
+
+
+@sync_to_async
+@transaction.atomic
+def store_within_quota(
+    app_id: str, from_address: str, emails: list[models.OutboundEmail]
+) -> tuple[Optional[int], list[models.OutboundEmail]]:
+    """Store the `emails` the hobby quota still allows, all of them when the owner is not on the hobby plan.
+    Returns the quota left before them, see `remaining_hobby_quota`, and the stored emails
+    """
+    # the stores of one app wait on each other, each one counts the emails the previous ones stored
+    list(models.EmailProvider.objects.select_for_update().filter(app_id=app_id, active=True).values_list("pk"))
+    remaining = remaining_hobby_quota(app_id, from_address)
+    allowed = emails if remaining is None else emails[:remaining]
+    return remaining, models.OutboundEmail.objects.bulk_create(allowed)
+
+
+@sync_to_async
+def finish_sent_emails(emails: list[models.OutboundEmail], errors: list[Optional[BaseException]]):
+    """Record the outcome of emails sent right away, the failed ones are not retried"""
+    now = dj_tz.now()
+    models.OutboundEmail.objects.filter(pk__in=[e.pk for e, error in zip(emails, errors) if error is None]).update(
+        status=models.OutboundEmailStatus.SENT, sent_at=now, locked_at=None
+    )
+    for email, error in zip(emails, errors):
+        if error is not None:
+            models.OutboundEmail.objects.filter(pk=email.pk).update(
+                status=models.OutboundEmailStatus.DEAD, last_error=repr(error), locked_at=None
+            )
+
+
+def billing_cycle_of(moment: datetime) -> date:
+    """The billing cycle (last day of the month) an event that happened at `moment` counts against"""
+    day = event_day(moment)
+    _, last_day_of_month = calendar.monthrange(day.year, day.month)
+    return date(day.year, day.month, last_day_of_month)
 
 
 def this_billing_cycle():
-    today = date.today()
-    _, last_day_of_month = calendar.monthrange(today.year, today.month)
-    return date(today.year, today.month, last_day_of_month)
+    return billing_cycle_of(dj_tz.now())
@@ -1,79 +1,60 @@
 from logging import getLogger
 
-from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.db.models import Q
 from django.http.response import JsonResponse
-from django.utils import timezone as dj_tz
 import msgspec.json
 
-from core import models as core_models
-
-from .models import EmailEvent, EmailEventChoices, EmailProvider, SMTPProvider
+from .ingestion import IngestionQueueFull, ingestion_queue
+from .models import EmailProvider
+from .provider_registry import provider_registry
 from .smtp_providers import SMTPServiceProvider
-from .utils import this_billing_cycle
+from .utils import new_email_event, store_email_events
 
 logger = getLogger(__name__)
 
 
-async def email_webhook(request, provider_name: str, token: str):
+def _authenticate_webhook(provider_name: str, token: str) -> SMTPServiceProvider | JsonResponse:
     try:
-        provider_handler = SMTPServiceProvider.get_provider(provider_name)
+        provider_handler = provider_registry.handler(provider_name)
     except KeyError:
         logger.warning("Invalid provider", extra={"provider": provider_name})
         return JsonResponse(status=400, data={"error": "Invalid provider"})
     if provider_handler.webhook_token != token:
         logger.warning("Invalid token", extra={"provider": provider_name, "token": token})
         return JsonResponse(status=400, data={"error": "Invalid token"})
+    return provider_handler
+
+
+async def _provider_id(provider_name: str) -> int | JsonResponse:
+    provider_id = await provider_registry.provider_id(provider_name)
+    if provider_id is None:
+        logger.error("Provider missing from the database", extra={"provider": provider_name})
+        return JsonResponse(status=400, data={"error": "Invalid provider"})
+    return provider_id
 
-    provider = await SMTPProvider.objects.only("id").aget(name=provider_name)
+
+async def email_webhook(request, provider_name: str, token: str):
+    provider_handler = _authenticate_webhook(provider_name, token)
+    if isinstance(provider_handler, JsonResponse):
+        return provider_handler
+
+    provider_id = await _provider_id(provider_name)
+    if isinstance(provider_id, JsonResponse):
+        return provider_id
     data = msgspec.json.decode(request.body)
     try:
         if webhook_data := provider_handler.parse_webhook(data):
-            new_event = await EmailEvent.objects.acreate(
-                provider_id=provider.id,
-                event=webhook_data["event"],
-                event_time=webhook_data["event_time"],
-                send_time=webhook_data["send_time"],
-                message_id=webhook_data["message_id"],
-                username=webhook_data["username"],
-                from_address=webhook_data["from_address"],
-                recipients=webhook_data["recipients"],
-                reason=webhook_data["reason"],
-            )
-            logger.info("Email webhook", extra={"provider": provider_name, "event": webhook_data["event"]})
+            if settings.WEBHOOK_INGESTION.mode == "queued":
+                try:
+                    await ingestion_queue.put(provider_id, webhook_data)
+                except IngestionQueueFull:
+                    logger.warning("Webhook ingestion queue is full", extra={"provider": provider_name})
+                    # let the provider retry later
+                    return JsonResponse(status=503, data={"error": "Busy, retry later"})
+                return JsonResponse(status=200, data={"success": True})
 
-            # Check if the email was sent by a hobby user, and validate their quota
-            if new_event.event == EmailEventChoices.SENT.value:
-                # This is a:
-                # 1- SENT event
-                # 2- from some app owned by user with a hobby plan
-                hobby_sender_app_ids = await sync_to_async(list)(
-                    EmailProvider.objects.filter(
-                        from_address=new_event.from_address, app__owner__plan=core_models.PlanEnum.HOBBY.value
-                    )
-                    .distinct()
-                    .values_list("app_id", "from_address")
-                )
-                if hobby_sender_app_ids:
-                    # 3- and there is another event from any of this user's apps in the same billing cycle
-                    now = dj_tz.datetime.now()
-                    previously_sent_count = await EmailEvent.objects.filter(
-                        ~Q(pk=new_event.pk),
-                        # count all other `sent` events so we don't miscount if the isolation levenl is missed up in async django
-                        event=EmailEventChoices.SENT.value,
-                        send_time__gte=dj_tz.datetime(now.year, now.month, 1),
-                        send_time__lte=now,
-                        from_address__in=[i[1] for i in hobby_sender_app_ids],
-                    ).acount()
-                    if (
-                        previously_sent_count >= settings.HOBBY_MONTHLY_EMAIL_LIMIT - 1
-                    ):  # -1 because we excluded the current event
-                        #  mark all this user apps as maxed_quota
-                        await EmailProvider.objects.filter(app_id__in=[i[0] for i in hobby_sender_app_ids]).aupdate(
-                            maxed_quota_for=this_billing_cycle()
-                        )
-                        # ideally we should also pause/disable all the smtp users of these hobby_sender_app_ids, till next month
+            await store_email_events([new_email_event(provider_id, webhook_data)])
+            logger.info("Email webhook", extra={"provider": provider_name, "event": webhook_data["event"]})
             return JsonResponse(status=200, data={"success": True})
         return JsonResponse(status=200, data={"message": "Not important"})
     except Exception as e:
@@ -85,10 +66,38 @@ async def email_webhook(request, provider_name: str, token: str):
         return JsonResponse(status=200, data={"error": "Invalid webhook data"})
 
 
-async def switch_provider(request, app_id: str, provider_name: str):
+async def email_webhook_batch(request, provider_name: str, token: str):
+    """Accept a JSON array of provider events, the token is checked once and all rows are inserted at once.
+    A malformed event is rejected alone, the others are stored
+    """
+    provider_handler = _authenticate_webhook(provider_name, token)
+    if isinstance(provider_handler, JsonResponse):
+        return provider_handler
+
     try:
-        provider = await SMTPProvider.objects.only("id").aget(name=provider_name)
-    except SMTPProvider.DoesNotExist:
+        payloads = msgspec.json.decode(request.body, type=list[dict])
+    except msgspec.DecodeError:
+        logger.warning("Invalid webhook batch", extra={"provider": provider_name})
+        return JsonResponse(status=400, data={"error": "Expected a JSON array of events"})
+
+    provider_id = await _provider_id(provider_name)
+    if isinstance(provider_id, JsonResponse):
+        return provider_id
+    parsed, rejected = provider_handler.parse_webhook_batch(payloads)
+    try:
+        events = await store_email_events([new_email_event(provider_id, webhook_data) for webhook_data in parsed])
+    except Exception as e:
+        logger.error(str(e), extra={"provider": provider_name, "count": len(payloads)}, exc_info=True)
+        return JsonResponse(status=200, data={"error": "Invalid webhook data"})
+    logger.info("Email webhook batch", extra={"provider": provider_name, "count": len(events), "rejected": rejected})
+    return JsonResponse(
+        status=200, data={"success": True, "stored": len(events), "rejected": rejected, "received": len(payloads)}
+    )
+
+
+async def switch_provider(request, app_id: str, provider_name: str):
+    provider_id = await provider_registry.provider_id(provider_name)
+    if provider_id is None:
         return JsonResponse(status=404, data={"error": "Invalid provider"})
-    await EmailProvider.switch_provider(app_id, provider)
+    await EmailProvider.switch_provider(app_id, provider_id)
     return JsonResponse(status=200, data={"success": True})